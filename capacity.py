@@ -0,0 +1,88 @@
+# capacity.py
+#
+# Pre-flight send-rate analysis of a parsed upload: how many sends fall in
+# each time bucket versus what the configured pacing / sender can push out,
+# and the backlog and completion time that implies. Pure arithmetic, no I/O.
+
+import math
+import os
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List
+
+from ingest import IST
+
+# Provider-side ceiling for one sender (messages per second).
+SENDER_MAX_PER_SECOND = float(os.environ.get("SENDER_MAX_PER_SECOND", 80))
+MAX_BUCKETS = 2000
+
+
+def send_rate(delay_seconds: float, sender_max_per_second: float = SENDER_MAX_PER_SECOND) -> float:
+    """Effective sends/second: the pacing delay capped by the sender's limit."""
+    d = float(delay_seconds or 0)
+    pace = 1.0 / d if d > 0 else math.inf
+    return min(pace, float(sender_max_per_second or math.inf))
+
+
+def preflight(jobs: List[Dict], delay_seconds: float, bucket_seconds: int = 600,
+              sender_max_per_second: float = SENDER_MAX_PER_SECOND, senders: int = 1) -> Dict:
+    """
+    Histogram scheduled sends into `bucket_seconds` buckets and compare with capacity.
+    Each of `senders` pooled numbers is paced independently, so capacity scales with it.
+    Completion time and lateness use the exact single-queue recurrence
+    start_i = max(due_i, start_{i-1} + 1/rate) over the sorted due times.
+    """
+    rate = send_rate(delay_seconds, sender_max_per_second) * max(1, int(senders))
+    dues = sorted(j["scheduled_at"].timestamp() for j in jobs)
+    if not dues:
+        return {"messages": 0, "rate_per_second": rate, "buckets": [], "overloaded": [],
+                "peak_backlog": 0, "max_lateness_s": 0.0, "predicted_finish": "", "last_due": ""}
+
+    # keep the chart readable for long campaigns
+    span = dues[-1] - dues[0]
+    bucket_seconds = max(int(bucket_seconds), int(math.ceil(span / MAX_BUCKETS)) or 1)
+    counts = Counter(int(t // bucket_seconds) * bucket_seconds for t in dues)
+
+    gap = 0.0 if math.isinf(rate) else 1.0 / rate
+    start = -math.inf
+    max_late = 0.0
+    for t in dues:
+        start = max(t, start + gap)
+        max_late = max(max_late, start - t)
+    finish = start
+
+    per_bucket = rate * bucket_seconds
+    buckets, overloaded = [], []
+    backlog, peak = 0.0, 0.0
+    b = min(counts)
+    last = max(max(counts), int(finish // bucket_seconds) * bucket_seconds)
+    while b <= last:
+        arrivals = counts.get(b, 0)
+        backlog = max(0.0, backlog + arrivals - per_bucket)
+        peak = max(peak, backlog)
+        row = {
+            "bucket_start": _iso(b),
+            "scheduled": arrivals,
+            "capacity": per_bucket if not math.isinf(per_bucket) else arrivals,
+            "backlog": int(round(backlog)),
+        }
+        buckets.append(row)
+        if arrivals > per_bucket:
+            overloaded.append(row)
+        b += bucket_seconds
+
+    return {
+        "messages": len(dues),
+        "rate_per_second": rate,
+        "bucket_seconds": bucket_seconds,
+        "buckets": buckets,
+        "overloaded": overloaded,
+        "peak_backlog": int(round(peak)),
+        "max_lateness_s": max_late,
+        "last_due": _iso(dues[-1]),
+        "predicted_finish": _iso(finish),
+    }
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, IST).isoformat(timespec="minutes")
@@ -0,0 +1,193 @@
+# circuit_breaker.py
+#
+# Per-Twilio-account circuit breaker. When credentials are revoked, the
+# account is suspended or Twilio keeps answering 5xx, every further call is
+# wasted and turns a pending message into a failed one. The breaker watches
+# the last WINDOW_SECONDS of call outcomes by error class and trips:
+#   account  ACCOUNT_TRIP_ERRORS auth / account errors (20003, 20005, ... / HTTP 401, 403)
+#   server   >= SERVER_TRIP_RATIO of at least MIN_CALLS calls were 5xx / transport errors
+# While open, callers hold their messages (media_scheduler reschedules them)
+# instead of sending. After the open period one caller gets a half-open
+# probe: a healthy answer closes the breaker, another systemic error re-opens
+# it for twice as long (up to MAX_OPEN_SECONDS). Recipient errors (invalid
+# number, template, ...) say nothing about the provider and count as healthy;
+# throttling is left to the sender pool's cooldowns.
+
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+WINDOW_SECONDS = 60.0
+ACCOUNT_TRIP_ERRORS = 3
+MIN_CALLS = 10
+SERVER_TRIP_RATIO = 0.5
+OPEN_SECONDS = 30.0
+MAX_OPEN_SECONDS = 900.0
+PROBE_TIMEOUT_SECONDS = 60.0  # a probe that never reports back frees the slot
+MAX_HOLDS = 20  # a message held this often is failed (something about it, not the provider, is wrong)
+
+ACCOUNT_CODES = {20003, 20005, 20006, 20008, 401, 403}
+SERVER_CODES = {20500, 20503, "transport"}
+THROTTLE_CODES = {20429, 63018, 429}  # as sender_pool.THROTTLE_CODES (cooldowns handle these)
+
+
+def classify(code) -> str:
+    """"account", "server", "throttle" or "ok" (delivered or a recipient-specific error)."""
+    if code in ACCOUNT_CODES:
+        return "account"
+    if code in SERVER_CODES or (isinstance(code, int) and 500 <= code < 600):
+        return "server"
+    if code in THROTTLE_CODES:
+        return "throttle"
+    return "ok"
+
+
+def is_transport_error(exc: BaseException) -> bool:
+    """Could not reach the provider (connection refused / reset, DNS, timeout): counted as a server error."""
+    transport = [ConnectionError, TimeoutError]
+    try:
+        import requests
+        transport += [requests.exceptions.ConnectionError, requests.exceptions.Timeout]
+    except ImportError:
+        pass
+    try:
+        import urllib3
+        transport += [urllib3.exceptions.ProtocolError, urllib3.exceptions.TimeoutError,
+                      urllib3.exceptions.NewConnectionError]
+    except ImportError:
+        pass
+    return isinstance(exc, tuple(transport))
+
+
+def is_systemic(code) -> bool:
+    """An error that says nothing about the message itself: hold it for a retry instead of failing it."""
+    return classify(code) in ("account", "server")
+
+
+class Breaker:
+    def __init__(self, name: str, clock=time.time):
+        self.name = name
+        self.clock = clock
+        self.state = CLOSED
+        self.reason = ""
+        self.opened_at: Optional[float] = None
+        self.open_until = 0.0
+        self._open_for = OPEN_SECONDS
+        self._probe_at: Optional[float] = None
+        self._events: deque = deque()  # (ts, class)
+        self._lock = threading.Lock()
+        self.trips = 0
+        self.held = 0
+
+    # ---------------- CALL PATH ----------------
+    def allow(self) -> bool:
+        """May a call go out now? In half-open state exactly one caller gets True (the probe)."""
+        now = self.clock()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now < self.open_until:
+                    return False
+                self.state = HALF_OPEN
+            if self._probe_at is not None and now - self._probe_at < PROBE_TIMEOUT_SECONDS:
+                return False
+            self._probe_at = now
+            return True
+
+    def is_open(self, now: Optional[float] = None) -> bool:
+        """Open and not yet due for a probe (senders in this state are skipped)."""
+        return self.state == OPEN and (now or self.clock()) < self.open_until
+
+    def record(self, code=None):
+        """Outcome of a call that went out: code None = delivered, else the error code."""
+        kind = classify(code)
+        if kind == "throttle":
+            return
+        now = self.clock()
+        with self._lock:
+            if self.state == OPEN:
+                return  # calls that were in flight when it tripped
+            if self.state == HALF_OPEN:
+                if kind == "ok":
+                    self._close()
+                else:
+                    self._trip(now, f"probe failed ({code})", backoff=True)
+                return
+            self._events.append((now, kind))
+            while self._events and now - self._events[0][0] > WINDOW_SECONDS:
+                self._events.popleft()
+            if kind == "account":
+                if sum(1 for _, k in self._events if k == "account") >= ACCOUNT_TRIP_ERRORS:
+                    self._trip(now, f"account / auth errors ({code})")
+            elif kind == "server":
+                server = sum(1 for _, k in self._events if k == "server")
+                if len(self._events) >= MIN_CALLS and server / len(self._events) >= SERVER_TRIP_RATIO:
+                    self._trip(now, f"{server}/{len(self._events)} calls failed with 5xx / network errors")
+
+    def _trip(self, now: float, reason: str, backoff: bool = False):
+        if backoff:
+            self._open_for = min(MAX_OPEN_SECONDS, self._open_for * 2)
+        else:
+            self.trips += 1
+            self.opened_at = now
+        self.state = OPEN
+        self.reason = reason
+        self.open_until = now + self._open_for
+        self._probe_at = None
+        print(f"[BREAKER] {self.name} open for {self._open_for:.0f}s: {reason}")
+
+    def _close(self):
+        print(f"[BREAKER] {self.name} closed after probe")
+        self.state = CLOSED
+        self.reason = ""
+        self._open_for = OPEN_SECONDS
+        self._probe_at = None
+        self._events.clear()
+
+    def reset(self):
+        """Manual override: close now (e.g. after fixing the credentials)."""
+        with self._lock:
+            self._close()
+
+    # ---------------- HOLDING ----------------
+    def hold_until(self, due_ts: float) -> float:
+        """
+        When a held message should come due again: after the open period,
+        keeping its offset from the trip so the backlog replays in its original order.
+        due_ts is the message's original due time (not an earlier hold's), so
+        re-holding after a failed probe does not push it out any further.
+        """
+        now = self.clock()
+        resume = max(self.open_until, now) + 1.0
+        return resume + max(0.0, due_ts - (self.opened_at or now))
+
+    def stats(self) -> Dict:
+        now = self.clock()
+        with self._lock:
+            recent = [k for t, k in self._events if now - t <= WINDOW_SECONDS]
+        return {"account": self.name, "state": self.state, "reason": self.reason,
+                "probe_in_s": round(max(0.0, self.open_until - now)) if self.state != CLOSED else 0,
+                "calls_60s": len(recent), "errors_60s": sum(1 for k in recent if k != "ok"),
+                "trips": self.trips, "held": self.held}
+
+
+# ---------------- PROCESS-WIDE BREAKERS ----------------
+_breakers: Dict[str, Breaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get(account: str) -> Breaker:
+    """The breaker for one Twilio account SID (shared by every sender and pool on it)."""
+    with _breakers_lock:
+        br = _breakers.get(account)
+        if br is None:
+            br = _breakers[account] = Breaker(account)
+        return br
+
+
+def all_breakers() -> List[Breaker]:
+    with _breakers_lock:
+        return list(_breakers.values())
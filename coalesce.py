@@ -0,0 +1,120 @@
+# coalesce.py
+#
+# Per-recipient coalescing before scheduling. Uploads often list the same
+# mobile_number on several rows a few minutes apart; each row would be its
+# own Twilio call. Within COALESCE_WINDOW_SECONDS of a recipient's first row:
+#   - exact duplicates (same media and same text) are dropped
+#   - the rest are merged into one message where WhatsApp allows it: texts
+#     are joined, and at most one media attachment goes per message
+# The merged message goes out at the earliest row's time in the most urgent
+# lane of its rows, and carries the absorbed rows in job["coalesced"] and its
+# own row as it was uploaded in job["row"] (revisions diff against those).
+
+import os
+from typing import Dict, List, Tuple
+
+import dispatch
+import message_templates
+
+COALESCE_WINDOW_SECONDS = float(os.environ.get("COALESCE_WINDOW_SECONDS", 0))  # 0 = off
+MERGE_SEPARATOR = "\n\n"
+MAX_BODY_CHARS = 1600  # Twilio rejects longer message bodies
+
+
+def _ts(job: Dict) -> float:
+    return job["scheduled_at"].timestamp()
+
+
+ROW_FIELDS = ("job_id", "row_key", "scheduled_at", "media_url", "lane", "body")
+
+
+def _absorbed(job: Dict) -> Dict:
+    """The parts of a row upload_diff.fingerprint compares, kept once the row is folded into a message."""
+    return {k: job[k] for k in ROW_FIELDS if k in job}
+
+
+def _merge(cluster: List[Dict]) -> Tuple[List[Dict], int, int]:
+    """One recipient's rows inside a window -> (messages, duplicates dropped, rows merged)."""
+    index: Dict[tuple, int] = {}
+    distinct: List[Tuple[Dict, str, List[Dict]]] = []  # (job, body, duplicates of it)
+    for job in cluster:
+        body = message_templates.body_for(job)
+        key = (job.get("media_url", ""), body)
+        if key in index:
+            distinct[index[key]][2].append(_absorbed(job))
+        else:
+            index[key] = len(distinct)
+            distinct.append((job, body, []))
+    dupes = len(cluster) - len(distinct)
+
+    groups: List[Dict] = []
+    for job, body, dup in distinct:
+        media = job.get("media_url", "")
+        lane = dispatch.LANES.index(dispatch.job_lane(job))
+        last = groups[-1] if groups else None
+        if last is not None and not (media and last["media"]) and \
+                len(MERGE_SEPARATOR.join(last["bodies"] + [body])) <= MAX_BODY_CHARS:
+            last["bodies"].append(body)
+            last["media"] = last["media"] or media
+            last["absorbed"] += [_absorbed(job)] + dup
+            last["lane"] = min(last["lane"], lane)
+        else:
+            groups.append({"job": job, "bodies": [body], "media": media, "absorbed": list(dup), "lane": lane})
+
+    messages = []
+    for g in groups:
+        job = g["job"]
+        if not g["absorbed"]:
+            messages.append(job)
+            continue
+        msg = {**job, "coalesced": g["absorbed"], "row": _absorbed(job), "lane": dispatch.LANES[g["lane"]]}
+        if len(g["bodies"]) > 1 or g["media"] != job.get("media_url", ""):
+            msg.update(body=MERGE_SEPARATOR.join(g["bodies"]), media_url=g["media"])
+        messages.append(msg)
+    return messages, dupes, len(distinct) - len(groups)
+
+
+def coalesce_recipients(jobs: List[Dict], window_seconds: float = COALESCE_WINDOW_SECONDS) -> Tuple[List[Dict], Dict]:
+    """
+    Returns (jobs to schedule, report). report: rows, sends, duplicates_dropped,
+    merged, api_calls_saved, recipients (recipients with fewer sends). window_seconds <= 0 returns jobs unchanged.
+    """
+    report = {"rows": len(jobs), "sends": len(jobs), "duplicates_dropped": 0, "merged": 0,
+              "api_calls_saved": 0, "recipients": 0}
+    if not window_seconds or window_seconds <= 0 or len(jobs) < 2:
+        return jobs, report
+
+    by_phone: Dict[str, List[Dict]] = {}
+    for job in jobs:
+        by_phone.setdefault(job.get("mobile_number", ""), []).append(job)
+
+    out = []
+    for phone, rows in by_phone.items():
+        if len(rows) == 1 or not phone:
+            out.extend(rows)
+            continue
+        rows.sort(key=_ts)
+        cluster: List[Dict] = []
+        saved = False
+        for job in rows + [None]:
+            if job is not None and (not cluster or _ts(job) - _ts(cluster[0]) <= window_seconds):
+                cluster.append(job)
+                continue
+            if len(cluster) > 1:
+                messages, dupes, merged = _merge(cluster)
+                report["duplicates_dropped"] += dupes
+                report["merged"] += merged
+                saved = saved or len(messages) < len(cluster)
+                out.extend(messages)
+            else:
+                out.extend(cluster)
+            cluster = [job] if job is not None else []
+        report["recipients"] += saved
+    out.sort(key=_ts)
+    report["sends"] = len(out)
+    report["api_calls_saved"] = len(jobs) - len(out)
+    return out, report
+
+
+def absorbed_ids(job: Dict) -> List[str]:
+    return [a["job_id"] for a in job.get("coalesced", ())]
@@ -0,0 +1,335 @@
+# dispatch.py
+#
+# Scheduling-layer helpers that do not depend on Streamlit:
+#   - RateLimiter: token bucket shared by everything that talks to the provider
+#   - plan_batches: coalesce rows with (nearly) identical scheduled_at into one job
+#   - run_batch / iter_batch: fan a batch out to a sender under the rate limit
+#   - priority lanes (urgent / normal / bulk): reserved worker threads and a
+#     guaranteed share of the send rate per lane
+# Clock and sleep are injectable so the same code can run on a virtual clock.
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from apscheduler.executors.pool import ThreadPoolExecutor
+
+# Default "nearly identical" window for coalescing rows into one batch job.
+BATCH_WINDOW_SECONDS = 60
+# misfire_grace_time for single-row jobs (batch jobs never misfire).
+MISFIRE_GRACE_SECONDS = 60
+
+
+# ---------------- RATE LIMITER ----------------
+class RateLimiter:
+    """Thread-safe token bucket. rate_per_sec <= 0 means unlimited."""
+
+    def __init__(self, rate_per_sec: float, burst: int = 1,
+                 clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep):
+        self.clock, self.sleep = clock, sleep
+        self._lock = threading.Lock()
+        self.rate = float(rate_per_sec or 0)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._last = clock()
+
+    @classmethod
+    def from_delay(cls, delay_seconds: float, **kw) -> "RateLimiter":
+        d = float(delay_seconds or 0)
+        return cls(1.0 / d if d > 0 else 0, **kw)
+
+    def set_rate(self, rate_per_sec: float):
+        with self._lock:
+            self._refill()
+            self.rate = float(rate_per_sec or 0)
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self) -> float:
+        """Take one token; return how long the caller must wait before using it."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill()
+            self._tokens -= 1.0
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def next_free_in(self) -> float:
+        """Seconds until a token is available, without taking it."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill()
+            return max(0.0, (1.0 - self._tokens) / self.rate)
+
+    def try_take(self, keep: float = 0.0) -> bool:
+        """Take a token only if one is ready now and `keep` tokens remain afterwards."""
+        with self._lock:
+            if self.rate <= 0:
+                return True
+            self._refill()
+            if self._tokens - 1.0 < keep:
+                return False
+            self._tokens -= 1.0
+            return True
+
+    def acquire(self) -> float:
+        """Block until a send is allowed; return the seconds waited."""
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def shared_limiter(key: str = "default", delay_seconds: Optional[float] = None) -> RateLimiter:
+    """Process-wide limiter per key; delay_seconds (if given) updates its pacing."""
+    with _limiters_lock:
+        lim = _limiters.get(key)
+        if lim is None:
+            lim = _limiters[key] = RateLimiter.from_delay(delay_seconds or 0)
+    if delay_seconds is not None:
+        d = float(delay_seconds or 0)
+        lim.set_rate(1.0 / d if d > 0 else 0)
+    return lim
+
+
+# ---------------- PRIORITY LANES ----------------
+URGENT, NORMAL, BULK = "urgent", "normal", "bulk"
+LANES = (URGENT, NORMAL, BULK)  # highest priority first
+DEFAULT_LANE = NORMAL
+LANE_ALIASES = {"high": URGENT, "p0": URGENT, "critical": URGENT, "medium": NORMAL, "default": NORMAL,
+                "low": BULK, "campaign": BULK, "marketing": BULK}
+
+
+def _lane_setting(env: str, default: Dict[str, float]) -> Dict[str, float]:
+    # e.g. LANE_WORKERS="urgent=2,normal=6,bulk=4"
+    out = dict(default)
+    for part in os.environ.get(env, "").split(","):
+        lane, _, val = part.partition("=")
+        if lane.strip() in out and val.strip():
+            out[lane.strip()] = float(val)
+    return out
+
+
+# Guaranteed share of the provider send rate per lane; a lane's idle share is lent to the others.
+LANE_RATE_SHARES = _lane_setting("LANE_RATE_SHARES", {URGENT: 0.2, NORMAL: 0.4, BULK: 0.4})
+# APScheduler worker threads reserved per lane, so bulk batches cannot occupy urgent workers.
+LANE_WORKERS = {k: max(1, int(v)) for k, v in
+                _lane_setting("LANE_WORKERS", {URGENT: 2, NORMAL: 6, BULK: 4}).items()}
+
+
+def normalize_lane(value, default: Optional[str] = None) -> Optional[str]:
+    """Map a priority cell / setting to a lane name; `default` for blanks and unknown values."""
+    v = str(value or "").strip().lower()
+    if v in LANES:
+        return v
+    return LANE_ALIASES.get(v, default)
+
+
+def job_lane(job: Dict) -> str:
+    return job.get("lane") or DEFAULT_LANE
+
+
+def lane_executor(lane: str) -> str:
+    """APScheduler executor alias for a lane (normal keeps the "default" executor)."""
+    return "default" if lane == NORMAL else lane
+
+
+def lane_executors() -> Dict[str, ThreadPoolExecutor]:
+    return {lane_executor(lane): ThreadPoolExecutor(LANE_WORKERS[lane]) for lane in LANES}
+
+
+class LaneLimiter:
+    """
+    One provider rate split into per-lane token buckets (rate * share each).
+    A lane whose bucket is empty borrows a ready token from another lane, but
+    lenders keep their last token, so an idle lane can always send at once.
+    """
+
+    def __init__(self, rate_per_sec: float, shares: Optional[Dict[str, float]] = None,
+                 clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep):
+        self.clock, self.sleep = clock, sleep
+        self.shares = self._normalized(shares or LANE_RATE_SHARES)
+        self.buckets = {lane: RateLimiter(0, burst=2, clock=clock, sleep=sleep) for lane in LANES}
+        self.set_rate(rate_per_sec)
+
+    @staticmethod
+    def _normalized(shares: Dict[str, float]) -> Dict[str, float]:
+        total = sum(max(0.0, shares.get(lane, 0.0)) for lane in LANES) or 1.0
+        return {lane: max(0.0, shares.get(lane, 0.0)) / total for lane in LANES}
+
+    @classmethod
+    def from_delay(cls, delay_seconds: float, **kw) -> "LaneLimiter":
+        d = float(delay_seconds or 0)
+        return cls(1.0 / d if d > 0 else 0, **kw)
+
+    def set_rate(self, rate_per_sec: float):
+        self.rate = float(rate_per_sec or 0)
+        for lane, bucket in self.buckets.items():
+            # a zero share still gets a trickle so that lane can never starve
+            bucket.set_rate(self.rate * max(self.shares[lane], 0.01) if self.rate > 0 else 0)
+
+    def reserve(self, lane: str) -> float:
+        own = self.buckets[lane]
+        if own.try_take():
+            return 0.0
+        for other in LANES:
+            if other != lane and self.buckets[other].try_take(keep=1.0):
+                return 0.0
+        return own.reserve()
+
+    def lane(self, lane: str) -> "_LaneView":
+        return _LaneView(self, lane)
+
+
+class _LaneView:
+    """RateLimiter-compatible handle (reserve/acquire/clock/sleep) for one lane."""
+
+    def __init__(self, parent: LaneLimiter, lane: str):
+        self.parent, self.name = parent, lane
+        self.clock, self.sleep = parent.clock, parent.sleep
+
+    def reserve(self) -> float:
+        return self.parent.reserve(self.name)
+
+    def next_free_in(self) -> float:
+        return self.parent.buckets[self.name].next_free_in()
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+_lane_limiters: Dict[str, LaneLimiter] = {}
+
+
+def lane_limiter(lane: str, delay_seconds: Optional[float] = None, key: str = "default") -> _LaneView:
+    """Process-wide lane-aware limiter per key, as a handle for `lane`."""
+    with _limiters_lock:
+        lim = _lane_limiters.get(key)
+        if lim is None:
+            lim = _lane_limiters[key] = LaneLimiter.from_delay(delay_seconds or 0)
+    if delay_seconds is not None:
+        d = float(delay_seconds or 0)
+        rate = 1.0 / d if d > 0 else 0
+        if rate != lim.rate:
+            lim.set_rate(rate)
+    return lim.lane(lane if lane in LANES else DEFAULT_LANE)
+
+
+# ---------------- BATCH PLANNING ----------------
+def _ts(job) -> float:
+    return job["scheduled_at"].timestamp()
+
+
+def plan_batches(jobs: List[Dict], window_seconds: float = BATCH_WINDOW_SECONDS) -> List[Dict]:
+    """
+    Group jobs of the same lane whose scheduled_at fall in the same window.
+    window_seconds=0 groups identical timestamps only.
+    Returns [{"batch_id", "scheduled_at", "lane", "jobs"}] sorted by time; each
+    batch's jobs are sorted by scheduled_at and the batch runs at its earliest job.
+    """
+    groups: Dict[tuple, List[Dict]] = {}
+    for job in jobs:
+        t = _ts(job)
+        key = (t // window_seconds) * window_seconds if window_seconds and window_seconds > 0 else t
+        groups.setdefault((key, LANES.index(job_lane(job))), []).append(job)
+
+    batches = []
+    for key in sorted(groups):
+        members = sorted(groups[key], key=_ts)
+        lane = LANES[key[1]]
+        digest = hashlib.sha1("\n".join(j["job_id"] for j in members).encode("utf-8")).hexdigest()[:12]
+        first = members[0]["scheduled_at"]
+        prefix = "batch" if lane == DEFAULT_LANE else f"batch|{lane}"
+        batches.append({
+            "batch_id": f"{prefix}|{first.isoformat()}|{len(members)}|{digest}",
+            "scheduled_at": first,
+            "lane": lane,
+            "jobs": members,
+        })
+    return batches
+
+
+# ---------------- FAN-OUT ----------------
+def iter_batch(batch: Dict, send_one: Callable[[Dict], Dict], limiter: RateLimiter,
+               clock: Optional[Callable[[], float]] = None,
+               admit: Optional[Callable[[Dict], bool]] = None,
+               limiter_for: Optional[Callable[[Dict], RateLimiter]] = None):
+    """
+    Generator core of run_batch. Yields the steps a worker goes through:
+      ("due", seconds)   hold until the next job's own scheduled_at
+      ("rate", seconds)  wait imposed by the rate limiter
+      ("sent", outcome)  one send finished
+    and returns the batch summary. run_batch drives it with real sleeps; the
+    simulator drives it on a virtual clock. `admit(job)` is asked when a job
+    comes due; False skips it without using a rate-limit token.
+    `limiter_for(job)`, if given, picks the limiter per job (e.g. per sender).
+    """
+    clock = clock or limiter.clock
+    outcomes = []
+    for job in batch["jobs"]:
+        due_in = _ts(job) - clock()
+        if due_in > 0:
+            yield "due", due_in
+        if admit is not None and not admit(job):
+            outcomes.append({"job_id": job["job_id"], "status": "skipped"})
+            continue
+        wait = (limiter_for(job) if limiter_for is not None else limiter).reserve()
+        if wait > 0:
+            yield "rate", wait
+        try:
+            res = send_one(job) or {}
+        except Exception as e:
+            res = {"status": "failed", "error": str(e)}
+        outcome = {"job_id": job["job_id"], "status": res.get("status", "failed"),
+                   **{k: v for k, v in res.items() if k != "status"}}
+        outcomes.append(outcome)
+        yield "sent", outcome
+    delivered = sum(1 for o in outcomes if o["status"] == "delivered")
+    skipped = sum(1 for o in outcomes if o["status"] == "skipped")
+    held = sum(1 for o in outcomes if o["status"] == "held")
+    return {
+        "batch_id": batch["batch_id"],
+        "delivered": delivered,
+        "failed": len(outcomes) - delivered - skipped - held,
+        "skipped": skipped,
+        "held": held,
+        "finished_at": datetime.fromtimestamp(clock()).isoformat(timespec="seconds"),
+        "outcomes": outcomes,
+    }
+
+
+def run_batch(batch: Dict, send_one: Callable[[Dict], Dict], limiter: RateLimiter,
+              clock: Optional[Callable[[], float]] = None,
+              sleep: Optional[Callable[[float], None]] = None,
+              admit: Optional[Callable[[Dict], bool]] = None,
+              limiter_for: Optional[Callable[[Dict], RateLimiter]] = None) -> Dict:
+    """
+    Send every job of a batch in time order under `limiter`.
+    Jobs later in the window are held until their own scheduled_at.
+    send_one(job) -> {"status": "delivered"|"failed", ...}; exceptions count as failed.
+    Returns {"batch_id", "delivered", "failed", "skipped", "held", "outcomes": [...]}.
+    """
+    sleep = sleep or limiter.sleep
+    steps = iter_batch(batch, send_one, limiter, clock, admit, limiter_for)
+    while True:
+        try:
+            kind, value = next(steps)
+        except StopIteration as done:
+            return done.value
+        if kind in ("due", "rate"):
+            sleep(value)
@@ -0,0 +1,126 @@
+# event_bus.py
+#
+# Process-wide publish/subscribe bus for job events (scheduled / delivered /
+# failed). Scheduler worker threads publish without a Streamlit session
+# context; every dashboard session holds its own Subscription and drains it
+# on each rerun. Each subscriber has a bounded buffer that drops its oldest
+# events when full, so a slow or abandoned session never blocks a send or
+# grows without limit.
+
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+SUBSCRIBER_BUFFER = 50_000
+IDLE_SUBSCRIBER_SECONDS = 3600.0  # full subscribers not drained for this long are dropped
+
+
+class Subscription:
+    def __init__(self, bus: "EventBus", maxlen: int, kinds: Optional[Tuple[str, ...]]):
+        self._bus = bus
+        self.kinds = kinds
+        self._buf: deque = deque(maxlen=maxlen)
+        self.received = 0
+        self.dropped = 0
+        self.last_drained = time.monotonic()
+
+    def _offer(self, event: Tuple[str, Dict]):
+        if self.kinds is not None and event[0] not in self.kinds:
+            return
+        if len(self._buf) == self._buf.maxlen:
+            self.dropped += 1  # deque(maxlen) discards the oldest on append
+        self._buf.append(event)
+        self.received += 1
+
+    def drain(self, max_items: Optional[int] = None) -> List[Tuple[str, Dict]]:
+        """Events since the last drain, oldest first."""
+        self.last_drained = time.monotonic()
+        out = []
+        pop = self._buf.popleft
+        while max_items is None or len(out) < max_items:
+            try:
+                out.append(pop())
+            except IndexError:
+                break
+        return out
+
+    def pending(self) -> int:
+        return len(self._buf)
+
+    @property
+    def registered(self) -> bool:
+        """False once the bus dropped it (abandoned while full); subscribe again to receive events."""
+        return self._bus.is_subscribed(self)
+
+    def close(self):
+        self._bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self, buffer_size: int = SUBSCRIBER_BUFFER, idle_seconds: float = IDLE_SUBSCRIBER_SECONDS):
+        self.buffer_size = buffer_size
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        # copy-on-write tuple of weak references: publish reads it without taking the lock
+        self._subs: Tuple[weakref.ref, ...] = ()
+        self.published = 0
+
+    def subscribe(self, kinds=None, buffer_size: Optional[int] = None) -> Subscription:
+        """New subscriber; kinds limits it to those event kinds. Dropped once garbage-collected."""
+        sub = Subscription(self, buffer_size or self.buffer_size, tuple(kinds) if kinds else None)
+        with self._lock:
+            self._subs = self._subs + (weakref.ref(sub),)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            self._subs = tuple(r for r in self._subs if r() is not None and r() is not sub)
+
+    def is_subscribed(self, sub: Subscription) -> bool:
+        return any(r() is sub for r in self._subs)
+
+    def publish(self, kind: str, payload: Dict):
+        """Never blocks on subscribers; safe from any thread."""
+        event = (kind, payload)
+        stale = False
+        now = None
+        for ref in self._subs:
+            sub = ref()
+            if sub is None:
+                stale = True
+                continue
+            sub._offer(event)
+            if len(sub._buf) == sub._buf.maxlen:  # full: is anyone still reading it?
+                now = now or time.monotonic()
+                stale = stale or now - sub.last_drained > self.idle_seconds
+        self.published += 1
+        if stale:
+            self._prune()
+
+    def _prune(self):
+        """Drop garbage-collected subscribers and full ones nobody drained for idle_seconds."""
+        now = time.monotonic()
+        with self._lock:
+            keep = []
+            for r in self._subs:
+                sub = r()
+                if sub is None:
+                    continue
+                if len(sub._buf) == sub._buf.maxlen and now - sub.last_drained > self.idle_seconds:
+                    continue
+                keep.append(r)
+            self._subs = tuple(keep)
+
+    def stats(self) -> Dict[str, int]:
+        subs = [s for s in (r() for r in self._subs) if s is not None]
+        return {"subscribers": len(subs), "published": self.published,
+                "buffered": sum(s.pending() for s in subs), "dropped": sum(s.dropped for s in subs)}
+
+
+BUS = EventBus()
+
+
+def publish(kind: str, payload: Dict):
+    BUS.publish(kind, payload)
@@ -0,0 +1,310 @@
+# hot_folder.py
+#
+# Watched-directory ingestion: CSV / Excel files dropped into HOT_FOLDER
+# (default uploads/inbox/) are picked up once their size stops changing, parsed
+# with the same ingest.load_table / parse_to_jobs path as the uploader on a
+# background worker, handed to a schedule callback and moved to
+# processed/ or failed/. Large CRM exports never pass through the browser.
+#
+# Like the uploader, nothing is scheduled without the pre-flight check: a file
+# whose check warns (or every file, unless auto-scheduling is on) waits in
+# review/ for confirm() / reject(); files left there by an earlier run are
+# parsed again when the watcher starts. Files already in the folder when it is
+# armed are left alone until adopt_existing().
+
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import ingest
+from ingest_profile import IngestProfile
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+    _HAS_WATCHDOG = True
+except Exception:
+    _HAS_WATCHDOG = False
+
+HOT_FOLDER = os.environ.get("HOT_FOLDER", os.path.join("uploads", "inbox"))
+EXTENSIONS = (".csv", ".xls", ".xlsx", ".xlsm", ".xlsb", ".ods")
+STABLE_SECONDS = 2.0   # size must stay unchanged this long before a file is read
+POLL_SECONDS = 1.0     # stability checks (and the directory scan without watchdog)
+MAX_HISTORY = 50
+_MOVED_SUFFIX = re.compile(r"_\d{8}_\d{6}(?=\.[^.]+$)")  # added by HotFolder._move
+
+
+def _is_candidate(path: str) -> bool:
+    name = os.path.basename(path)
+    return (os.path.isfile(path) and name.lower().endswith(EXTENSIONS)
+            and not name.startswith((".", "~$")))
+
+
+class _Handler(FileSystemEventHandler if _HAS_WATCHDOG else object):
+    def __init__(self, watcher: "HotFolder"):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.notice(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.notice(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.notice(event.dest_path)
+
+
+class HotFolder:
+    """
+    Watches `folder` (not its subfolders). schedule(jobs, source_name) is
+    called on the worker thread and returns the number of messages scheduled;
+    check(jobs) returns the pre-flight summary {"ok": bool, "summary": str}.
+    """
+
+    def __init__(self, folder: str = HOT_FOLDER, logs_dir: str = ingest.LOGS_DIR):
+        self.folder = os.path.abspath(folder)
+        self.processed_dir = os.path.join(self.folder, "processed")
+        self.failed_dir = os.path.join(self.folder, "failed")
+        self.review_dir = os.path.join(self.folder, "review")
+        self.logs_dir = logs_dir
+        self._schedule: Optional[Callable[[List[Dict], str], int]] = None
+        self._check: Optional[Callable[[List[Dict]], Dict]] = None
+        self.auto_schedule = False
+        self._lock = threading.Lock()
+        self._seen: Dict[str, tuple] = {}      # path -> (size, mtime, first seen unchanged at)
+        self._existing: set = set()             # paths present when armed (not ingested unless adopted)
+        self._review: Dict[str, Dict] = {}      # review file -> {"jobs", "rec"} awaiting confirmation
+        self.history: List[Dict] = []           # newest first
+        self._observer = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ---------------- LIFECYCLE ----------------
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def start(self, schedule: Callable[[List[Dict], str], int],
+              check: Optional[Callable[[List[Dict]], Dict]] = None, auto_schedule: bool = False):
+        """
+        (Re)arm the watcher; the callbacks replace any previous ones.
+        auto_schedule: files that pass check() are scheduled without confirmation.
+        """
+        with self._lock:
+            self._schedule, self._check, self.auto_schedule = schedule, check, auto_schedule
+        if self.running:
+            return
+        if self._thread is not None:
+            self._thread.join()  # a stopped worker may still be finishing a file: never run two
+        for d in (self.folder, self.processed_dir, self.failed_dir, self.review_dir):
+            os.makedirs(d, exist_ok=True)
+        with self._lock:
+            self._existing = {os.path.join(self.folder, n) for n in os.listdir(self.folder)
+                              if _is_candidate(os.path.join(self.folder, n))}
+            self._seen.clear()
+        self._stop.clear()
+        if _HAS_WATCHDOG:
+            self._observer = Observer()
+            self._observer.schedule(_Handler(self), self.folder, recursive=False)
+            self._observer.start()
+        self._thread = threading.Thread(target=self._run, name="hot-folder", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop watching; waits for the file being processed (start() waits too if this times out)."""
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def adopt_existing(self) -> int:
+        """Ingest the files that were already in the folder when it was armed."""
+        with self._lock:
+            paths, self._existing = list(self._existing), set()
+        for path in paths:
+            self.notice(path)
+        return len(paths)
+
+    # ---------------- DETECTION ----------------
+    def notice(self, path: str):
+        path = os.path.abspath(path)
+        if os.path.dirname(path) != self.folder or not _is_candidate(path):
+            return
+        with self._lock:
+            if path not in self._existing:
+                self._seen.setdefault(path, (-1, -1.0, 0.0))
+
+    def _ready_files(self) -> List[str]:
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (size, mtime, since) in list(self._seen.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    self._seen.pop(path, None)
+                    continue
+                if (st.st_size, st.st_mtime) != (size, mtime):
+                    self._seen[path] = (st.st_size, st.st_mtime, now)  # still being written
+                elif now - since >= STABLE_SECONDS:
+                    self._seen.pop(path)
+                    ready.append(path)
+        return sorted(ready, key=lambda p: os.path.getmtime(p))
+
+    def _run(self):
+        self._restore_review()
+        while not self._stop.is_set():
+            if not _HAS_WATCHDOG:
+                for name in os.listdir(self.folder):
+                    self.notice(os.path.join(self.folder, name))
+            for path in self._ready_files():
+                if self._stop.is_set():
+                    break
+                self.process(path)
+            self._stop.wait(POLL_SECONDS)
+
+    # ---------------- PROCESSING ----------------
+    def _start_record(self, name: str, path: str) -> Dict:
+        rec = {"file": name, "state": "reading", "size_mb": round(os.path.getsize(path) / 1e6, 1),
+               "rows": 0, "scheduled": 0, "seconds": 0.0, "error": "", "profile": "",
+               "started_at": datetime.now().isoformat(timespec="seconds")}
+        with self._lock:
+            self.history.insert(0, rec)
+            del self.history[MAX_HISTORY:]
+        return rec
+
+    def _parse(self, path: str, name: str, rec: Dict, profile: IngestProfile) -> Dict:
+        """Parse a file and run the pre-flight check: rec gets rows / preflight; returns the verdict."""
+        with open(path, "rb") as f:
+            df = ingest.load_table(f, profile)
+        if df is None or df.empty:
+            raise ValueError("no data rows")
+        rec.update(state="parsing", rows=len(df))
+        jobs, _ = ingest.parse_to_jobs(df, os.path.splitext(name)[0], profile, logs_dir=self.logs_dir)
+        del df
+        with self._lock:
+            check = self._check
+        verdict = check(jobs) if check else {"ok": True, "summary": ""}
+        rec["preflight"] = verdict["summary"]
+        return {**verdict, "jobs": jobs}
+
+    def _restore_review(self):
+        """Re-parse files an earlier run left in review/ so they can be confirmed or rejected again."""
+        with self._lock:
+            known = set(self._review)
+        for review_file in sorted(os.listdir(self.review_dir)):
+            path = os.path.join(self.review_dir, review_file)
+            if review_file in known or not _is_candidate(path) or self._stop.is_set():
+                continue
+            name = _MOVED_SUFFIX.sub("", review_file)  # the upload keeps its list name (revisions)
+            rec = self._start_record(name, path)
+            profile = IngestProfile(name)
+            try:
+                jobs = self._parse(path, name, rec, profile)["jobs"]
+                rec["state"] = "awaiting confirmation"
+                with self._lock:
+                    self._review[review_file] = {"jobs": jobs, "rec": rec, "profile": profile}
+            except Exception as e:
+                rec.update(state="failed", error=f"{type(e).__name__}: {e}")
+                traceback.print_exc()
+                self._move(path, self.failed_dir)
+
+    def process(self, path: str) -> Dict:
+        name = os.path.basename(path)
+        rec = self._start_record(name, path)
+        t0 = time.perf_counter()
+        profile = IngestProfile(name)
+        try:
+            verdict = self._parse(path, name, rec, profile)
+            jobs = verdict["jobs"]
+            with self._lock:
+                auto = self.auto_schedule
+            if not (auto and verdict["ok"]):
+                rec["state"] = "awaiting confirmation"
+                review = self._move(path, self.review_dir)
+                with self._lock:
+                    self._review[os.path.basename(review)] = {"jobs": jobs, "rec": rec, "profile": profile}
+                return rec
+            self._schedule_file(jobs, name, rec, profile)
+            self._move(path, self.processed_dir)
+        except Exception as e:
+            rec.update(state="failed", error=f"{type(e).__name__}: {e}")
+            traceback.print_exc()
+            self._move(path, self.failed_dir)
+        finally:
+            rec["seconds"] = round(time.perf_counter() - t0, 2)
+            try:
+                rec["profile"] = profile.write_json(ingest.PROFILES_DIR)
+            except OSError:
+                pass
+        return rec
+
+    def _schedule_file(self, jobs: List[Dict], name: str, rec: Dict, profile: IngestProfile):
+        rec["state"] = "scheduling"
+        with self._lock:
+            schedule = self._schedule
+        with profile.stage("schedule_job_loop"):
+            rec["scheduled"] = schedule(jobs, name) if schedule else 0
+        rec["state"] = "done"
+
+    # ---------------- REVIEW ----------------
+    def awaiting(self) -> List[Dict]:
+        """Files parked for confirmation: [{"review_file", "file", "rows", "preflight"}]."""
+        with self._lock:
+            return [{"review_file": k, "file": v["rec"]["file"], "rows": len(v["jobs"]),
+                     "preflight": v["rec"].get("preflight", "")} for k, v in self._review.items()]
+
+    def confirm(self, review_file: str) -> int:
+        """Schedule a file awaiting confirmation; returns messages scheduled."""
+        with self._lock:
+            item = self._review.pop(review_file, None)
+        if item is None:
+            return 0
+        rec = item["rec"]
+        path = os.path.join(self.review_dir, review_file)
+        try:
+            self._schedule_file(item["jobs"], rec["file"], rec, item["profile"])
+            self._move(path, self.processed_dir)
+            item["profile"].write_json(ingest.PROFILES_DIR)
+        except Exception as e:
+            rec.update(state="failed", error=f"{type(e).__name__}: {e}")
+            traceback.print_exc()
+            self._move(path, self.failed_dir)
+        return rec["scheduled"]
+
+    def reject(self, review_file: str):
+        with self._lock:
+            item = self._review.pop(review_file, None)
+        if item is not None:
+            item["rec"]["state"] = "rejected"
+            self._move(os.path.join(self.review_dir, review_file), self.failed_dir)
+
+    def _move(self, path: str, dest_dir: str) -> str:
+        base, ext = os.path.splitext(os.path.basename(path))
+        dest = os.path.join(dest_dir, f"{base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}")
+        try:
+            shutil.move(path, dest)
+        except OSError:
+            traceback.print_exc()
+        return dest
+
+    # ---------------- STATUS ----------------
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "folder": self.folder,
+                "running": self.running,
+                "waiting": [os.path.basename(p) for p in self._seen],
+                "existing": sorted(os.path.basename(p) for p in self._existing if os.path.exists(p)),
+                "history": [dict(r) for r in self.history],
+            }
@@ -0,0 +1,420 @@
+# ingest.py
+#
+# Upload parsing shared by the Streamlit UI and background workers:
+# table reading, column detection, phone/datetime normalization and the
+# per-upload conversion log. No Streamlit imports here.
+
+import io
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from dateutil import parser as date_parser
+from dateutil import tz
+from zoneinfo import ZoneInfo
+
+import dispatch
+import message_templates
+import schema_inference
+import suppression
+from ingest_profile import IngestProfile, ensure_profile
+
+# ---------------- DIRECTORIES ----------------
+LOGS_DIR = "logs"
+PROFILES_DIR = os.path.join(LOGS_DIR, "profiles")
+
+# ---------------- TIMEZONE ----------------
+try:
+    IST = ZoneInfo("Asia/Kolkata")
+except Exception:
+    IST = tz.gettz("Asia/Kolkata")
+
+# ---------------- DATA HELPERS ----------------
+DATETIME_CANDS = [
+    "datetime","date_time","date/time","date time","timestamp","scheduled_at","scheduled",
+    "sendtime","send_time","send_date","time","date",
+]
+DATE_CANDS = ["date", "send_date", "day"]
+TIME_CANDS = ["time", "send_time", "hour", "minute"]
+MOBILE_CANDS = ["mobile", "phone", "contact", "number", "mobile_number"]
+MEDIA_CANDS = ["media","media_path","image","url","file","media_url"]
+NAME_CANDS = ["name", "full name", "fullname", "patient"]
+PRIORITY_CANDS = ["priority", "lane", "urgency"]
+
+# header hints per schema_inference role ("date"/"time" alone are not full timestamps)
+ROLE_CANDS = {
+    "phone": MOBILE_CANDS,
+    "name": NAME_CANDS,
+    "media": MEDIA_CANDS,
+    "datetime": [c for c in DATETIME_CANDS if c not in ("date", "time")],
+    "date": DATE_CANDS,
+    "time": TIME_CANDS,
+    "message": message_templates.MESSAGE_CANDS,
+    "priority": PRIORITY_CANDS,
+}
+
+_ISO_RE = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+def try_parse_datetime(val, profile=None):
+    profile = ensure_profile(profile)
+    if val is None or (isinstance(val, float) and pd.isna(val)): return None
+    if isinstance(val, (pd.Timestamp, datetime)):
+        return val.to_pydatetime() if isinstance(val, pd.Timestamp) else val
+    s = str(val).strip()
+    if s == "": return None
+    if _ISO_RE.match(s):
+        try:
+            dt = datetime.fromisoformat(s)
+            profile.count("iso_parse")
+            return dt
+        except ValueError:
+            pass
+    for dayfirst in (True, False):
+        try:
+            dt = date_parser.parse(s, fuzzy=True, dayfirst=dayfirst)
+            profile.count("fuzzy_parse_dayfirst" if dayfirst else "fuzzy_parse_monthfirst")
+            return dt
+        except Exception:
+            continue
+    try:
+        dt = pd.to_datetime(s, errors="coerce", dayfirst=True)
+        if not pd.isna(dt):
+            profile.count("pandas_parse_fallback")
+            return dt.to_pydatetime()
+    except Exception:
+        pass
+    profile.count("datetime_unparseable")
+    return None
+
+def to_ist(dt):
+    if dt is None: return None
+    if dt.tzinfo is None:
+        try: return dt.replace(tzinfo=IST)
+        except Exception: return datetime.fromtimestamp(dt.timestamp(), IST)
+    try: return dt.astimezone(IST)
+    except Exception: return dt.replace(tzinfo=IST)
+
+def normalize_phone(raw):
+    if raw is None: return ""
+    s = str(raw).strip()
+    if re.match(r"^\d+\.?\d*e[+-]?\d+$", s, re.IGNORECASE):
+        s = "{:.0f}".format(float(s))
+    s = re.sub(r"[()\s\-]", "", s)
+    if s.startswith("+"):
+        return re.sub(r"[^\d+]", "", s)
+    digits = re.sub(r"\D", "", s)
+    if len(digits) == 10:
+        return "+91" + digits
+    elif len(digits) > 10:
+        if digits.startswith("0"):
+            digits = digits.lstrip("0")
+        return "+" + digits
+    return digits
+
+def find_col_by_candidates(cols, candidates):
+    cols_l = [c.lower() for c in cols]
+    for cand in candidates:
+        if cand in cols_l:
+            return cols[cols_l.index(cand)]
+    for cand in candidates:
+        for i, c in enumerate(cols_l):
+            if cand in c:
+                return cols[i]
+    return None
+
+def read_any_table(uploaded_file, profile=None):
+    profile = ensure_profile(profile)
+    name = uploaded_file.name.lower()
+    uploaded_file.seek(0)
+    if name.endswith(".csv"):
+        try:
+            return pd.read_csv(uploaded_file, dtype=str)
+        except Exception:
+            profile.count("latin1_retry")
+            uploaded_file.seek(0)
+            return pd.read_csv(uploaded_file, encoding="latin1", low_memory=False, dtype=str)
+    else:
+        try:
+            uploaded_file.seek(0)
+            return pd.read_excel(uploaded_file, engine="openpyxl", dtype=str)
+        except Exception:
+            profile.count("excel_default_engine_retry")
+            try:
+                uploaded_file.seek(0)
+                return pd.read_excel(uploaded_file, dtype=str)
+            except Exception:
+                profile.count("latin1_retry")
+                uploaded_file.seek(0)
+                return pd.read_csv(uploaded_file, encoding="latin1", low_memory=False, dtype=str)
+
+def post_process_mobile_column(df):
+    mobile_col = find_col_by_candidates(df.columns, MOBILE_CANDS)
+    if mobile_col:
+        df[mobile_col] = df[mobile_col].astype(str).str.strip()
+    return df
+
+def parse_row_datetime(row, cols, profile=None, schema=None):
+    """
+    Scheduled time of one row. With a schema (schema_inference) only the
+    columns it mapped are read; without one - or when it found no datetime /
+    date column - the header candidates are tried and, failing those, every
+    cell of the row is scanned.
+    """
+    profile = ensure_profile(profile)
+    if schema is not None and (schema["roles"].get("datetime") or schema["roles"].get("date")):
+        return _schema_row_datetime(row, schema["roles"], profile)
+    dt_col = find_col_by_candidates(cols, DATETIME_CANDS)
+    if dt_col and pd.notna(row.get(dt_col, None)) and str(row.get(dt_col)).strip() != "":
+        dt = try_parse_datetime(row.get(dt_col), profile)
+        if dt:
+            profile.count("datetime_from_datetime_column")
+            return dt
+    date_col = find_col_by_candidates(cols, DATE_CANDS)
+    time_col = find_col_by_candidates(cols, TIME_CANDS)
+    if date_col and time_col and pd.notna(row.get(date_col, None)):
+        combined = f"{row.get(date_col,'')} {row.get(time_col,'')}"
+        dt = try_parse_datetime(combined, profile)
+        if dt:
+            profile.count("datetime_from_date_time_columns")
+            return dt
+    profile.count("datetime_column_scan")
+    for c in cols:
+        v = row.get(c)
+        if pd.isna(v): continue
+        s = str(v)
+        profile.count("column_scan_cells")
+        if re.search(r"\d{1,4}[-/:\s]\d{1,4}", s):
+            dt = try_parse_datetime(s, profile)
+            if dt: return dt
+    return None
+
+def _schema_row_datetime(row, roles, profile):
+    dt_col, date_col, time_col = roles.get("datetime"), roles.get("date"), roles.get("time")
+    if dt_col:
+        v = row.get(dt_col, None)
+        if pd.notna(v) and str(v).strip() != "":
+            dt = try_parse_datetime(v, profile)
+            if dt:
+                profile.count("datetime_from_datetime_column")
+                return dt
+    if date_col and pd.notna(row.get(date_col, None)):
+        combined = str(row.get(date_col, ""))
+        if time_col and pd.notna(row.get(time_col, None)):
+            combined += " " + str(row.get(time_col, ""))
+        dt = try_parse_datetime(combined, profile)
+        if dt:
+            profile.count("datetime_from_date_time_columns")
+            return dt
+    return None
+
+def _original_datetime_value(row, roles):
+    if roles.get("datetime"):
+        v = row.get(roles["datetime"], "")
+        if pd.notna(v) and str(v).strip():
+            return v
+    out = ""
+    if roles.get("date"):
+        out = str(row.get(roles["date"], ""))
+        if roles.get("time"):
+            out += " " + str(row.get(roles["time"], ""))
+    return out
+
+def load_table(uploaded_file, profile=None):
+    """read_any_table + post_process_mobile_column, timed per stage."""
+    profile = ensure_profile(profile)
+    with profile.stage("read_any_table"):
+        df = read_any_table(uploaded_file, profile)
+    if df is None:
+        return df
+    with profile.stage("post_process_mobile_column"):
+        df = post_process_mobile_column(df)
+    profile.rows = len(df)
+    return df
+
+def parse_to_jobs(df, source_filename_base, profile=None, logs_dir=LOGS_DIR, template=None, schema=None,
+                  suppress=True):
+    """
+    Return (jobs, conversion_log_path) for a parsed upload.
+    `template` is a message_templates.CompiledTemplate already validated against
+    df's header; without one the message column (or "Hello {name}") is used.
+    Bodies are rendered here in bulk, or lazily at send time for big uploads.
+    A priority column (urgent / normal / bulk) sets job["lane"] per row; rows
+    without one keep no lane so the upload-level choice applies.
+    Column roles come from `schema` (schema_inference), by default the cached
+    or freshly inferred one for this header.
+    Rows to opted-out numbers are dropped (counted as "suppressed_rows") unless
+    suppress=False; the conversion log keeps them.
+    """
+    profile = ensure_profile(profile)
+    cols = df.columns.tolist()
+    if schema is None:
+        schema = schema_inference.get_schema(df, ROLE_CANDS, profile)
+    roles = schema["roles"]
+    name_col, mobile_col, media_col, priority_col = roles["name"], roles["phone"], roles["media"], roles["priority"]
+
+    if template is None:
+        message_col = roles["message"]
+        template = message_templates.default_template(cols, message_col, name_col)
+    with profile.stage("render_templates"):
+        bodies = template.render_frame(df)
+
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_base = re.sub(r"[^\w\-]", "_", source_filename_base)
+    upload_id = f"{safe_base}_{ts}"
+    parsed_ts = time.time()  # lifecycle ledger: when this upload was parsed
+
+    jobs, conversion_log_rows = [], []
+    seen_phones = {}
+    loop_t0 = time.perf_counter()
+    dt_before = profile.stages.get("parse_row_datetime", {}).get("seconds", 0.0)
+    for pos, (idx, row) in enumerate(df.iterrows()):
+        phone = normalize_phone(row.get(mobile_col, "") if mobile_col else "")
+        name = row.get(name_col, "") if name_col else ""
+        media = row.get(media_col, "") if media_col else ""
+
+        with profile.stage("parse_row_datetime"):
+            raw_dt = parse_row_datetime(row, cols, profile, schema)
+        if raw_dt is None:
+            profile.count("no_datetime_rows")
+            scheduled_at = datetime.now().replace(tzinfo=IST) + timedelta(seconds=5)
+            detected_tz = "NoDateGiven"
+            converted_ist = scheduled_at
+        else:
+            if raw_dt.tzinfo is None:
+                detected_tz = "Assumed IST"
+                scheduled_at = raw_dt.replace(tzinfo=IST)
+            else:
+                detected_tz = str(raw_dt.tzinfo)
+                scheduled_at = to_ist(raw_dt)
+            converted_ist = to_ist(raw_dt) if raw_dt else scheduled_at
+
+        # ids stable across re-exports of the same list: the n-th row for this number, not the
+        # row index, so inserting a row only changes the ids of later rows to the same number
+        seen_phones[phone] = seen_phones.get(phone, 0) + 1
+        jid = f"{phone}|{media}|{converted_ist.timestamp() if converted_ist else datetime.now().timestamp()}" \
+              f"|{seen_phones[phone]}"
+        job = {
+            "job_id": jid,
+            "mobile_number": phone,
+            "name": name,
+            "media_url": media if pd.notna(media) else "",
+            "scheduled_at": scheduled_at,
+            "upload_id": upload_id,
+            "row_key": f"{phone}#{seen_phones[phone]}",
+            "parsed_ts": parsed_ts,
+            "body": bodies[pos],
+        }
+        if priority_col:
+            raw_lane = row.get(priority_col, "")
+            lane = dispatch.normalize_lane(raw_lane if pd.notna(raw_lane) else "")
+            if lane:
+                job["lane"] = lane
+            elif pd.notna(raw_lane) and str(raw_lane).strip():
+                profile.count("unknown_priority_rows")
+        jobs.append(job)
+
+        original_value = _original_datetime_value(row, roles)
+
+        conversion_log_rows.append({
+            "row_index": int(idx),
+            "mobile_number": phone,
+            "original_value": original_value,
+            "detected_timezone": detected_tz,
+            "converted_ist": converted_ist.isoformat() if converted_ist else "",
+        })
+
+    # everything in the row loop except datetime detection (phones, job dicts, log rows)
+    dt_spent = profile.stages.get("parse_row_datetime", {}).get("seconds", 0.0) - dt_before
+    profile.add_time("row_normalization", time.perf_counter() - loop_t0 - dt_spent, calls=len(jobs))
+
+    if suppress:
+        with profile.stage("suppression_check"):
+            jobs, suppressed = suppression.LIST.filter_jobs(jobs)
+        if suppressed:
+            profile.count("suppressed_rows", suppressed)
+
+    with profile.stage("conversion_log_write"):
+        log_filename = f"{safe_base}_log_{ts}.csv"
+        log_path = os.path.join(logs_dir, log_filename)
+        pd.DataFrame(conversion_log_rows).to_csv(log_path, index=False)
+    return jobs, log_path
+
+# ---------------- RECORD INGESTION (API) ----------------
+def record_roles(keys):
+    """Role -> key for dict records (API bodies), matched on field names only."""
+    keys = [str(k) for k in keys]
+    roles, used = {}, set()
+    for role in ("datetime", "date", "time", "phone", "media", "message", "priority", "name"):
+        col = find_col_by_candidates([k for k in keys if k not in used], ROLE_CANDS[role])
+        roles[role] = col
+        if col:
+            used.add(col)
+    return roles
+
+def job_from_record(rec, roles, upload_id, n, profile=None):
+    """
+    One job from a dict record with parse_to_jobs' rules (phone, IST
+    datetime, media, lane). Raises ValueError for rows that cannot be sent.
+    """
+    profile = ensure_profile(profile)
+    raw_phone = rec.get(roles["phone"], "") if roles["phone"] else ""
+    phone = normalize_phone(raw_phone)
+    if not re.fullmatch(r"\+\d{8,15}", phone):
+        raise ValueError(f"invalid phone number {raw_phone!r}")
+    raw_dt = _schema_row_datetime(rec, roles, profile)
+    if raw_dt is None:
+        if roles["datetime"] or roles["date"]:
+            raise ValueError("unparseable date/time")
+        scheduled_at = datetime.now().replace(tzinfo=IST) + timedelta(seconds=5)
+    else:
+        scheduled_at = raw_dt.replace(tzinfo=IST) if raw_dt.tzinfo is None else to_ist(raw_dt)
+    media = str(rec.get(roles["media"], "") or "") if roles["media"] else ""
+    name = str(rec.get(roles["name"], "") or "") if roles["name"] else ""
+    body = str(rec.get(roles["message"], "") or "") if roles["message"] else ""
+    job = {
+        "job_id": f"{phone}|{media}|{scheduled_at.timestamp()}|{upload_id}:{n}",
+        "mobile_number": phone,
+        "name": name,
+        "media_url": media,
+        "scheduled_at": scheduled_at,
+        "upload_id": upload_id,
+        "row_key": f"{phone}#{n}",
+        "parsed_ts": time.time(),
+        "body": sys.intern(body) if body else message_templates.DEFAULT_GREETING.format(name=name),
+    }
+    lane = dispatch.normalize_lane(rec.get(roles["priority"], "")) if roles["priority"] else None
+    if lane:
+        job["lane"] = lane
+    return job
+
+# ---------------- WORKER ENTRY POINT ----------------
+def parse_upload(name, data, template_text="", logs_dir=LOGS_DIR):
+    """
+    Read + parse one uploaded file end to end (module-level so it can run in a
+    worker process). Returns {"name", "jobs", "preview", "profile", "log_path",
+    "schema", "columns"} or {"name", "warning"|"error"}.
+    """
+    profile = IngestProfile(name)
+    try:
+        buf = io.BytesIO(data)
+        buf.name = name
+        df = load_table(buf, profile)
+        if df is None or df.empty:
+            return {"name": name, "warning": f"No data found in {name}."}
+        template = None
+        if template_text:
+            try:
+                template = message_templates.compile_template(template_text, df.columns)
+            except message_templates.TemplateError as e:
+                return {"name": name, "error": f"{name}: {e}"}
+        schema = schema_inference.get_schema(df, ROLE_CANDS, profile)
+        jobs, log_path = parse_to_jobs(df, os.path.splitext(name)[0], profile, logs_dir, template, schema)
+        profile.write_json(PROFILES_DIR)
+    except Exception as e:
+        return {"name": name, "error": f"{name}: {type(e).__name__}: {e}"}
+    return {"name": name, "jobs": jobs, "preview": df.head(10), "profile": profile, "log_path": log_path,
+            "suppressed": profile.counters.get("suppressed_rows", 0),
+            "schema": schema, "columns": [str(c) for c in df.columns]}
@@ -0,0 +1,298 @@
+# ingest_api.py
+#
+# Authenticated bulk ingestion API on the web app (gunicorn web_app:app):
+#
+#   POST /api/v1/batches        body: NDJSON, JSON (array or {"jobs": [...]}) or CSV
+#   GET  /api/v1/batches/<id>   status of an accepted batch
+#
+# Bodies are read as a stream and every record is normalised with the upload
+# rules (ingest.job_from_record). Accepted batches go to a bounded queue; a
+# worker hands them to the scheduler attached from the dashboard, or, when no
+# scheduler lives in this process (plain gunicorn), spools them as CSV into
+# the hot folder for the dashboard process to pick up. Batch status is kept
+# as JSON files next to the spool (batches/), so any worker process can answer
+# a status request, and backpressure counts spooled rows not yet scheduled.
+# A bad NDJSON line rejects only that record.
+#
+#   curl -H "Authorization: Bearer $INGEST_API_TOKEN" -H "Content-Type: application/x-ndjson" \
+#        --data-binary @jobs.ndjson http://localhost:5000/api/v1/batches
+
+import codecs
+import csv
+import hmac
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional
+
+from flask import Blueprint, Response, jsonify, request
+
+import hot_folder
+import ingest
+import job_index
+import metrics
+import suppression
+
+# Comma-separated bearer tokens; the API answers 503 while none is configured.
+API_TOKENS = [t.strip() for t in os.environ.get("INGEST_API_TOKEN", "").split(",") if t.strip()]
+MAX_PENDING = int(os.environ.get("INGEST_MAX_PENDING", 500_000))        # messages
+MAX_BATCH_ROWS = int(os.environ.get("INGEST_MAX_BATCH_ROWS", 200_000))
+MAX_JSON_BYTES = 64 * 1024 * 1024  # plain JSON is not streamable; use NDJSON for bigger batches
+MAX_ERRORS_REPORTED = 100
+MAX_BATCHES_KEPT = 1000
+BATCH_ID_RE = re.compile(r"[0-9a-f]{16}")
+
+api = Blueprint("ingest_api", __name__, url_prefix="/api/v1")
+
+
+# ---------------- QUEUE / STATUS ----------------
+class IngestQueue:
+    """Bounded hand-off between request threads and the scheduling worker."""
+
+    def __init__(self, spool_dir: str = hot_folder.HOT_FOLDER):
+        self.spool_dir = spool_dir
+        self.review_dir = os.path.join(spool_dir, "review")   # HotFolder.review_dir
+        self.status_dir = os.path.join(spool_dir, "batches")  # <batch_id>.json per accepted batch
+        self._q: "queue.Queue" = queue.Queue()
+        self._sink: Optional[Callable[[List[Dict]], int]] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.queued_messages = 0
+        self._recorded = 0
+        self._backlog = (0.0, 0)  # (checked at, count)
+
+    def attach(self, sink: Optional[Callable[[List[Dict]], int]]):
+        """Schedule accepted batches with sink(jobs) -> count (None = spool to the hot folder)."""
+        with self._lock:
+            self._sink = sink
+
+    @property
+    def attached(self) -> bool:
+        return self._sink is not None
+
+    def pending(self) -> int:
+        """
+        Queued in this process, spooled to the hot folder but not scheduled yet
+        (shared by every process), and waiting in this process's scheduler.
+        The last two are refreshed at most every 2 s.
+        """
+        checked, count = self._backlog
+        if time.monotonic() - checked > 2.0:
+            count = job_index.INDEX.state_counts().get(job_index.PENDING, 0) + self._spooled_rows()
+            self._backlog = (time.monotonic(), count)
+        return self.queued_messages + count
+
+    def _spooled_rows(self) -> int:
+        """Rows of API batches still in the hot folder inbox or waiting in its review/."""
+        rows = 0
+        for d in (self.spool_dir, self.review_dir):
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith("api_") and name.endswith(".csv"):
+                    rec = self.status(name[4:20])
+                    rows += rec.get("accepted", 0) if rec else 0
+        return rows
+
+    # ---- batch status (one JSON file per batch, readable by every process) ----
+    def _status_path(self, batch_id: str) -> str:
+        return os.path.join(self.status_dir, f"{batch_id}.json")
+
+    def record(self, batch_id: str, **fields) -> Dict:
+        with self._lock:
+            rec = self.status(batch_id) or {"batch_id": batch_id}
+            rec.update(fields)
+            os.makedirs(self.status_dir, exist_ok=True)
+            path = self._status_path(batch_id)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(rec, f)
+            os.replace(path + ".tmp", path)
+            self._recorded += 1
+            if self._recorded % 100 == 0:
+                self._prune()
+            return rec
+
+    def status(self, batch_id: str) -> Optional[Dict]:
+        if not BATCH_ID_RE.fullmatch(batch_id or ""):
+            return None
+        try:
+            with open(self._status_path(batch_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def recent(self, n: int = 50) -> List[Dict]:
+        """Status of the n most recently updated batches, newest first."""
+        try:
+            paths = [os.path.join(self.status_dir, f) for f in os.listdir(self.status_dir) if f.endswith(".json")]
+        except OSError:
+            return []
+        paths.sort(key=os.path.getmtime, reverse=True)
+        return [r for r in (self.status(os.path.basename(p)[:-5]) for p in paths[:n]) if r]
+
+    def _prune(self):
+        """Keep the newest MAX_BATCHES_KEPT status files."""
+        try:
+            paths = [os.path.join(self.status_dir, n) for n in os.listdir(self.status_dir) if n.endswith(".json")]
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:-MAX_BATCHES_KEPT]:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def submit(self, batch_id: str, jobs: List[Dict]):
+        with self._lock:
+            self.queued_messages += len(jobs)
+        self._ensure_started()
+        self._q.put((batch_id, jobs))
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="ingest-api", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch_id, jobs = self._q.get()
+            try:
+                with self._lock:
+                    sink = self._sink
+                if sink is not None:
+                    self.record(batch_id, state="scheduled", scheduled=sink(jobs))
+                else:
+                    self.record(batch_id, state="spooled", spool_file=self._spool(batch_id, jobs))
+            except Exception as e:
+                self.record(batch_id, state="failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self.queued_messages -= len(jobs)
+                self.record(batch_id, finished_at=datetime.now().isoformat(timespec="seconds"))
+
+    def _spool(self, batch_id: str, jobs: List[Dict]) -> str:
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, f"api_{batch_id}.csv")
+        with open(path + ".part", "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["mobile_number", "name", "media_url", "scheduled_at", "message", "priority"])
+            for j in jobs:
+                w.writerow([j["mobile_number"], j["name"], j["media_url"], j["scheduled_at"].isoformat(),
+                            j["body"], j.get("lane", "")])
+        os.replace(path + ".part", path)  # hot folder ignores *.part
+        return os.path.basename(path)
+
+
+QUEUE = IngestQueue()
+
+
+# ---------------- BODY PARSING ----------------
+def _records(content_type: str, stream) -> Iterator[Dict]:
+    if "csv" in content_type:
+        yield from csv.DictReader(codecs.iterdecode(stream, "utf-8-sig"))
+    elif "ndjson" in content_type or "jsonl" in content_type or "json-seq" in content_type:
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError as e:  # this record only; the caller reports it by line
+                    yield ValueError(f"invalid JSON: {e}")
+    else:
+        body = json.loads(stream.read(MAX_JSON_BYTES + 1) or b"null")
+        items = body.get("jobs") if isinstance(body, dict) else body
+        if not isinstance(items, list):
+            raise ValueError('JSON body must be an array of jobs or {"jobs": [...]}')
+        yield from items
+
+
+def _authorized() -> bool:
+    header = request.headers.get("Authorization", "")
+    token = header[7:].strip() if header.lower().startswith("bearer ") else request.headers.get("X-API-Key", "")
+    return any(hmac.compare_digest(token, t) for t in API_TOKENS)
+
+
+def _error(status: int, message: str, **extra):
+    metrics.INGEST_REQUESTS.inc(status=status)
+    resp = jsonify({"error": message, **extra})
+    resp.status_code = status
+    return resp
+
+
+# ---------------- ROUTES ----------------
+@api.route("/batches", methods=["POST"])
+def create_batch():
+    if not API_TOKENS:
+        return _error(503, "ingestion API disabled (set INGEST_API_TOKEN)")
+    if not _authorized():
+        return _error(401, "missing or invalid API token")
+    if request.content_length and "json" in (request.mimetype or "") and "nd" not in request.mimetype \
+            and request.content_length > MAX_JSON_BYTES:
+        return _error(413, "JSON body too large; send NDJSON instead")
+
+    pending = QUEUE.pending()
+    if pending >= MAX_PENDING:
+        resp = _error(429, "too many pending messages, retry later", pending=pending, limit=MAX_PENDING)
+        resp.headers["Retry-After"] = "30"
+        return resp
+
+    batch_id = secrets.token_hex(8)
+    upload_id = f"api_{batch_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    t0 = time.perf_counter()
+    jobs, errors, rejected = [], [], 0
+    roles_by_keys: Dict[tuple, Dict] = {}
+    try:
+        for n, rec in enumerate(_records(request.mimetype or "", request.stream), 1):
+            if n > MAX_BATCH_ROWS:
+                return _error(413, f"batch larger than {MAX_BATCH_ROWS} rows; split it")
+            try:
+                if isinstance(rec, ValueError):
+                    raise rec
+                if not isinstance(rec, dict):
+                    raise ValueError("record must be an object")
+                keys = tuple(rec)
+                roles = roles_by_keys.get(keys)
+                if roles is None:
+                    roles = roles_by_keys[keys] = ingest.record_roles(keys)
+                jobs.append(ingest.job_from_record(rec, roles, upload_id, n))
+            except ValueError as e:
+                rejected += 1
+                if len(errors) < MAX_ERRORS_REPORTED:
+                    errors.append({"row": n, "error": str(e)})
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:  # malformed body
+        return _error(400, f"could not parse body: {e}")
+
+    jobs, suppressed = suppression.LIST.filter_jobs(jobs)  # opted-out numbers are dropped, not errors
+    metrics.INGEST_ROWS.inc(len(jobs), outcome="accepted")
+    metrics.INGEST_ROWS.inc(rejected, outcome="rejected")
+    metrics.INGEST_ROWS.inc(suppressed, outcome="suppressed")
+    metrics.SUPPRESSED.inc(suppressed, stage="api")
+    rec = QUEUE.record(batch_id, state="queued" if jobs else "empty", upload_id=upload_id,
+                       accepted=len(jobs), rejected=rejected, suppressed=suppressed, errors=errors,
+                       parse_seconds=round(time.perf_counter() - t0, 3),
+                       received_at=datetime.now().isoformat(timespec="seconds"))
+    if jobs:
+        QUEUE.submit(batch_id, jobs)
+    metrics.INGEST_REQUESTS.inc(status=202)
+    resp = jsonify({**rec, "status_url": f"{api.url_prefix}/batches/{batch_id}"})
+    resp.status_code = 202
+    return resp
+
+
+@api.route("/batches/<batch_id>", methods=["GET"])
+def batch_status(batch_id):
+    if not API_TOKENS:
+        return _error(503, "ingestion API disabled (set INGEST_API_TOKEN)")
+    if not _authorized():
+        return _error(401, "missing or invalid API token")
+    rec = QUEUE.status(batch_id)
+    if rec is None:
+        return Response(json.dumps({"error": "unknown batch id"}), status=404, mimetype="application/json")
+    return jsonify(rec)
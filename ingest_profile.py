@@ -0,0 +1,96 @@
+# ingest_profile.py
+#
+# Per-file ingestion profiling: wall time per stage + counters for the
+# fallback paths taken (latin-1 retries, fuzzy datetime parses, column scans).
+
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+
+class IngestProfile:
+    """Collects stage timings and fallback counters for one uploaded file."""
+
+    def __init__(self, source_name: str = ""):
+        self.source_name = source_name
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.stages: Dict[str, Dict[str, float]] = {}  # name -> {"seconds", "calls"}
+        self.counters: Dict[str, int] = {}
+        self.rows = 0
+        self.path: Optional[str] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        s = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+        s["seconds"] += seconds
+        s["calls"] += calls
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(s["seconds"] for s in self.stages.values())
+
+    def to_dict(self) -> Dict:
+        return {
+            "source": self.source_name,
+            "started_at": self.started_at,
+            "rows": self.rows,
+            "total_seconds": round(self.total_seconds, 6),
+            "stages": {k: {"seconds": round(v["seconds"], 6), "calls": int(v["calls"])}
+                       for k, v in self.stages.items()},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def stage_rows(self):
+        """Rows for a table view: stage, seconds, calls, share of total."""
+        total = self.total_seconds or 1.0
+        return [
+            {"stage": k, "seconds": round(v["seconds"], 4), "calls": int(v["calls"]),
+             "share_%": round(100.0 * v["seconds"] / total, 1)}
+            for k, v in self.stages.items()
+        ]
+
+    def write_json(self, out_dir: str) -> str:
+        """Write (or rewrite, once more stages have run) this profile's JSON file."""
+        if self.path is None:
+            os.makedirs(out_dir, exist_ok=True)
+            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+            safe_base = re.sub(r"[^\w\-]", "_", os.path.splitext(self.source_name)[0] or "upload")
+            self.path = os.path.join(out_dir, f"{safe_base}_profile_{ts}.json")
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return self.path
+
+
+class _NullProfile(IngestProfile):
+    """Drop-in profile that records nothing (used when profiling is off)."""
+
+    @contextmanager
+    def stage(self, name: str):
+        yield self
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        pass
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+
+def ensure_profile(profile: Optional[IngestProfile]) -> IngestProfile:
+    return profile if profile is not None else NULL_PROFILE
@@ -0,0 +1,330 @@
+# job_index.py
+#
+# Secondary indexes over scheduled messages (by upload, by mobile number,
+# by scheduled time) so bulk cancel / pause / resume / shift only touch an
+# in-memory state table. The send path asks the index before each send
+# (claim), so a cancelled or paused message is never sent even though its
+# APScheduler job may still fire; dead APScheduler jobs are purged in the
+# background afterwards. Sent and cancelled messages stay queryable (upload
+# revisions diff against them) for TERMINAL_KEEP_SECONDS after their last
+# scheduled time, then are evicted; per-lane depths are kept incrementally.
+
+import bisect
+import heapq
+import itertools
+import os
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import dispatch
+
+PENDING, PAUSED, PARKED, CANCELLED, DISPATCHED = "pending", "paused", "parked", "cancelled", "dispatched"
+ACTIVE_STATES = (PENDING, PAUSED, PARKED)
+TERMINAL_STATES = (DISPATCHED, CANCELLED)
+TERMINAL_KEEP_SECONDS = float(os.environ.get("JOB_INDEX_KEEP_HOURS", 24)) * 3600
+
+
+class JobIndex:
+    def __init__(self, keep_seconds: float = TERMINAL_KEEP_SECONDS, clock: Callable[[], float] = time.time):
+        self._lock = threading.RLock()
+        self.keep_seconds = keep_seconds
+        self.clock = clock
+        self.records: Dict[str, Dict] = {}          # job_id -> {"job", "state", "gen", "aps_id", ...}
+        self.by_upload: Dict[str, Set[str]] = {}
+        self.by_mobile: Dict[str, Set[str]] = {}
+        self._by_time: List = []                    # [(ts, job_id)], sorted lazily
+        self._time_sorted = True
+        self._aps_members: Dict[str, Set[str]] = {}  # APScheduler job id -> job_ids
+        self._aps_owner: Dict[str, object] = {}      # APScheduler job id -> scheduler
+        self._time_stale = 0                         # _by_time entries of evicted records
+        self._states: Dict[str, int] = {}            # state -> records
+        self._lanes: Dict[str, Dict[str, int]] = {}  # lane -> {"pending", "due"}
+        self._future: Dict[str, List] = {}           # lane -> heap [(ts, seq, rec, tok)] of pending, not yet due
+        self._expiry: List = []                      # heap [(evict_at, seq, rec, tok)] of terminal records
+        self._seq = itertools.count()
+
+    # ---------------- STATE BOOKKEEPING ----------------
+    def _set_state(self, rec: Dict, state: Optional[str]):
+        """Every state change goes through here (None = record dropped) so the counters stay exact."""
+        old = rec.get("state")
+        if old is not None:
+            self._states[old] -= 1
+            if old == PENDING:
+                lane = self._lanes[rec["lane"]]
+                lane["pending"] -= 1
+                lane["due"] -= rec["due"]
+        rec["tok"] = next(self._seq)  # invalidates heap entries pushed for the old state
+        rec["state"] = state
+        if state is None:
+            return
+        self._states[state] = self._states.get(state, 0) + 1
+        ts = rec["job"]["scheduled_at"].timestamp()
+        rec["last_ts"] = max(rec.get("last_ts", ts), ts)  # a stale (pre-shift) APScheduler entry may fire until then
+        if state == PENDING:
+            rec["lane"] = dispatch.job_lane(rec["job"])
+            rec["due"] = False
+            self._lanes.setdefault(rec["lane"], {"pending": 0, "due": 0})["pending"] += 1
+            heapq.heappush(self._future.setdefault(rec["lane"], []), (ts, rec["tok"], rec, rec["tok"]))
+        elif state in TERMINAL_STATES:
+            # evicting earlier would let a still-registered APScheduler job through claim() as "unknown"
+            evict_at = max(self.clock(), rec["last_ts"]) + self.keep_seconds
+            heapq.heappush(self._expiry, (evict_at, rec["tok"], rec, rec["tok"]))
+
+    def _advance(self, now: float):
+        """Count pending messages whose time has come as due; drop expired terminal records."""
+        for lane, heap in self._future.items():
+            while heap and heap[0][0] <= now:
+                _ts, _seq, rec, tok = heapq.heappop(heap)
+                if rec["tok"] == tok:
+                    rec["due"] = True
+                    self._lanes[lane]["due"] += 1
+            if len(heap) > 64 and len(heap) > 2 * self._lanes[lane]["pending"]:
+                heap[:] = [e for e in heap if e[2]["tok"] == e[3]]  # mostly superseded entries: compact
+                heapq.heapify(heap)
+        while self._expiry and self._expiry[0][0] <= now:
+            _at, _seq, rec, tok = heapq.heappop(self._expiry)
+            if rec["tok"] == tok and self.records.get(rec["job"]["job_id"]) is rec:
+                self._evict(rec)
+        if self._time_stale > 1024 and self._time_stale > len(self._by_time) // 2:
+            self._by_time = [(ts, jid) for ts, jid in self._by_time if jid in self.records]
+            self._time_stale = 0
+
+    def _evict(self, rec: Dict):
+        job = rec["job"]
+        jid = job["job_id"]
+        self._set_state(rec, None)
+        del self.records[jid]
+        for table, key in ((self.by_upload, job.get("upload_id", "")), (self.by_mobile, job.get("mobile_number", ""))):
+            ids = table.get(key)
+            if ids is not None:
+                ids.discard(jid)
+                if not ids:
+                    del table[key]
+        members = self._aps_members.get(rec["aps_id"])
+        if members is not None:
+            members.discard(jid)
+            if not members:  # every message's time is long past: the APScheduler job has run
+                del self._aps_members[rec["aps_id"]]
+                self._aps_owner.pop(rec["aps_id"], None)
+        self._time_stale += 1
+
+    # ---------------- REGISTRATION ----------------
+    def add(self, jobs: Iterable[Dict], aps_id: str, scheduler=None):
+        """Register messages carried by one APScheduler job (a single or a batch)."""
+        with self._lock:
+            members = self._aps_members.setdefault(aps_id, set())
+            if scheduler is not None:
+                self._aps_owner[aps_id] = scheduler
+            for job in jobs:
+                jid = job["job_id"]
+                rec = self.records.get(jid)
+                if rec is not None:
+                    if rec["aps_id"] != aps_id:
+                        self._aps_members.get(rec["aps_id"], set()).discard(jid)
+                    self._set_state(rec, None)
+                new = self.records[jid] = {"job": job, "gen": job.get("gen", 0), "aps_id": aps_id}
+                if rec is not None:
+                    new["last_ts"] = rec["last_ts"]
+                self._set_state(new, PENDING)
+                members.add(jid)
+                self.by_upload.setdefault(job.get("upload_id", ""), set()).add(jid)
+                self.by_mobile.setdefault(job.get("mobile_number", ""), set()).add(jid)
+                if rec is None or rec["job"]["scheduled_at"] != job["scheduled_at"]:
+                    self._by_time.append((job["scheduled_at"].timestamp(), jid))
+                    self._time_sorted = False
+            self._advance(self.clock())
+
+    # ---------------- SEND-PATH GUARD ----------------
+    def claim(self, job: Dict, hold: bool = False) -> bool:
+        """
+        Called right before a send. True = go ahead (message becomes dispatched).
+        Paused messages are parked for resume(); cancelled or superseded
+        (shifted) generations are skipped. Unknown jobs are always allowed.
+        hold=True: the message is about to be held (provider breaker open) rather
+        than sent - same answer, but it stays pending.
+        """
+        with self._lock:
+            rec = self.records.get(job["job_id"])
+            if rec is None:
+                return True
+            if rec["gen"] != job.get("gen", 0):
+                return False
+            if rec["state"] == PENDING:
+                if not hold:
+                    self._set_state(rec, DISPATCHED)
+                return True
+            if rec["state"] == PAUSED:
+                self._set_state(rec, PARKED)
+            return False
+
+    def release(self, job: Dict):
+        """A claimed message did not go out (held): pending again, so cancel / pause apply to it."""
+        with self._lock:
+            rec = self.records.get(job["job_id"])
+            if rec is not None and rec["gen"] == job.get("gen", 0) and rec["state"] == DISPATCHED:
+                self._set_state(rec, PENDING)
+
+    # ---------------- QUERIES ----------------
+    def select(self, upload_id: Optional[str] = None, mobile: Optional[str] = None,
+               start=None, end=None, states=ACTIVE_STATES) -> Set[str]:
+        """Job ids matching every given filter (datetimes for start/end, inclusive)."""
+        with self._lock:
+            candidates = []
+            if upload_id:
+                candidates.append(self.by_upload.get(upload_id, set()))
+            if mobile:
+                candidates.append(self.by_mobile.get(mobile, set()))
+            if start is not None or end is not None:
+                candidates.append(self._time_range(start, end))
+            if candidates:
+                candidates.sort(key=len)
+                ids = set(candidates[0]).intersection(*candidates[1:])
+            else:
+                ids = set(self.records)
+            return {j for j in ids if self.records[j]["state"] in states}
+
+    def _time_range(self, start, end) -> Set[str]:
+        if not self._time_sorted:
+            self._by_time.sort()
+            self._time_sorted = True
+        lo = 0 if start is None else bisect.bisect_left(self._by_time, (start.timestamp(), ""))
+        hi = len(self._by_time) if end is None else \
+            bisect.bisect_right(self._by_time, (end.timestamp(), "\U0010ffff"))
+        return {jid for ts, jid in self._by_time[lo:hi]
+                if jid in self.records and self.records[jid]["job"]["scheduled_at"].timestamp() == ts}
+
+    def records_for_upload(self, upload_id: str) -> List[Dict]:
+        """[{"job", "state", "gen"}] for every message of an upload, in any state."""
+        with self._lock:
+            return [{"job": self.records[j]["job"], "state": self.records[j]["state"], "gen": self.records[j]["gen"]}
+                    for j in self.by_upload.get(upload_id, ())]
+
+    def upload_ids(self) -> List[str]:
+        with self._lock:
+            return list(self.by_upload)
+
+    def upload_counts(self) -> Dict[str, int]:
+        """Active messages per upload id (for the admin picker)."""
+        with self._lock:
+            out = {}
+            for up, ids in self.by_upload.items():
+                n = sum(1 for j in ids if self.records[j]["state"] in ACTIVE_STATES)
+                if n:
+                    out[up] = n
+            return out
+
+    def lane_depths(self, now: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Per priority lane: "pending" = messages waiting to be sent, "due" = those
+        already past their scheduled time (the lane's backlog).
+        """
+        with self._lock:
+            self._advance(self.clock() if now is None else now)
+            return {lane: dict(d) for lane, d in self._lanes.items() if d["pending"]}
+
+    def state_counts(self) -> Dict[str, int]:
+        with self._lock:
+            self._advance(self.clock())
+            return {state: n for state, n in self._states.items() if n}
+
+    # ---------------- BULK OPERATIONS ----------------
+    def cancel(self, ids: Iterable[str]) -> int:
+        n = 0
+        with self._lock:
+            for jid in ids:
+                rec = self.records.get(jid)
+                if rec and rec["state"] in ACTIVE_STATES:
+                    self._set_state(rec, CANCELLED)
+                    n += 1
+        return n
+
+    def pause(self, ids: Iterable[str]) -> int:
+        n = 0
+        with self._lock:
+            for jid in ids:
+                rec = self.records.get(jid)
+                if rec and rec["state"] == PENDING:
+                    self._set_state(rec, PAUSED)
+                    n += 1
+        return n
+
+    def resume(self, ids: Iterable[str]) -> Tuple[int, List[Dict]]:
+        """
+        Un-pause. Returns (messages resumed, messages to re-dispatch): parked ones
+        (their time passed while paused) and paused ones shifted while paused.
+        """
+        n, redispatch = 0, []
+        with self._lock:
+            for jid in ids:
+                rec = self.records.get(jid)
+                if not rec or rec["state"] not in (PAUSED, PARKED):
+                    continue
+                n += 1
+                if rec["state"] == PARKED or rec.pop("unscheduled", False):
+                    rec["gen"] += 1
+                    redispatch.append({**rec["job"], "gen": rec["gen"]})
+                self._set_state(rec, PENDING)
+        return n, redispatch
+
+    def shift(self, ids: Iterable[str], seconds: float) -> Tuple[int, List[Dict]]:
+        """
+        Move messages by `seconds`. Old APScheduler entries become stale (their
+        generation no longer matches). Paused and parked messages stay so and are
+        re-dispatched at their new time by resume(). Returns (messages moved,
+        pending jobs to schedule).
+        """
+        n, moved = 0, []
+        with self._lock:
+            for jid in ids:
+                rec = self.records.get(jid)
+                if not rec or rec["state"] not in ACTIVE_STATES:
+                    continue
+                n += 1
+                rec["gen"] += 1
+                job = {**rec["job"], "gen": rec["gen"],
+                       "scheduled_at": rec["job"]["scheduled_at"] + timedelta(seconds=seconds)}
+                rec["job"] = job
+                if rec["state"] == PAUSED:
+                    rec["unscheduled"] = True  # its APScheduler entry is stale now
+                else:
+                    moved += [job] if rec["state"] == PENDING else []
+                self._set_state(rec, rec["state"])  # re-queued under the new time
+        return n, moved
+
+    # ---------------- APSCHEDULER CLEANUP ----------------
+    def dead_aps_jobs(self) -> List[str]:
+        """APScheduler job ids whose messages are all cancelled/superseded."""
+        with self._lock:
+            dead = []
+            for aps_id, members in self._aps_members.items():
+                if not any(self.records[j]["state"] in ACTIVE_STATES and self.records[j]["aps_id"] == aps_id
+                           for j in members):
+                    dead.append(aps_id)
+            return dead
+
+    def purge_async(self, on_done: Optional[Callable[[int], None]] = None):
+        """Remove dead APScheduler jobs on a background thread."""
+        def _run():
+            removed = 0
+            for aps_id in self.dead_aps_jobs():
+                with self._lock:
+                    sched = self._aps_owner.pop(aps_id, None)
+                    self._aps_members.pop(aps_id, None)
+                if sched is None:
+                    continue
+                try:
+                    sched.remove_job(aps_id)
+                    removed += 1
+                except Exception:
+                    pass  # already ran or replaced
+            if on_done:
+                on_done(removed)
+
+        t = threading.Thread(target=_run, name="job-index-purge", daemon=True)
+        t.start()
+        return t
+
+
+INDEX = JobIndex()
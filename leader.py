@@ -0,0 +1,216 @@
+# leader.py
+#
+# Leader election between processes sharing the logs/ directory (Streamlit
+# replicas, gunicorn workers): exactly one process - the holder of an
+# exclusive portalocker lock on SCHEDULER_LOCK_PATH - runs the dispatching
+# scheduler. Others keep theirs paused and forward schedule operations to the
+# leader through a file outbox.
+#
+# The OS drops the lock the instant its process dies, and followers retry
+# every POLL_SECONDS, so failover takes about a second. While leading, the
+# lease file is renewed every RENEW_SECONDS (holder, pid, term, timestamp) for
+# status displays, and the lock file itself is re-checked: if it was removed or
+# replaced - so another process could lock a new one - the leader steps down.
+
+import atexit
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import portalocker
+
+LOCK_PATH = os.environ.get("SCHEDULER_LOCK_PATH", os.path.join("logs", "scheduler.lock"))
+OUTBOX_DIR = os.environ.get("SCHEDULER_OUTBOX_DIR", os.path.join("logs", "scheduler_outbox"))
+RENEW_SECONDS = 2.0
+POLL_SECONDS = 1.0
+LEASE_SECONDS = 10.0  # a lease older than this belongs to a hung or dead leader
+
+
+class LeaderElector:
+    """
+    on_elected() / on_demoted() run on the elector thread; on_tick() runs there
+    every POLL_SECONDS while leading (outbox consumption, scheduler wakeups).
+    """
+
+    def __init__(self, lock_path: str = LOCK_PATH, on_elected: Callable[[], None] = lambda: None,
+                 on_demoted: Callable[[], None] = lambda: None, on_tick: Callable[[], None] = lambda: None):
+        self.lock_path = lock_path
+        self.lease_path = lock_path + ".lease"
+        self.on_elected, self.on_demoted, self.on_tick = on_elected, on_demoted, on_tick
+        self.identity = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.is_leader = False
+        self.term = 0
+        self.elected_at: Optional[float] = None
+        self._fh = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------------- LIFECYCLE ----------------
+    def start(self):
+        if self._thread is not None:
+            return self
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        self._try_acquire()  # decide before the first page render when possible
+        self._thread = threading.Thread(target=self._run, name="leader-elector", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.is_leader:
+            self._step_down("shutdown")
+
+    def _run(self):
+        last_renew = 0.0
+        while not self._stop.wait(POLL_SECONDS if not self.is_leader else min(POLL_SECONDS, RENEW_SECONDS)):
+            try:
+                if not self.is_leader:
+                    self._try_acquire()
+                    continue
+                if time.monotonic() - last_renew >= RENEW_SECONDS:
+                    if not self._renew():
+                        continue
+                    last_renew = time.monotonic()
+                self.on_tick()
+            except Exception as e:  # never let the elector die: a dead elector is a stuck leader
+                print(f"[LEADER] {type(e).__name__}: {e}")
+
+    # ---------------- LOCK ----------------
+    def _try_acquire(self):
+        fh = open(self.lock_path, "a+")
+        try:
+            portalocker.lock(fh, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        except portalocker.exceptions.LockException:
+            fh.close()
+            return False
+        self._fh = fh
+        prev = self.lease() or {}
+        self.term = int(prev.get("term", 0)) + 1
+        self.is_leader = True
+        self.elected_at = time.time()
+        self._write_lease()
+        print(f"[LEADER] {self.identity} elected (term {self.term})")
+        self.on_elected()
+        return True
+
+    def _renew(self) -> bool:
+        try:
+            same_file = os.fstat(self._fh.fileno()).st_ino == os.stat(self.lock_path).st_ino
+        except OSError:
+            same_file = False
+        if not same_file:
+            self._step_down("lock file removed or replaced")
+            return False
+        try:
+            self._write_lease()
+        except OSError as e:
+            print(f"[LEADER] lease renewal failed: {e}")  # the lock still guarantees exclusivity
+        return True
+
+    def _step_down(self, reason: str):
+        print(f"[LEADER] {self.identity} stepping down: {reason}")
+        self.is_leader = False
+        try:
+            self.on_demoted()
+        finally:
+            try:
+                portalocker.unlock(self._fh)
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+    def _write_lease(self):
+        tmp = f"{self.lease_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"holder": self.identity, "pid": os.getpid(), "term": self.term,
+                       "elected_at": self.elected_at, "renewed_at": time.time()}, f)
+        os.replace(tmp, self.lease_path)
+
+    # ---------------- STATUS ----------------
+    def lease(self) -> Optional[Dict]:
+        try:
+            with open(self.lease_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def status(self) -> Dict:
+        lease = self.lease() or {}
+        age = time.time() - lease["renewed_at"] if lease.get("renewed_at") else None
+        return {"role": "leader" if self.is_leader else "follower", "me": self.identity,
+                "leader": lease.get("holder"), "term": lease.get("term"),
+                "lease_age_s": None if age is None else round(age, 1),
+                "lease_stale": age is None or age > LEASE_SECONDS}
+
+
+# ---------------- FOLLOWER -> LEADER HANDOFF ----------------
+def _to_json(o):
+    if isinstance(o, datetime):
+        return {"$dt": o.isoformat()}
+    if isinstance(o, (set, frozenset)):
+        return sorted(o)
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def _from_json(d: Dict):
+    return datetime.fromisoformat(d["$dt"]) if set(d) == {"$dt"} else d
+
+
+class Outbox:
+    """
+    Schedule operations written by followers, applied by the leader in order (one
+    JSON file each; datetimes as ISO strings). Operations never carry auth
+    tokens: senders are referenced by account SID and number (sender_pool.config_refs).
+    """
+
+    def __init__(self, directory: str = OUTBOX_DIR):
+        self.directory = directory
+        self.waiting = 0  # entries the last drain() had to leave for later
+
+    def put(self, op: Dict) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.time():017.6f}_{os.getpid()}_{uuid.uuid4().hex[:8]}.json"
+        path = os.path.join(self.directory, name)
+        fd = os.open(path + ".part", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)  # recipients' numbers
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(op, f, default=_to_json, separators=(",", ":"))
+        os.replace(path + ".part", path)
+        return name
+
+    def pending(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "*.json")))
+
+    def drain(self, apply: Callable[[Dict], None], limit: int = 50) -> int:
+        """
+        Apply up to `limit` operations (leader only); each file is removed once applied.
+        apply() raising LookupError (e.g. no credentials here yet for its senders)
+        leaves the entry in place to be retried on a later drain.
+        """
+        done = waiting = 0
+        for path in self.pending()[:limit]:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    op = json.load(f, object_hook=_from_json)
+            except (OSError, ValueError) as e:
+                print(f"[LEADER] unreadable outbox entry {path}: {e}")
+                os.replace(path, path + ".bad")
+                continue
+            try:
+                apply(op)
+            except LookupError as e:
+                if not self.waiting:
+                    print(f"[LEADER] outbox entry waiting: {e}")
+                waiting += 1
+                continue
+            os.remove(path)
+            done += 1
+        self.waiting = waiting
+        return done
@@ -0,0 +1,172 @@
+# lifecycle.py
+#
+# Per-job lifecycle ledger for schedule-drift analysis. Every job that reaches
+# its send path writes one row when it finishes, with the times it was
+# parsed, scheduled, due, dispatched (picked up by a worker) and the Twilio
+# API call start/end, plus its final status.
+#
+# Rows go to logs/lifecycle/YYYY-MM-DD.csv (by due date, IST). To stay compact,
+# `due` is an epoch in seconds and every other stage is an integer offset in
+# milliseconds from it (negative = before due). A flusher thread appends in
+# batches, as status_callbacks does, so the send path never touches disk.
+#
+#   drift = dispatched - due      -> scheduler / worker pool is behind
+#   wait  = api_start - dispatched -> rate limiter / sender pacing
+#   api   = api_end - api_start   -> provider latency
+
+import csv
+import glob
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+import dispatch
+import metrics
+from ingest import IST
+
+LEDGER_DIR = os.path.join("logs", "lifecycle")
+COLUMNS = ("due", "upload_id", "row_key", "lane", "sender", "sid", "status", "code",
+           "parsed", "scheduled", "dispatched", "api_start", "api_end")
+
+
+def _ms(t: Optional[float], due: float):
+    return "" if t is None else int(round((t - due) * 1000))
+
+
+class Ledger:
+    """Buffers lifecycle rows and appends them to one CSV per due date."""
+
+    def __init__(self, directory: str = LEDGER_DIR, max_buffer: int = 200_000,
+                 batch_size: int = 5000, flush_interval: float = 2.0):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._q: "queue.Queue[tuple]" = queue.Queue(maxsize=max_buffer)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+
+    # ---- intake (send path) ----
+    def record(self, job: Dict, status: str, dispatched: Optional[float] = None, res: Optional[Dict] = None):
+        """One finished job; res is the send outcome (api_start / api_end / sid / sender / code)."""
+        res = res or {}
+        due = (job.get("held_from") or job["scheduled_at"]).timestamp()  # a held message keeps its row time
+        lane = dispatch.job_lane(job)
+        if dispatched is not None:
+            metrics.DISPATCH_DRIFT.observe(max(0.0, dispatched - due), lane=lane)
+        row = (round(due, 3), job.get("upload_id", ""), job.get("row_key", ""), lane,
+               res.get("sender", ""), res.get("sid", ""), status, res.get("code") or "",
+               _ms(job.get("parsed_ts"), due), _ms(job.get("scheduled_ts"), due), _ms(dispatched, due),
+               _ms(res.get("api_start"), due), _ms(res.get("api_end"), due))
+        self._ensure_started()
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def pending(self) -> int:
+        return self._q.qsize()
+
+    # ---- batching ----
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="lifecycle-ledger", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write_or_drop(batch)
+
+    def flush(self) -> bool:
+        """Write what is buffered now; False if the write failed (rows dropped, as the flusher does)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        return self._write_or_drop(batch) if batch else True
+
+    def _write_or_drop(self, batch: List[tuple]) -> bool:
+        try:
+            self._write(batch)
+            return True
+        except Exception as e:  # disk full, permissions...: lose this batch, keep the caller alive
+            self.dropped += len(batch)
+            print(f"[LEDGER] {type(e).__name__}: {e} ({len(batch)} rows dropped)")
+            return False
+
+    def _write(self, batch: List[tuple]):
+        by_day: Dict[str, List[tuple]] = {}
+        for row in batch:
+            by_day.setdefault(datetime.fromtimestamp(row[0], IST).strftime("%Y-%m-%d"), []).append(row)
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for day, rows in by_day.items():
+                path = os.path.join(self.directory, f"{day}.csv")
+                new = not os.path.exists(path)
+                with open(path, "a", encoding="utf-8", newline="") as f:
+                    w = csv.writer(f)
+                    if new:
+                        w.writerow(COLUMNS)
+                    w.writerows(rows)
+        self.written += len(batch)
+
+    # ---- queries (dashboard) ----
+    def load(self, start: date, end: Optional[date] = None) -> pd.DataFrame:
+        """Rows due between start and end (inclusive days) with absolute stage times and derived delays."""
+        self.flush()
+        end = end or start
+        frames = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.csv"))):
+            day = os.path.splitext(os.path.basename(path))[0]
+            if start.isoformat() <= day <= end.isoformat():
+                frames.append(pd.read_csv(path, dtype={"upload_id": str, "row_key": str, "lane": str,
+                                                       "sender": str, "sid": str, "status": str}))
+        if not frames:
+            return pd.DataFrame(columns=list(COLUMNS) + ["drift_s", "wait_s", "api_s", "end_to_end_s", "due_at"])
+        df = pd.concat(frames, ignore_index=True)
+        df["drift_s"] = df["dispatched"] / 1000.0
+        df["wait_s"] = (df["api_start"] - df["dispatched"]) / 1000.0
+        df["api_s"] = (df["api_end"] - df["api_start"]) / 1000.0
+        df["end_to_end_s"] = df["api_end"] / 1000.0
+        df["due_at"] = pd.to_datetime(df["due"], unit="s", utc=True)
+        return df
+
+
+LEDGER = Ledger()
+
+
+def drift_percentiles(df: pd.DataFrame, by: str = "hour") -> pd.DataFrame:
+    """p50 / p95 / p99 of drift, limiter wait and API time grouped by due hour or by upload_id."""
+    sent = df[df["status"] != "skipped"]
+    if sent.empty:
+        return pd.DataFrame()
+    key = sent["due_at"].dt.tz_convert(IST).dt.floor("h").dt.tz_localize(None) if by == "hour" else sent[by]
+    g = sent.groupby(key)
+    out = pd.DataFrame({"messages": g.size(), "failed": g["status"].apply(lambda s: int((s == "failed").sum()))})
+    for col in ("drift_s", "wait_s", "api_s", "end_to_end_s"):
+        for q in (0.5, 0.95, 0.99):
+            out[f"{col[:-2]}_p{int(q * 100)}_s"] = g[col].quantile(q).round(2)
+    out.index.name = by
+    return out
+
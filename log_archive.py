@@ -0,0 +1,432 @@
+# log_archive.py
+#
+# Rotated, compressed message-log archive with a per-recipient index.
+#
+# Streams ("delivery": every delivered / failed send from the event bus;
+# "conversion": rows of old <upload>_log_<ts>.csv files swept out of logs/)
+# are appended as JSON lines to an active segment under logs/archive/<stream>/.
+# A segment is closed when it passes SEGMENT_MAX_MB or SEGMENT_MAX_AGE and is
+# recompressed as a series of independent zstd frames (~BLOCK_BYTES of lines
+# each). index.sqlite3 maps (phone, day) -> (segment, frame offset), so the
+# history of one number reads and decompresses only the frames that mention
+# it. The active segment is indexed in memory.
+#
+# Several processes may share the archive (Streamlit replicas): each writes
+# its own active segments, named after the process (<stream>_<ts>.<owner>.jsonl),
+# and holds owners/<owner>.lock while alive. Segments of an owner whose lock is
+# free (it exited or crashed) are compressed by whoever recovers next, under
+# recover.lock so two processes never handle the same segment.
+
+import glob
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional
+
+import portalocker
+
+import event_bus
+import message_templates
+from ingest import IST
+
+try:
+    import zstandard as zstd
+    _HAS_ZSTD = True
+except Exception:  # archive still works, with zlib frames
+    _HAS_ZSTD = False
+
+ARCHIVE_DIR = os.path.join("logs", "archive")
+STREAMS = ("delivery", "conversion")
+SEGMENT_MAX_BYTES = int(float(os.environ.get("LOG_SEGMENT_MAX_MB", 16)) * 1024 * 1024)
+SEGMENT_MAX_AGE_SECONDS = float(os.environ.get("LOG_SEGMENT_MAX_AGE_HOURS", 24)) * 3600
+BLOCK_BYTES = 64 * 1024           # uncompressed bytes per frame = unit of random access
+CONVERSION_KEEP_SECONDS = float(os.environ.get("CONVERSION_LOG_KEEP_DAYS", 7)) * 86400
+_CONVERSION_LOG_RE = re.compile(r"_log_(\d{8}_\d{6})\.csv$")
+_OWNER_RE = re.compile(r"\.([A-Za-z0-9-]+)\.jsonl$")  # segments written before per-process names have none
+RECOVER_SECONDS = 600.0  # how often a running writer looks for segments left by dead processes
+ACTIVE_LOGS: set = set()  # conversion logs dashboard sessions of this process still show / append to
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, stream TEXT, path TEXT UNIQUE, codec TEXT,
+                                     first_ts REAL, last_ts REAL, records INTEGER, bytes INTEGER);
+CREATE TABLE IF NOT EXISTS frames (segment INTEGER, frame INTEGER, offset INTEGER, length INTEGER,
+                                   PRIMARY KEY (segment, frame)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (phone INTEGER, day INTEGER, segment INTEGER, frame INTEGER,
+                                    PRIMARY KEY (phone, day, segment, frame)) WITHOUT ROWID;
+"""
+
+
+def _phone_key(phone) -> Optional[int]:
+    """Digits of an E.164 number as an integer: a much smaller index key than the text."""
+    digits = str(phone or "").lstrip("+")
+    return int(digits) if digits.isdigit() and len(digits) <= 18 else None
+
+
+def _day(ts: float) -> int:
+    return int(datetime.fromtimestamp(ts, IST).strftime("%Y%m%d"))
+
+
+def _compress(data: bytes) -> bytes:
+    return zstd.ZstdCompressor(level=9).compress(data) if _HAS_ZSTD else zlib.compress(data, 9)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if not _HAS_ZSTD:
+            raise RuntimeError("zstandard is required to read this archive segment (pip install zstandard)")
+        return zstd.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class _Active:
+    """Open, uncompressed segment of one stream, indexed in memory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, "ab+")
+        m = re.search(r"_(\d{8}_\d{6})_\d+(?:\.[A-Za-z0-9-]+)?\.jsonl$", path)
+        self.opened = datetime.strptime(m.group(1), "%Y%m%d_%H%M%S").replace(tzinfo=IST).timestamp() \
+            if m else time.time()
+        self.offsets: Dict[str, List[int]] = {}
+        self.f.seek(0)
+        pos = 0
+        for line in self.f:  # rebuild the index of a segment left open by a previous process
+            try:
+                self._note(json.loads(line), pos)
+            except ValueError:
+                pass
+            pos += len(line)
+        self.f.seek(0, os.SEEK_END)
+
+    def _note(self, rec: Dict, pos: int):
+        self.offsets.setdefault(str(rec.get("mobile_number", "")), []).append(pos)
+
+    def write(self, recs: Iterable[Dict]):
+        pos = self.f.tell()
+        chunks = []
+        for rec in recs:
+            line = (json.dumps(rec, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+            self._note(rec, pos)
+            chunks.append(line)
+            pos += len(line)
+        self.f.write(b"".join(chunks))
+        self.f.flush()
+
+    def read(self, phone: str) -> List[Dict]:
+        out = []
+        for pos in self.offsets.get(phone, ()):
+            self.f.seek(pos)
+            out.append(json.loads(self.f.readline()))
+        self.f.seek(0, os.SEEK_END)
+        return out
+
+
+class LogArchive:
+    def __init__(self, directory: str = ARCHIVE_DIR, max_bytes: int = SEGMENT_MAX_BYTES,
+                 max_age_seconds: float = SEGMENT_MAX_AGE_SECONDS, block_bytes: int = BLOCK_BYTES):
+        self.directory = directory
+        self.max_bytes, self.max_age_seconds, self.block_bytes = max_bytes, max_age_seconds, block_bytes
+        self.index_path = os.path.join(directory, "index.sqlite3")
+        self._lock = threading.RLock()
+        self._active: Dict[str, _Active] = {}
+        os.makedirs(os.path.join(directory, "owners"), exist_ok=True)
+        host = re.sub(r"[^A-Za-z0-9-]", "-", socket.gethostname())
+        self.owner = f"{host}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        # held for the life of the process: its segments are not recovered while this is locked
+        self._owner_lock = open(self._owner_lock_path(self.owner), "a+")
+        portalocker.lock(self._owner_lock, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        with self._db() as db:
+            db.executescript(_SCHEMA)
+        self.recover()
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with db:  # commit / rollback
+                yield db
+        finally:
+            db.close()
+
+    # ---------------- WRITING ----------------
+    def append(self, stream: str, records: List[Dict]):
+        """records need "mobile_number" and "ts" (epoch seconds)."""
+        if stream not in STREAMS:
+            raise ValueError(f"unknown log stream {stream!r}")
+        if not records:
+            return
+        with self._lock:
+            active = self._active.get(stream)
+            if active is None:
+                active = self._open(stream)
+            active.write(records)
+            if active.f.tell() >= self.max_bytes:
+                self._close_segment(stream)
+
+    def rotate_due(self):
+        """Close segments that are past their age limit (called periodically)."""
+        with self._lock:
+            for stream, active in list(self._active.items()):
+                if active.f.tell() and time.time() - active.opened >= self.max_age_seconds:
+                    self._close_segment(stream)
+
+    def rotate_all(self):
+        with self._lock:
+            for stream in list(self._active):
+                self._close_segment(stream)
+
+    def _open(self, stream: str) -> _Active:
+        d = os.path.join(self.directory, stream)
+        os.makedirs(d, exist_ok=True)
+        path = os.path.join(d, f"{stream}_{datetime.now(IST).strftime('%Y%m%d_%H%M%S_%f')}.{self.owner}.jsonl")
+        self._active[stream] = active = _Active(path)
+        return active
+
+    def _close_segment(self, stream: str):
+        active = self._active.pop(stream, None)
+        if active is None:
+            return
+        active.f.close()
+        if os.path.getsize(active.path):
+            self._compress_segment(stream, active.path)
+        os.remove(active.path)
+
+    def _compress_segment(self, stream: str, plain_path: str):
+        out_path = plain_path[:-len(".jsonl")] + ".jsonl.zst"
+        codec = "zstd" if _HAS_ZSTD else "zlib"
+        frames, entries = [], set()
+        first_ts = last_ts = None
+        records = 0
+        with open(plain_path, "rb") as src, open(out_path + ".part", "wb") as dst:
+            block, size = [], 0
+
+            def flush_block():
+                nonlocal block, size
+                if not block:
+                    return
+                data = _compress(b"".join(block))
+                frames.append((len(frames), dst.tell(), len(data)))
+                dst.write(data)
+                block, size = [], 0
+
+            for line in src:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if size + len(line) > self.block_bytes:
+                    flush_block()
+                ts = float(rec.get("ts") or 0)
+                first_ts = ts if first_ts is None else min(first_ts, ts)
+                last_ts = ts if last_ts is None else max(last_ts, ts)
+                key = _phone_key(rec.get("mobile_number"))
+                if key is not None:
+                    entries.add((key, _day(ts), len(frames)))
+                block.append(line)
+                size += len(line)
+                records += 1
+            flush_block()
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(out_path + ".part", out_path)
+        rel = os.path.relpath(out_path, self.directory)
+        with self._db() as db:
+            cur = db.execute("INSERT OR REPLACE INTO segments (stream, path, codec, first_ts, last_ts, records, bytes) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (stream, rel, codec, first_ts, last_ts, records, os.path.getsize(out_path)))
+            seg = cur.lastrowid
+            db.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)", [(seg, *f) for f in frames])
+            db.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?)",
+                           [(phone, day, seg, frame) for phone, day, frame in entries])
+
+    # ---------------- RECOVERY ----------------
+    def _owner_lock_path(self, owner: str) -> str:
+        return os.path.join(self.directory, "owners", f"{owner}.lock")
+
+    def _owner_gone(self, owner: Optional[str]) -> bool:
+        """True when no live process holds the owner's lock (None = a segment from before owners)."""
+        if owner == self.owner:
+            return False
+        if owner is None:
+            return True
+        path = self._owner_lock_path(owner)
+        try:
+            fh = open(path, "a+")
+        except OSError:
+            return True
+        try:
+            portalocker.lock(fh, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        except portalocker.exceptions.LockException:
+            fh.close()
+            return False
+        portalocker.unlock(fh)
+        fh.close()
+        return True
+
+    def recover(self) -> int:
+        """Compress segments left by processes that are gone; returns segments recovered."""
+        recovered = 0
+        with portalocker.Lock(os.path.join(self.directory, "recover.lock"), timeout=60), self._lock:
+            with self._db() as db:
+                known = {r[0] for r in db.execute("SELECT path FROM segments")}
+            gone = set()
+            for stream in STREAMS:
+                d = os.path.join(self.directory, stream)
+                for path in sorted(glob.glob(os.path.join(d, "*.jsonl"))):
+                    m = _OWNER_RE.search(os.path.basename(path))
+                    owner = m.group(1) if m else None
+                    if not self._owner_gone(owner):
+                        continue
+                    gone.add(owner)
+                    part = path[:-len(".jsonl")] + ".jsonl.zst.part"
+                    if os.path.exists(part):
+                        os.remove(part)
+                    zst = path + ".zst"
+                    if os.path.exists(zst) and os.path.relpath(zst, self.directory) not in known:
+                        os.remove(zst)  # compressed but never indexed
+                    if os.path.exists(zst):
+                        os.remove(path)  # indexed, only the plain copy was left
+                    else:
+                        if os.path.getsize(path):
+                            self._compress_segment(stream, path)
+                        os.remove(path)
+                    recovered += 1
+            for owner in gone - {None}:
+                try:
+                    os.remove(self._owner_lock_path(owner))
+                except OSError:
+                    pass
+        return recovered
+
+    # ---------------- LOOKUP ----------------
+    def lookup(self, phone: str, start: Optional[date] = None, end: Optional[date] = None,
+               stream: Optional[str] = None) -> List[Dict]:
+        """Every archived record for one number (optionally within [start, end] days), oldest first."""
+        lo = int(start.strftime("%Y%m%d")) if start else 0
+        hi = int(end.strftime("%Y%m%d")) if end else 99999999
+        sql = ("SELECT DISTINCT s.stream, s.path, s.codec, f.offset, f.length FROM entries e "
+               "JOIN segments s ON s.id = e.segment JOIN frames f ON f.segment = e.segment AND f.frame = e.frame "
+               "WHERE e.phone = ? AND e.day BETWEEN ? AND ?")
+        key = _phone_key(phone)
+        if key is None:
+            return []
+        args = [key, lo, hi]
+        if stream:
+            sql += " AND s.stream = ?"
+            args.append(stream)
+        with self._db() as db:
+            hits = db.execute(sql + " ORDER BY s.id, f.offset", args).fetchall()
+
+        out = []
+        needle = phone.encode("utf-8")
+        for st_name, rel, codec, offset, length in hits:
+            with open(os.path.join(self.directory, rel), "rb") as f:
+                f.seek(offset)
+                data = _decompress(f.read(length), codec)
+            for line in data.splitlines():
+                if needle in line:
+                    rec = json.loads(line)
+                    if rec.get("mobile_number") == phone:
+                        out.append({"stream": st_name, **rec})
+        with self._lock:
+            for st_name, active in self._active.items():
+                if stream is None or st_name == stream:
+                    out += [{"stream": st_name, **r} for r in active.read(phone)]
+        out = [r for r in out if lo <= _day(float(r.get("ts") or 0)) <= hi]
+        out.sort(key=lambda r: float(r.get("ts") or 0))
+        return out
+
+    def stats(self) -> List[Dict]:
+        with self._db() as db:
+            rows = db.execute("SELECT stream, COUNT(*), SUM(records), SUM(bytes) FROM segments GROUP BY stream").fetchall()
+        out = {r[0]: {"stream": r[0], "segments": r[1], "records": r[2] or 0, "compressed_mb": round((r[3] or 0) / 1e6, 2)}
+               for r in rows}
+        with self._lock:
+            for st_name, active in self._active.items():
+                s = out.setdefault(st_name, {"stream": st_name, "segments": 0, "records": 0, "compressed_mb": 0.0})
+                s["active_mb"] = round(active.f.tell() / 1e6, 2)
+        return list(out.values())
+
+    # ---------------- CONVERSION LOGS ----------------
+    def sweep_conversion_logs(self, logs_dir: str = "logs", keep_seconds: float = CONVERSION_KEEP_SECONDS,
+                              exclude: Iterable[str] = ()) -> int:
+        """Move <upload>_log_<ts>.csv files older than keep_seconds into the archive. Returns files moved."""
+        import csv
+
+        exclude = {os.path.abspath(p) for p in exclude if p}
+        moved = 0
+        # one sweeper at a time across processes, or two could archive the same file
+        with portalocker.Lock(os.path.join(self.directory, "sweep.lock"), timeout=60):
+            for path in sorted(glob.glob(os.path.join(logs_dir, "*_log_*.csv"))):
+                m = _CONVERSION_LOG_RE.search(os.path.basename(path))
+                if not m or os.path.abspath(path) in exclude:
+                    continue
+                try:
+                    if time.time() - os.path.getmtime(path) < keep_seconds:
+                        continue
+                    ts = datetime.strptime(m.group(1), "%Y%m%d_%H%M%S").replace(tzinfo=IST).timestamp()
+                    name = os.path.basename(path)
+                    with open(path, newline="", encoding="utf-8") as f:
+                        recs = [{**row, "ts": ts, "file": name} for row in csv.DictReader(f)]
+                except FileNotFoundError:  # cleared from the dashboard meanwhile
+                    continue
+                self.append("conversion", recs)
+                os.remove(path)
+                moved += 1
+        return moved
+
+
+# ---------------- BACKGROUND WRITER ----------------
+def _body(job: Dict) -> str:
+    try:
+        return message_templates.body_for(job)
+    except message_templates.TemplateError:
+        return ""  # the failure itself is logged with the error
+
+
+def delivery_record(kind: str, job: Dict) -> Dict:
+    rec = {"ts": time.time(), "status": kind, "mobile_number": job.get("mobile_number", ""),
+           "name": job.get("name", ""), "upload_id": job.get("upload_id", ""), "job_id": job.get("job_id", ""),
+           "scheduled_at": job.get("scheduled_at"), "media_url": job.get("media_url", ""),
+           "body": _body(job), "sid": job.get("sid", ""), "sender": job.get("sender", "")}
+    if job.get("error"):
+        rec["error"] = job["error"]
+    return rec
+
+
+class ArchiveWriter:
+    """Subscribes to delivered / failed events and appends them to the archive; rotates and sweeps."""
+
+    def __init__(self, archive: LogArchive, logs_dir: str = "logs", interval: float = 1.0,
+                 exclude_logs=lambda: ()):
+        self.archive, self.logs_dir, self.interval = archive, logs_dir, interval
+        self.exclude_logs = exclude_logs
+        self.sub = event_bus.BUS.subscribe(("delivered", "failed"), buffer_size=200_000)
+        self._thread = threading.Thread(target=self._run, name="log-archive", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_sweep = last_recover = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            try:
+                events = self.sub.drain()
+                if events:
+                    self.archive.append("delivery", [delivery_record(k, p) for k, p in events])
+                self.archive.rotate_due()
+                if time.monotonic() - last_recover > RECOVER_SECONDS:
+                    last_recover = time.monotonic()
+                    self.archive.recover()
+                if time.monotonic() - last_sweep > 600:
+                    last_sweep = time.monotonic()
+                    self.archive.sweep_conversion_logs(self.logs_dir, exclude=self.exclude_logs())
+            except Exception as e:  # keep archiving; a bad record must not stop the thread
+                print(f"[ARCHIVE] {type(e).__name__}: {e}")
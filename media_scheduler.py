@@ -1,14 +1,12 @@
+import multiprocessing
 import os
 import re
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from queue import Queue
 
 import pandas as pd
 import streamlit as st
-from dateutil import parser as date_parser
-from dateutil import tz
-from zoneinfo import ZoneInfo
 from apscheduler.schedulers.background import BackgroundScheduler
 from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
@@ -21,6 +19,29 @@ st.set_page_config(page_title="WhatsApp Messaging Scheduler", layout="wide", ini
 
 # ---------------- APP IMPORTS (helpers) ----------------
 from secrets_helper import init_secrets_and_auth
+import metrics
+import ingest
+import dispatch
+import message_templates
+import simulator
+import capacity
+import status_callbacks
+import job_index
+import report_export
+import sender_pool
+import hot_folder
+import upload_diff
+import coalesce
+import lifecycle
+import event_bus
+import log_archive
+import schema_inference
+import ingest_api
+import leader
+import media_store
+import suppression
+import circuit_breaker
+from web_app import app, serve_in_background  # noqa: F401  (app kept importable as media_scheduler:app)
 
 def get_user_roles(username: str, roles_map: dict) -> set[str]:
     """Return the role(s) for a username."""
@@ -107,18 +128,15 @@ LOGS_DIR = "logs"
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
 
-# ---------------- TIMEZONE ----------------
-try:
-    IST = ZoneInfo("Asia/Kolkata")
-except Exception:
-    IST = tz.gettz("Asia/Kolkata")
-
 # ---------------- SESSION STATE ----------------
 st.session_state.setdefault("logs", {"scheduled": [], "delivered": [], "failed": []})
 st.session_state.setdefault("scheduled_ids", set())
 st.session_state.setdefault("active_upload_log", None)
 st.session_state.setdefault("refresh_toggle", False)
-st.session_state.setdefault("log_queue", Queue())
+if "log_sub" not in st.session_state or not st.session_state.log_sub.registered:
+    # this session's view of job events published by scheduler threads (any session's jobs);
+    # re-subscribes when the bus dropped an abandoned, full subscription
+    st.session_state.log_sub = event_bus.BUS.subscribe(("scheduled", "delivered", "failed"))
 st.session_state.setdefault("DELAY_SECONDS", 1.0)
 
 # === Twilio (frontend) helpers ===
@@ -129,6 +147,20 @@ def get_twilio_creds_from_state():
     wa_from = (st.session_state.get("FROM_WHATSAPP") or "").strip()
     return sid, tok, wa_from
 
+def get_sender_configs():
+    """((sid, token, from), ...) for the primary sender plus the pooled extra numbers."""
+    sid, tok, wa_from = get_twilio_creds_from_state()
+    configs = [(sid, tok, wa_from)]
+    try:
+        extra = sender_pool.parse_pool_config(st.session_state.get("SENDER_POOL", ""), sid, tok)
+    except ValueError:
+        extra = []  # reported by validate_twilio_creds_frontend
+    for cfg in extra:
+        if cfg[2] not in {c[2] for c in configs}:
+            configs.append(cfg)
+    sender_pool.remember_credentials(configs)  # lets this process apply forwarded jobs if it leads
+    return tuple(configs)
+
 def validate_twilio_creds_frontend():
     """Validate Twilio creds the user typed in the UI (no secrets.toml)."""
     sid, tok, wa_from = get_twilio_creds_from_state()
@@ -139,6 +171,13 @@ def validate_twilio_creds_frontend():
         errors.append("Twilio Auth Token looks too short")
     if not wa_from or not wa_from.startswith("whatsapp:"):
         errors.append("From WhatsApp number must start with 'whatsapp:' (e.g., whatsapp:+1415XXXXXXX)")
+    try:
+        for x_sid, x_tok, _ in sender_pool.parse_pool_config(st.session_state.get("SENDER_POOL", ""), sid, tok):
+            if not re.fullmatch(r"AC[0-9a-fA-F]{32}", x_sid) or len(x_tok) < 20:
+                errors.append("Sender pool: invalid Account SID / Auth Token on an extra sender line")
+                break
+    except ValueError as e:
+        errors.append(f"Sender pool: {e}")
     return errors
 
 # ---------------- CSS ----------------
@@ -163,206 +202,95 @@ div[data-testid="stFileUploadDropzone"] button:hover, div[data-testid="stFileUpl
 
 # ---------------- LOGGING HELPERS ----------------
 def enqueue_log(kind, payload):
-    try:
-        st.session_state.log_queue.put((kind, payload), block=False)
-    except Exception:
-        pass
+    """Publish a job event to every dashboard session; safe (and non-blocking) from worker threads."""
+    event_bus.publish(kind, payload)
 
-def drain_log_queue(max_items=10000):
-    moved = 0
-    while moved < max_items:
-        try:
-            kind, payload = st.session_state.log_queue.get_nowait()
-        except Exception:
-            break
-        kind = kind if kind in ("scheduled", "delivered", "failed") else "scheduled"
+def drain_events(max_items=10000):
+    for kind, payload in st.session_state.log_sub.drain(max_items):
         st.session_state.logs.setdefault(kind, []).append(payload)
-        moved += 1
 
 # ---------------- DATA HELPERS ----------------
-DATETIME_CANDS = [
-    "datetime","date_time","date/time","date time","timestamp","scheduled_at","scheduled",
-    "sendtime","send_time","send_date","time","date",
-]
-DATE_CANDS = ["date", "send_date", "day"]
-TIME_CANDS = ["time", "send_time", "hour", "minute"]
-MOBILE_CANDS = ["mobile", "phone", "contact", "number", "mobile_number"]
-MEDIA_CANDS = ["media","media_path","image","url","file","media_url"]
-
-def try_parse_datetime(val):
-    if val is None or (isinstance(val, float) and pd.isna(val)): return None
-    if isinstance(val, (pd.Timestamp, datetime)):
-        return val.to_pydatetime() if isinstance(val, pd.Timestamp) else val
-    s = str(val).strip()
-    if s == "": return None
-    for dayfirst in (True, False):
-        try:
-            return date_parser.parse(s, fuzzy=True, dayfirst=dayfirst)
-        except Exception:
-            continue
-    try:
-        dt = pd.to_datetime(s, errors="coerce", dayfirst=True)
-        if not pd.isna(dt): return dt.to_pydatetime()
-    except Exception:
-        pass
-    return None
-
-def to_ist(dt):
-    if dt is None: return None
-    if dt.tzinfo is None:
-        try: return dt.replace(tzinfo=IST)
-        except Exception: return datetime.fromtimestamp(dt.timestamp(), IST)
-    try: return dt.astimezone(IST)
-    except Exception: return dt.replace(tzinfo=IST)
-
-def normalize_phone(raw):
-    if raw is None: return ""
-    s = str(raw).strip()
-    if re.match(r"^\d+\.?\d*e[+-]?\d+$", s, re.IGNORECASE):
-        s = "{:.0f}".format(float(s))
-    s = re.sub(r"[()\s\-]", "", s)
-    if s.startswith("+"):
-        return re.sub(r"[^\d+]", "", s)
-    digits = re.sub(r"\D", "", s)
-    if len(digits) == 10:
-        return "+91" + digits
-    elif len(digits) > 10:
-        if digits.startswith("0"):
-            digits = digits.lstrip("0")
-        return "+" + digits
-    return digits
-
-def find_col_by_candidates(cols, candidates):
-    cols_l = [c.lower() for c in cols]
-    for cand in candidates:
-        if cand in cols_l:
-            return cols[cols_l.index(cand)]
-    for cand in candidates:
-        for i, c in enumerate(cols_l):
-            if cand in c:
-                return cols[i]
-    return None
-
-def read_any_table(uploaded_file):
-    name = uploaded_file.name.lower()
-    uploaded_file.seek(0)
-    if name.endswith(".csv"):
-        try:
-            return pd.read_csv(uploaded_file, dtype=str)
-        except Exception:
-            uploaded_file.seek(0)
-            return pd.read_csv(uploaded_file, encoding="latin1", low_memory=False, dtype=str)
-    else:
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+
+@st.cache_resource
+def get_parse_pool():
+    """Worker processes for upload parsing; spawned so they do not inherit scheduler/web threads."""
+    return ProcessPoolExecutor(max_workers=max(1, PARSE_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+
+def parse_uploads(items, template_text):
+    """
+    Parse [(name, bytes), ...] with ingest.parse_upload; yields (position, result)
+    as each file finishes. Several files go to the process pool, one runs inline.
+    """
+    if len(items) == 1 or PARSE_WORKERS <= 1:
+        for i, (name, data) in enumerate(items):
+            yield i, ingest.parse_upload(name, data, template_text, LOGS_DIR)
+        return
+    pool = get_parse_pool()
+    futures = {pool.submit(ingest.parse_upload, name, data, template_text, LOGS_DIR): i
+               for i, (name, data) in enumerate(items)}
+    for fut in as_completed(futures):
+        i = futures[fut]
         try:
-            uploaded_file.seek(0)
-            return pd.read_excel(uploaded_file, engine="openpyxl", dtype=str)
-        except Exception:
-            try:
-                uploaded_file.seek(0)
-                return pd.read_excel(uploaded_file, dtype=str)
-            except Exception:
-                uploaded_file.seek(0)
-                return pd.read_csv(uploaded_file, encoding="latin1", low_memory=False, dtype=str)
-
-def post_process_mobile_column(df):
-    mobile_col = find_col_by_candidates(df.columns, MOBILE_CANDS)
-    if mobile_col:
-        df[mobile_col] = df[mobile_col].astype(str).str.strip()
-    return df
-
-def parse_row_datetime(row, cols):
-    dt_col = find_col_by_candidates(cols, DATETIME_CANDS)
-    if dt_col and pd.notna(row.get(dt_col, None)) and str(row.get(dt_col)).strip() != "":
-        dt = try_parse_datetime(row.get(dt_col))
-        if dt: return dt
-    date_col = find_col_by_candidates(cols, DATE_CANDS)
-    time_col = find_col_by_candidates(cols, TIME_CANDS)
-    if date_col and time_col and pd.notna(row.get(date_col, None)):
-        combined = f"{row.get(date_col,'')} {row.get(time_col,'')}"
-        dt = try_parse_datetime(combined)
-        if dt: return dt
-    for c in cols:
-        v = row.get(c)
-        if pd.isna(v): continue
-        s = str(v)
-        if re.search(r"\d{1,4}[-/:\s]\d{1,4}", s):
-            dt = try_parse_datetime(s)
-            if dt: return dt
-    return None
-
-def parse_to_jobs(df, source_filename_base):
-    cols = df.columns.tolist()
-    name_col = find_col_by_candidates(cols, ["name", "full name", "fullname", "patient"])
-    mobile_col = find_col_by_candidates(cols, MOBILE_CANDS)
-    media_col = find_col_by_candidates(cols, MEDIA_CANDS)
-
-    jobs, conversion_log_rows = [], []
-    for idx, row in df.iterrows():
-        phone = normalize_phone(row.get(mobile_col, "") if mobile_col else "")
-        name = row.get(name_col, "") if name_col else ""
-        media = row.get(media_col, "") if media_col else ""
-
-        raw_dt = parse_row_datetime(row, cols)
-        if raw_dt is None:
-            scheduled_at = datetime.now().replace(tzinfo=IST) + timedelta(seconds=5)
-            detected_tz = "NoDateGiven"
-            converted_ist = scheduled_at
-        else:
-            if raw_dt.tzinfo is None:
-                detected_tz = "Assumed IST"
-                scheduled_at = raw_dt.replace(tzinfo=IST)
-            else:
-                detected_tz = str(raw_dt.tzinfo)
-                scheduled_at = to_ist(raw_dt)
-            converted_ist = to_ist(raw_dt) if raw_dt else scheduled_at
-
-        jid = f"{phone}|{media}|{converted_ist.timestamp() if converted_ist else datetime.now().timestamp()}|{idx}"
-        jobs.append({
-            "job_id": jid,
-            "mobile_number": phone,
-            "name": name,
-            "media_url": media if pd.notna(media) else "",
-            "scheduled_at": scheduled_at,
-        })
-
-        dt_src_col = find_col_by_candidates(cols, DATETIME_CANDS)
-        original_value = row.get(dt_src_col, "") if dt_src_col else ""
-        if not original_value:
-            date_col = find_col_by_candidates(cols, DATE_CANDS)
-            time_col = find_col_by_candidates(cols, TIME_CANDS)
-            if date_col:
-                original_value = str(row.get(date_col, ""))
-            if date_col and time_col:
-                original_value += " " + str(row.get(time_col, ""))
-
-        conversion_log_rows.append({
-            "row_index": int(idx),
-            "mobile_number": phone,
-            "original_value": original_value,
-            "detected_timezone": detected_tz,
-            "converted_ist": converted_ist.isoformat() if converted_ist else "",
-        })
-
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_base = re.sub(r"[^\w\-]", "_", source_filename_base)
-    log_filename = f"{safe_base}_log_{ts}.csv"
-    log_path = os.path.join(LOGS_DIR, log_filename)
-    pd.DataFrame(conversion_log_rows).to_csv(log_path, index=False)
-    st.session_state.active_upload_log = log_path
-    return jobs
+            res = fut.result()
+        except Exception as e:  # worker died (e.g. out of memory)
+            res = {"name": items[i][0], "error": f"{items[i][0]}: parse worker failed: {e}"}
+        yield i, res
 
 # ---------------- SCHEDULER SINGLETON ----------------
-if "scheduler" not in st.session_state:
-    st.session_state.scheduler = BackgroundScheduler()
-    st.session_state.scheduler.start()
-scheduler = st.session_state.scheduler
+@st.cache_resource
+def get_scheduler():
+    """
+    One scheduler per process (one thread pool per priority lane, normal = "default").
+    It starts paused and only dispatches while this process is the leader (see get_elector).
+    """
+    sched = BackgroundScheduler(executors=dispatch.lane_executors())
+    sched.start(paused=True)
+    metrics.start_snapshots()  # the deployed web app's /metrics reads these while we lead
+    return metrics.instrument_scheduler(sched)
+
+scheduler = get_scheduler()
+
+# ---------------- METRICS ENDPOINT ----------------
+@st.cache_resource
+def start_web_app():
+    """Serve web_app (/metrics) from this process once; WEB_APP_PORT=0 disables it."""
+    port = int(os.environ.get("WEB_APP_PORT", 5000))
+    if port <= 0:
+        return None
+    try:
+        return serve_in_background(port)
+    except OSError as e:
+        print(f"web_app not started on port {port}: {e}")
+        return None
+
+start_web_app()
+
+# ---------------- HOT FOLDER ----------------
+@st.cache_resource
+def get_hot_folder():
+    """One watcher per process over HOT_FOLDER (default uploads/inbox/); armed from the admin panel."""
+    return hot_folder.HotFolder(hot_folder.HOT_FOLDER, LOGS_DIR)
+
+# ---------------- LOG ARCHIVE ----------------
+@st.cache_resource
+def get_log_archive():
+    """Process-wide archive of delivery events and old conversion logs (see log_archive.py)."""
+    archive = log_archive.LogArchive()
+    log_archive.ArchiveWriter(archive, LOGS_DIR, exclude_logs=lambda: tuple(log_archive.ACTIVE_LOGS))
+    return archive
+
+log_archive_store = get_log_archive()
 
 # ---------------- SENDER ----------------
-def send_whatsapp_message(job, creds, delay_seconds=1.0):
-    sid, tok, wa_from = creds
+def _send_one(client, wa_from, job, may_retry=False):
+    """
+    One Twilio call for one job; logs + metrics, returns an outcome dict.
+    may_retry: a throttling error will be retried on another sender, so it is not logged as failed.
+    The outcome carries api_start / api_end (epoch seconds) for the lifecycle ledger.
+    """
+    timing = {}
     try:
-        client = Client(sid, tok)
-
         to_number = job["mobile_number"]
         if to_number and not to_number.startswith("whatsapp:"):
             to_number = f"whatsapp:{to_number}"
@@ -373,46 +301,325 @@ def send_whatsapp_message(job, creds, delay_seconds=1.0):
             if re.match(r"^https?://", media, re.IGNORECASE):
                 media_arg = [media]
             else:
-                raise ValueError(f"media_url must be a public http(s) URL: {media}")
+                raise ValueError(f"media_url must be a public http(s) URL or a file under "
+                                 f"{', '.join(media_store.SOURCE_DIRS)}/: {media}")
 
-        msg = client.messages.create(
-            from_=wa_from,
-            to=to_number,
-            body=f"Hello {job.get('name', '')}",
-            media_url=media_arg,
-        )
+        started = time.perf_counter()
+        timing["api_start"] = time.time()
+        try:
+            extra = {"status_callback": status_callbacks.STATUS_CALLBACK_URL} \
+                if status_callbacks.STATUS_CALLBACK_URL else {}
+            msg = client.messages.create(
+                from_=wa_from,
+                to=to_number,
+                body=message_templates.body_for(job),
+                media_url=media_arg,
+                **extra,
+            )
+        except TwilioRestException as e:
+            timing["api_end"] = time.time()
+            metrics.record_send(started, "failed", e.code or e.status)
+            raise
+        timing["api_end"] = time.time()
+        metrics.record_send(started, "delivered")
 
-        enqueue_log("delivered", {**job, "sid": getattr(msg, "sid", "")})
+        sid = getattr(msg, "sid", "")
+        enqueue_log("delivered", {**job, "sid": sid, "sender": wa_from})
+        return {"status": "delivered", "sid": sid, **timing}
 
     except TwilioRestException as e:
-        enqueue_log("failed", {**job, "error": str(e)})
+        code = e.code or e.status
+        # throttled (retried on another sender) or systemic (held by the pool): not a failed message
+        if not (may_retry and code in sender_pool.THROTTLE_CODES) and not circuit_breaker.is_systemic(code):
+            enqueue_log("failed", {**job, "error": str(e), "sender": wa_from})
+        return {"status": "failed", "error": str(e), "code": code, **timing}
     except Exception as e:
-        enqueue_log("failed", {**job, "error": str(e)})
+        code = "transport" if circuit_breaker.is_transport_error(e) else None  # network errors trip the breaker
+        if code is None:
+            metrics.SENDS.inc(outcome="failed")
+            enqueue_log("failed", {**job, "error": str(e)})
+        return {"status": "failed", "error": str(e), "code": code, **timing}
+
+def _log_unlogged(job, res):
+    """A throttled send that found no other sender after all (see SenderPool.send) still counts as failed."""
+    if res.get("unlogged"):
+        enqueue_log("failed", {**job, "error": res.get("error", ""), "sender": res.get("sender", "")})
+
+def _pool(creds, delay_seconds):
+    if isinstance(creds[0], str):  # (sid, token, from) of jobs scheduled before sender pools
+        creds = (tuple(creds),)
+    return sender_pool.get_pool(creds, delay_seconds)
+
+def _opted_out(job):
+    """Send-time opt-out check (the number may have opted out after scheduling); cancels the message."""
+    if not suppression.LIST.contains(job["mobile_number"]):
+        return False
+    job_index.INDEX.cancel([job["job_id"]])
+    metrics.SUPPRESSED.inc(stage="send")
+    return True
+
+@metrics.busy_worker(lambda job, *_: dispatch.job_lane(job))
+def send_whatsapp_message(job, creds, delay_seconds=1.0):
+    dispatched = time.time()
+    pool = _pool(creds, delay_seconds)
+    if _opted_out(job):
+        lifecycle.LEDGER.record(job, "suppressed", dispatched)
+        return {"status": "skipped", "reason": "opted out"}
+    if not job_index.INDEX.claim(job):  # cancelled, paused or shifted since scheduling
+        lifecycle.LEDGER.record(job, "skipped", dispatched)
+        return {"status": "skipped"}
+    pool.limiter_for(job).acquire()
+    res = pool.send(job, lambda sender, retry: _send_one(sender.client, sender.from_number, job, retry))
+    if res.get("status") == "held":
+        job_index.INDEX.release(job)
+        _hold([job], pool, creds, delay_seconds)
+        return res
+    _log_unlogged(job, res)
+    lifecycle.LEDGER.record(job, res.get("status", "failed"), dispatched, res)
+    return res
+
+def _hold(jobs, pool, creds, delay_seconds):
+    """
+    Provider breaker open: put messages back on the scheduler (see circuit_breaker) instead of failing them.
+    Only messages still pending at their generation are re-queued; ones cancelled,
+    paused or shifted while held stay as the user left them.
+    """
+    jobs = [j for j in jobs if job_index.INDEX.claim(j, hold=True)]
+    given_up = [j for j in jobs if j.get("holds", 0) >= circuit_breaker.MAX_HOLDS]
+    for j in given_up:
+        job_index.INDEX.claim(j)
+        metrics.SENDS.inc(outcome="failed")
+        enqueue_log("failed", {**j, "error": f"held {j['holds']} times by the provider breaker; giving up"})
+        lifecycle.LEDGER.record(j, "failed", time.time())
+    jobs = [j for j in jobs if j.get("holds", 0) < circuit_breaker.MAX_HOLDS]
+    if not jobs:
+        return
+    held = []
+    for j in jobs:
+        due = j.get("held_from") or j["scheduled_at"]  # the original due time, however often it was held
+        held.append({**j, "held_from": due, "holds": j.get("holds", 0) + 1,
+                     "scheduled_at": datetime.fromtimestamp(pool.hold_until(due.timestamp()), ingest.IST)})
+    ctx = {"scheduler": scheduler, "creds": creds, "delay": delay_seconds, "window": dispatch.BATCH_WINDOW_SECONDS,
+           "coalesce": 0, "scheduled_ids": set(), "on_leader": True, "requeue": True}
+    schedule_jobs(held, force=True, ctx=ctx)
+    for br in {s.breaker for s in pool.senders if s.breaker.state != circuit_breaker.CLOSED}:
+        br.held += len(jobs)
+    metrics.MESSAGES_HELD.inc(len(jobs))
+
+@metrics.busy_worker(lambda batch, *_: batch.get("lane", dispatch.DEFAULT_LANE))
+def send_whatsapp_batch(batch, creds, delay_seconds=1.0):
+    """Fan a coalesced batch out over the sender pool; each recipient's sender paces its sends."""
+    pool = _pool(creds, delay_seconds)
+    lane = batch.get("lane", dispatch.DEFAULT_LANE)
+
+    dispatched = {}  # job_id -> when the batch worker reached it (before the rate-limit wait)
+    held, flushed = [], [time.monotonic()]
+
+    def flush_held(force=False):
+        # re-queued in chunks so a long fan-out does not keep held messages until it ends
+        if held and (force or len(held) >= 500 or time.monotonic() - flushed[0] > 5.0):
+            _hold(held[:], pool, creds, delay_seconds)
+            held.clear()
+            flushed[0] = time.monotonic()
+
+    def admit(j):
+        dispatched[j["job_id"]] = time.time()
+        if _opted_out(j):
+            lifecycle.LEDGER.record(j, "suppressed", dispatched.pop(j["job_id"]))
+            return False
+        blocked = pool.blocked()  # every account's breaker is open: no rate token, hold instead
+        if job_index.INDEX.claim(j, hold=blocked):
+            if not blocked:
+                return True
+            dispatched.pop(j["job_id"])
+            held.append(j)
+            flush_held()
+            return False
+        lifecycle.LEDGER.record(j, "skipped", dispatched.pop(j["job_id"]))
+        return False
+
+    def send_one(j):
+        j = {**j, "batch_id": batch["batch_id"]}
+        res = pool.send(j, lambda sender, retry: _send_one(sender.client, sender.from_number, j, retry))
+        if res.get("status") == "held":
+            dispatched.pop(j["job_id"], None)
+            job_index.INDEX.release(j)
+            held.append({k: v for k, v in j.items() if k != "batch_id"})
+            flush_held()
+            return res
+        _log_unlogged(j, res)
+        lifecycle.LEDGER.record(j, res.get("status", "failed"), dispatched.pop(j["job_id"], None), res)
+        return res
+
+    try:
+        result = dispatch.run_batch(
+            batch, send_one, pool.senders[0].limiter(lane),  # clock/sleep source; tokens come from limiter_for
+            admit=admit, limiter_for=pool.limiter_for)
     finally:
-        try:
-            d = float(delay_seconds or 0)
-            if d > 0:
-                time.sleep(d)
-        except Exception:
-            pass
-
-def schedule_job(job):
-    if job["job_id"] in st.session_state.scheduled_ids:
+        flush_held(force=True)
+    return result  # per-message outcomes are already in the ledger, the event log and metrics
+
+def _hot_preflight(jobs, ctx):
+    """Pre-flight verdict for a hot-folder file (the uploader shows the same numbers as a chart)."""
+    pf = capacity.preflight(jobs, ctx["delay"], senders=len(ctx["creds"]))
+    summary = (f"{pf['messages']} messages, last predicted at {pf['predicted_finish']} "
+               f"(max lateness {pf['max_lateness_s'] / 60:.1f} min)")
+    if pf["overloaded"]:
+        summary += f"; {len(pf['overloaded'])} time window(s) exceed capacity"
+    return {"ok": not pf["overloaded"], "summary": summary}
+
+def schedule_context():
+    """Session settings used for scheduling, captured so worker threads (hot folder) can schedule too."""
+    return {
+        "scheduler": scheduler,
+        "creds": get_sender_configs(),
+        "delay": float(st.session_state.get("DELAY_SECONDS", 1.0)),
+        "window": float(st.session_state.get("BATCH_WINDOW_SECONDS", dispatch.BATCH_WINDOW_SECONDS)),
+        "coalesce": float(st.session_state.get("COALESCE_WINDOW_SECONDS", coalesce.COALESCE_WINDOW_SECONDS)),
+        "scheduled_ids": st.session_state.scheduled_ids,
+    }
+
+def schedule_job(job, force=False, ctx=None):
+    ctx = ctx or schedule_context()
+    if job["job_id"] in ctx["scheduled_ids"] and not force:
         return
-    creds = get_twilio_creds_from_state()
-    delay = float(st.session_state.get("DELAY_SECONDS", 1.0))
+    scheduler = ctx["scheduler"]
 
     scheduler.add_job(
         send_whatsapp_message,
         "date",
         run_date=job["scheduled_at"],
-        args=[job, creds, delay],
+        args=[job, ctx["creds"], ctx["delay"]],
         id=job["job_id"],
         replace_existing=True,
-        misfire_grace_time=60,
+        misfire_grace_time=dispatch.MISFIRE_GRACE_SECONDS,
+        executor=dispatch.lane_executor(dispatch.job_lane(job)),
     )
-    st.session_state.scheduled_ids.add(job["job_id"])
-    enqueue_log("scheduled", job)
+    job_index.INDEX.add([job], job["job_id"], scheduler)
+    ctx["scheduled_ids"].add(job["job_id"])
+    if not ctx.get("requeue"):
+        metrics.SCHEDULED.inc()
+        enqueue_log("scheduled", job)
+
+def schedule_jobs(jobs, force=False, lane=None, ctx=None):
+    """
+    Schedule an upload; rows sharing a batch window (and lane) become one fan-out job.
+    force=True re-schedules already known job ids (bulk shift / resume).
+    lane is the upload-level priority for rows without their own priority column value.
+    ctx (see schedule_context) is required off the Streamlit script thread.
+    New rows to the same recipient are coalesced first (ctx["coalesce"] window);
+    forced re-schedules keep their rows as they are.
+    Returns the number of messages (sends) scheduled.
+    Outside the leader process the rows are forwarded to the leader instead
+    (counted before coalescing, which the leader applies).
+    ctx["requeue"] (messages held by the provider breaker) skips the "scheduled" events and counters.
+    """
+    ctx = ctx or schedule_context()
+    scheduler = ctx["scheduler"]
+    if not force:
+        jobs = [j for j in jobs if j["job_id"] not in ctx["scheduled_ids"]]
+    if lane:
+        jobs = [j if j.get("lane") else {**j, "lane": lane} for j in jobs]
+    if not jobs:
+        return 0
+    jobs, media_errors = media_store.STORE.resolve_jobs(jobs)  # local files -> stored, public URLs
+    for media, err in media_errors.items():
+        print(f"[MEDIA] {err}")
+    if not ctx.get("on_leader") and not elector.is_leader:
+        leader.Outbox().put({"jobs": jobs, "force": force, "senders": sender_pool.config_refs(ctx["creds"]),
+                             "delay": ctx["delay"], "window": ctx["window"], "coalesce": ctx["coalesce"]})
+        for job in jobs:
+            ctx["scheduled_ids"].add(job["job_id"])
+            enqueue_log("scheduled", {**job, "forwarded": True})
+        return len(jobs)
+    if not force and ctx.get("coalesce"):
+        jobs, report = coalesce.coalesce_recipients(jobs, ctx["coalesce"])
+        metrics.COALESCED.inc(report["duplicates_dropped"], kind="duplicate")
+        metrics.COALESCED.inc(report["merged"], kind="merged")
+        for job in jobs:
+            ctx["scheduled_ids"].update(coalesce.absorbed_ids(job))
+    scheduled_ts = time.time()
+    for job in jobs:
+        job["scheduled_ts"] = scheduled_ts  # lifecycle ledger
+    if not ctx.get("requeue"):
+        upload_diff.remember(jobs)  # revisions after a restart / eviction still know what was sent
+
+    for batch in dispatch.plan_batches(jobs, ctx["window"]):
+        if len(batch["jobs"]) == 1:
+            schedule_job(batch["jobs"][0], force=force, ctx=ctx)
+            continue
+        # one APScheduler job per batch; never dropped as a misfire, however late it starts
+        scheduler.add_job(
+            send_whatsapp_batch,
+            "date",
+            run_date=batch["scheduled_at"],
+            args=[batch, ctx["creds"], ctx["delay"]],
+            id=batch["batch_id"],
+            replace_existing=True,
+            misfire_grace_time=None,
+            coalesce=False,
+            executor=dispatch.lane_executor(batch["lane"]),
+        )
+        job_index.INDEX.add(batch["jobs"], batch["batch_id"], scheduler)
+        if not ctx.get("requeue"):
+            metrics.record_batch(len(batch["jobs"]))
+        for job in batch["jobs"]:
+            ctx["scheduled_ids"].add(job["job_id"])
+            if not ctx.get("requeue"):
+                enqueue_log("scheduled", {**job, "batch_id": batch["batch_id"]})
+    return len(jobs)
+
+# ---------------- LEADER ELECTION ----------------
+def _apply_forwarded(op, scheduled_ids):
+    """
+    Schedule an operation another process put in the outbox (runs on the leader).
+    LookupError (left in the outbox) until this process knows the senders' tokens.
+    """
+    creds = sender_pool.resolve_refs(op["senders"])
+    ctx = {"scheduler": scheduler, "creds": creds, "delay": op["delay"], "window": op["window"],
+           "coalesce": op["coalesce"], "scheduled_ids": scheduled_ids, "on_leader": True}
+    now = datetime.now(ingest.IST) + timedelta(seconds=2)  # overdue after a failover: send now, not misfire
+    schedule_jobs([{**j, "scheduled_at": max(j["scheduled_at"], now)} for j in op["jobs"]],
+                  force=op["force"], ctx=ctx)
+
+def _hand_off(sched):
+    """Stop dispatching and forward every job not yet started to whichever process leads next."""
+    sched.pause()
+    groups = {}
+    for aps_job in sched.get_jobs():
+        payload, creds, delay = aps_job.args
+        groups.setdefault((creds, delay), []).extend(payload.get("jobs", [payload]))
+        sched.remove_job(aps_job.id)
+    box = leader.Outbox()
+    for (creds, delay), jobs in groups.items():
+        box.put({"jobs": jobs, "force": True, "senders": sender_pool.config_refs(creds), "delay": delay,
+                 "window": dispatch.BATCH_WINDOW_SECONDS, "coalesce": 0})
+    if groups:
+        print(f"[LEADER] handed off {sum(len(j) for j in groups.values())} pending messages")
+
+@st.cache_resource
+def get_elector():
+    """
+    Process-wide leader elector: only the lock holder's scheduler runs; the others
+    forward schedule_jobs() calls through the outbox, which the leader drains.
+    """
+    scheduled_ids = set()  # dedupe for forwarded rows, shared by everything the leader applies
+    box = leader.Outbox()
+
+    def elected():
+        metrics.SCHEDULER_LEADER.set(1)
+        scheduler.resume()
+
+    def demoted():
+        metrics.SCHEDULER_LEADER.set(0)
+        _hand_off(scheduler)
+
+    def tick():
+        box.drain(lambda op: _apply_forwarded(op, scheduled_ids))
+
+    return leader.LeaderElector(on_elected=elected, on_demoted=demoted, on_tick=tick).start()
+
+elector = get_elector()
 
 # ---------------- SIDEBAR ----------------
 with st.sidebar:
@@ -428,42 +635,98 @@ with st.sidebar:
             value=float(st.session_state.get("DELAY_SECONDS", 1.0)),
             step=0.5,
         )
+        st.session_state.BATCH_WINDOW_SECONDS = st.number_input(
+            "Batch window (seconds)",
+            min_value=0, max_value=3600,
+            value=int(st.session_state.get("BATCH_WINDOW_SECONDS", dispatch.BATCH_WINDOW_SECONDS)),
+            step=15,
+            help="Rows due within the same window are sent as one batch job (0 = identical times only).",
+        )
+        st.session_state.COALESCE_WINDOW_SECONDS = st.number_input(
+            "Coalesce per recipient (seconds)",
+            min_value=0, max_value=86400,
+            value=int(st.session_state.get("COALESCE_WINDOW_SECONDS", coalesce.COALESCE_WINDOW_SECONDS)),
+            step=60,
+            help="Rows to the same number within this window become one message: exact duplicates "
+                 "are dropped, texts are joined (one media attachment per message). 0 = off.",
+        )
+        depths = job_index.INDEX.lane_depths()
+        st.caption("Priority lanes (pending / overdue): " + ", ".join(
+            f"{lane} {depths.get(lane, {}).get('pending', 0)} / {depths.get(lane, {}).get('due', 0)}"
+            for lane in dispatch.LANES))
+        pools = [p for p in sender_pool.active_pools() if len(p.senders) > 1]
+        if pools:
+            st.caption("Sender pool")
+            st.dataframe(pd.DataFrame([r for p in pools for r in p.stats()]), hide_index=True,
+                         use_container_width=True)
+        breakers = circuit_breaker.all_breakers()
+        if breakers:
+            st.caption("Provider circuit breakers (per Twilio account)")
+            st.dataframe(pd.DataFrame([{**b.stats(), "account": f"…{b.name[-6:]}"} for b in breakers]),
+                         hide_index=True, use_container_width=True)
+            tripped = [b for b in breakers if b.state != circuit_breaker.CLOSED]
+            if tripped and st.button("Close breakers now (credentials fixed)", key="breaker_reset"):
+                for b in tripped:
+                    b.reset()
+                st.rerun()
+        bus = event_bus.BUS.stats()
+        if bus["dropped"]:
+            st.caption(f"Job events: {bus['subscribers']} session(s) listening, "
+                       f"{bus['dropped']} dropped from full session buffers.")
     else:
         st.caption("Pacing is configured by Admin.")
 
+    role = elector.status()
+    if role["role"] == "leader":
+        st.caption(f"Dispatching from this process (leader, term {role['term']}).")
+        waiting = len(leader.Outbox().pending())
+        if waiting:
+            st.warning(f"{waiting} schedule(s) forwarded by other processes are waiting here: enter the "
+                       "Twilio credentials of their senders (or set TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN).")
+    else:
+        st.info(f"Messages are dispatched by {role['leader'] or 'no process yet'}; schedules made here "
+                "are forwarded to it. Delivery logs and bulk actions below cover this process only."
+                + (" The leader lease is stale - a new leader is taking over." if role["lease_stale"] else ""))
+
     # Log panes
     for label, key in [("Scheduled Messages", "scheduled"),
                        ("Delivered Messages", "delivered"),
                        ("Failed Messages", "failed")]:
         with st.expander(label, expanded=False):
-            drain_log_queue()  # keep fresh
+            drain_events()  # keep fresh
             rows = st.session_state.logs.get(key, [])
             if rows:
                 df = pd.DataFrame(rows)
+                if key == "delivered" and "sid" in df.columns:
+                    # handset delivery state from Twilio status callbacks (if configured)
+                    found = status_callbacks.STORE.statuses(df["sid"].tolist())
+                    df["delivery_status"] = df["sid"].map(found).fillna("")
                 gb = GridOptionsBuilder.from_dataframe(df)
                 gb.configure_default_column(sortable=True, filter=True, resizable=True)
                 gb.configure_grid_options(domLayout='autoHeight')
                 AgGrid(df, gridOptions=gb.build(), fit_columns_on_grid_load=True, height=200)
 
+            # Reports are built only on request, then cached until the source log changes
             active_log = st.session_state.get("active_upload_log", None)
-            if active_log and os.path.exists(active_log):
-                try:
-                    with open(active_log, "rb") as f:
-                        data = f.read()
-                    st.download_button("Download Log Report", data=data,
-                        file_name=os.path.basename(active_log), mime="text/csv", key=f"dl_{key}")
-                except Exception:
-                    csv_bytes = pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
-                    st.download_button("Download Log Report", data=csv_bytes,
-                        file_name=f"{key}_logs.csv", mime="text/csv", key=f"dl2_{key}")
+            fmt = st.selectbox("Report format", list(report_export.FORMATS), key=f"fmt_{key}")
+            use_file = bool(active_log and os.path.exists(active_log))
+            if use_file:
+                ready = report_export.current_export(active_log, report_export.file_signature(active_log), fmt)
             else:
-                csv_bytes = pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
-                st.download_button("Download Log Report", data=csv_bytes,
-                    file_name=f"{key}_logs.csv", mime="text/csv", key=f"dl3_{key}")
+                ready = report_export.current_export(
+                    f"{key}_logs", report_export.rows_signature(f"{key}_logs", rows), fmt)
+            if ready is None and st.button("Prepare Log Report", key=f"prep_{key}"):
+                ready = (report_export.export_file(active_log, fmt) if use_file
+                         else report_export.export_rows(f"{key}_logs", rows, fmt))
+            if ready:
+                with open(ready, "rb") as f:
+                    st.download_button("Download Log Report", data=f,
+                        file_name=os.path.basename(ready), mime=report_export.mime_type(fmt), key=f"dl_{key}")
 
             if st.button("Clear Logs", key=f"clear_{key}"):
                 st.session_state.logs[key] = []
                 a = st.session_state.get("active_upload_log", None)
+                log_archive.ACTIVE_LOGS.discard(a)
                 if a and os.path.exists(a):
                     try: os.remove(a)
                     except Exception: pass
@@ -498,6 +761,14 @@ with left_col:
                 value=st.session_state.get("FROM_WHATSAPP", "whatsapp:+"),
                 key="from_wa"
             )
+            st.session_state["SENDER_POOL"] = st.text_area(
+                "Additional sender numbers (optional, one per line)",
+                value=st.session_state.get("SENDER_POOL", ""),
+                placeholder="whatsapp:+1415XXXXXXX\nwhatsapp:+1415YYYYYYY, ACxxxxxxxx, other_account_token",
+                help="Messages are spread across all senders; each recipient keeps the sender that "
+                     "first wrote to them. The delay setting paces each sender separately.",
+                key="sender_pool",
+            )
             st.markdown('</div>', unsafe_allow_html=True)
             st.caption("These credentials are stored only in memory for this session.")
         else:
@@ -508,7 +779,8 @@ with left_col:
             st.write(
                 f"Twilio configured: SID={'✅' if sid_ok else '❌'}, "
                 f"Token={'✅' if tok_ok else '❌'}, "
-                f"From={'✅' if from_ok else '❌'}"
+                f"From={'✅' if from_ok else '❌'}, "
+                f"senders in pool: {len(get_sender_configs())}"
             )
 
     # Validate AFTER input fields are present
@@ -529,6 +801,8 @@ with left_col:
                 test_to = f"whatsapp:{test_to}"
             try:
                 client = Client(sid, tok)
+                # urgent lane: shares the provider rate with scheduled sends but never queues behind bulk
+                dispatch.lane_limiter(dispatch.URGENT, float(st.session_state.get("DELAY_SECONDS", 1.0))).acquire()
                 msg = client.messages.create(
                     from_=wa_from,
                     to=test_to,
@@ -540,7 +814,215 @@ with left_col:
             except Exception as e:
                 st.error(f"Error: {e}")
 
+    # Bulk cancel / pause / resume / shift over the job index (admins only)
+    if is_admin:
+        with st.expander("Manage scheduled jobs", expanded=False):
+            uploads = job_index.INDEX.upload_counts()
+            c1, c2 = st.columns(2)
+            sel_upload = c1.selectbox(
+                "Upload", ["(any)"] + sorted(uploads),
+                format_func=lambda u: u if u == "(any)" else f"{u} ({uploads[u]} pending)",
+            )
+            sel_mobile = c2.text_input("Mobile number (E.164)", value="", key="bulk_mobile")
+            use_range = st.checkbox("Limit to a time range", value=False, key="bulk_use_range")
+            start = end = None
+            if use_range:
+                r1, r2, r3, r4 = st.columns(4)
+                d0 = r1.date_input("From date", key="bulk_d0")
+                t0 = r2.time_input("From time", key="bulk_t0")
+                d1 = r3.date_input("To date", key="bulk_d1")
+                t1 = r4.time_input("To time", key="bulk_t1")
+                start = datetime.combine(d0, t0, tzinfo=ingest.IST)
+                end = datetime.combine(d1, t1, tzinfo=ingest.IST)
+
+            filters = dict(
+                upload_id=None if sel_upload == "(any)" else sel_upload,
+                mobile=ingest.normalize_phone(sel_mobile) if sel_mobile.strip() else None,
+                start=start, end=end,
+            )
+            if not any(v is not None for v in filters.values()):
+                st.caption("Pick an upload, a number or a time range.")
+            else:
+                ids = job_index.INDEX.select(**filters)
+                st.write(f"**{len(ids)}** matching messages "
+                         f"({', '.join(f'{k}: {v}' for k, v in job_index.INDEX.state_counts().items())})")
+                shift_min = st.number_input("Shift by (minutes, negative = earlier)", value=0, step=5,
+                                            key="bulk_shift")
+                b1, b2, b3, b4 = st.columns(4)
+                t_start = time.perf_counter()
+                done = None
+                if b1.button("Cancel", key="bulk_cancel"):
+                    done = f"Cancelled {job_index.INDEX.cancel(ids)} messages"
+                elif b2.button("Pause", key="bulk_pause"):
+                    done = f"Paused {job_index.INDEX.pause(ids)} messages"
+                elif b3.button("Resume", key="bulk_resume"):
+                    resumed, parked = job_index.INDEX.resume(ids)
+                    now = datetime.now(ingest.IST) + timedelta(seconds=2)
+                    schedule_jobs([{**j, "scheduled_at": max(j["scheduled_at"], now)} for j in parked], force=True)
+                    done = f"Resumed {resumed} messages ({len(parked)} re-dispatched)"
+                elif b4.button("Shift", key="bulk_shift_go") and shift_min:
+                    shifted, moved = job_index.INDEX.shift(ids, shift_min * 60)
+                    now = datetime.now(ingest.IST) + timedelta(seconds=2)
+                    schedule_jobs([{**j, "scheduled_at": max(j["scheduled_at"], now)} for j in moved], force=True)
+                    done = f"Shifted {shifted} messages by {shift_min} min ({shifted - len(moved)} stay paused)"
+                if done:
+                    job_index.INDEX.purge_async()
+                    st.success(f"{done} in {(time.perf_counter() - t_start) * 1000:.0f} ms.")
+
+    # Server-side hot folder for files too big for the browser uploader (admins only)
+    if is_admin:
+        hf = get_hot_folder()
+        with st.expander(f"Hot folder ({'watching' if hf.running else 'stopped'})", expanded=False):
+            st.caption(f"Drop CSV / Excel files into `{hf.folder}`. They are parsed and pre-flight checked in "
+                       "the background, then wait here for confirmation (or are scheduled right away with the "
+                       "current credentials, pacing and batch window when auto-scheduling is on and the check "
+                       "passes) and end up in `processed/` or `failed/`.")
+            hot_lane = st.selectbox("Priority lane for folder files", dispatch.LANES,
+                                    index=dispatch.LANES.index(dispatch.DEFAULT_LANE), key="hot_lane")
+            hot_auto = st.checkbox("Schedule files within capacity without confirmation", value=False,
+                                   key="hot_auto")
+            h1, h2, h3 = st.columns(3)
+            if h1.button("Start watching" if not hf.running else "Re-arm with current settings", key="hot_start"):
+                ctx = schedule_context()
+                hf.start(lambda jobs, _name: schedule_jobs(jobs, lane=hot_lane, ctx=ctx),
+                         check=lambda jobs: _hot_preflight(jobs, ctx), auto_schedule=hot_auto)
+                st.rerun()
+            if hf.running and h2.button("Stop", key="hot_stop"):
+                hf.stop()
+                st.rerun()
+            h3.button("Refresh", key="hot_refresh")
+            status = hf.status()
+            if status["waiting"]:
+                st.write("Waiting for writes to finish: " + ", ".join(status["waiting"]))
+            if status["existing"]:
+                st.write("Already in the folder when armed (not ingested): " + ", ".join(status["existing"]))
+                if st.button(f"Ingest {len(status['existing'])} existing file(s)", key="hot_adopt"):
+                    hf.adopt_existing()
+                    st.rerun()
+            for item in hf.awaiting():
+                st.markdown(f"**{item['file']}** · {item['rows']} messages awaiting confirmation")
+                st.caption(item["preflight"])
+                r1, r2 = st.columns(2)
+                if r1.button("Schedule", key=f"hot_confirm_{item['review_file']}"):
+                    st.success(f"Scheduled {hf.confirm(item['review_file'])} messages from {item['file']}.")
+                if r2.button("Reject", key=f"hot_reject_{item['review_file']}"):
+                    hf.reject(item["review_file"])
+                    st.rerun()
+            if status["history"]:
+                st.dataframe(pd.DataFrame(status["history"]), hide_index=True, use_container_width=True)
+
+        api_q = ingest_api.QUEUE
+        with st.expander(f"Bulk ingestion API ({'scheduling here' if api_q.attached else 'spooling to hot folder'})",
+                         expanded=False):
+            st.caption("`POST /api/v1/batches` on the web app (NDJSON, JSON or CSV, `Authorization: Bearer "
+                       "$INGEST_API_TOKEN`). Attach to schedule accepted batches directly in this process; "
+                       "otherwise they are written to the hot folder.")
+            if not ingest_api.API_TOKENS:
+                st.warning("INGEST_API_TOKEN is not set: the API answers 503.")
+            a1, a2 = st.columns(2)
+            if a1.button("Attach with current settings", key="api_attach"):
+                ctx = schedule_context()
+                api_q.attach(lambda jobs: schedule_jobs(jobs, ctx=ctx))
+                st.rerun()
+            if api_q.attached and a2.button("Detach", key="api_detach"):
+                api_q.attach(None)
+                st.rerun()
+            st.write(f"Queued: {api_q.queued_messages} messages · pending limit {ingest_api.MAX_PENDING}")
+            recent = [{k: v for k, v in r.items() if k != "errors"} for r in api_q.recent(50)]
+            if recent:
+                st.dataframe(pd.DataFrame(recent), hide_index=True, use_container_width=True)
+
+        with st.expander("Schedule drift", expanded=False):
+            st.caption("From the lifecycle ledger. Drift = picked up by a worker − due (scheduler / worker "
+                       "pool behind); wait = API call start − picked up (rate limit / sender pacing); "
+                       "API = Twilio call time.")
+            today = datetime.now(ingest.IST).date()
+            d1, d2, d3 = st.columns(3)
+            drift_from = d1.date_input("From", value=today, key="drift_from")
+            drift_to = d2.date_input("To", value=today, key="drift_to")
+            drift_by = d3.selectbox("Group by", ["hour", "upload_id", "lane", "sender"], key="drift_by")
+            if st.checkbox("Load drift report", key="drift_show"):
+                dropped = lifecycle.LEDGER.dropped
+                try:
+                    ledger = lifecycle.LEDGER.load(drift_from, drift_to)
+                    table = lifecycle.drift_percentiles(ledger, drift_by) if not ledger.empty else pd.DataFrame()
+                except Exception as e:  # unreadable ledger file: report it, keep the dashboard up
+                    print(f"[LEDGER] {type(e).__name__}: {e}")
+                    st.warning(f"Could not read the lifecycle ledger: {type(e).__name__}: {e}")
+                    table = None
+                if lifecycle.LEDGER.dropped > dropped:
+                    st.warning(f"Lifecycle ledger write failed; {lifecycle.LEDGER.dropped - dropped} rows dropped "
+                               "(see [LEDGER] in the logs).")
+                if table is None:
+                    st.info("Drift report unavailable.")
+                elif table.empty:
+                    st.info("No sends recorded for these days yet.")
+                else:
+                    p95 = table[["drift_p95_s", "wait_p95_s", "api_p95_s"]]
+                    if drift_by == "hour":
+                        st.line_chart(p95)
+                    else:
+                        st.bar_chart(p95)
+                    st.dataframe(table, use_container_width=True)
+
+        with st.expander("Message history", expanded=False):
+            st.caption("Archived deliveries and conversion logs for one number (indexed by phone and day).")
+            h1, h2, h3 = st.columns([2, 1, 1])
+            hist_phone = h1.text_input("Mobile number", key="hist_phone", placeholder="+9198XXXXXXXX")
+            hist_from = h2.date_input("From", value=today - timedelta(days=30), key="hist_from")
+            hist_to = h3.date_input("To", value=today, key="hist_to")
+            if hist_phone and st.button("Look up", key="hist_lookup"):
+                t0 = time.perf_counter()
+                found = log_archive_store.lookup(ingest.normalize_phone(hist_phone), hist_from, hist_to)
+                st.caption(f"{len(found)} record(s) in {(time.perf_counter() - t0) * 1000:.0f} ms")
+                if found:
+                    hist = pd.DataFrame(found)
+                    hist.insert(0, "at", pd.to_datetime(hist["ts"], unit="s", utc=True).dt.tz_convert(ingest.IST))
+                    st.dataframe(hist.drop(columns=["ts"]), hide_index=True, use_container_width=True)
+            st.dataframe(pd.DataFrame(log_archive_store.stats()), hide_index=True, use_container_width=True)
+            if st.button("Close active segments now", key="archive_rotate"):
+                log_archive_store.rotate_all()
+                st.rerun()
+
+        with st.expander("Opt-out list", expanded=False):
+            sup = suppression.LIST.stats()
+            st.caption(f"{sup['base_numbers'] + sup['pending_adds']} number(s) opted out (approx.). Checked when "
+                       "uploads are parsed and again before every send. STOP / START replies to "
+                       "`/twilio/inbound` on the web app update it automatically.")
+            o1, o2 = st.columns(2)
+            optout_numbers = o1.text_area("Numbers (one per line)", key="optout_numbers", height=100)
+            b1, b2 = o1.columns(2)
+            if b1.button("Opt out", key="optout_add") and optout_numbers.strip():
+                n = suppression.LIST.add(ingest.normalize_phone(v) for v in optout_numbers.split())
+                st.success(f"Opted out {n} number(s).")
+            if b2.button("Opt back in", key="optout_remove") and optout_numbers.strip():
+                n = suppression.LIST.remove(ingest.normalize_phone(v) for v in optout_numbers.split())
+                st.success(f"Opted {n} number(s) back in.")
+            optout_file = o2.file_uploader("Bulk list (CSV / Excel / .txt)", key="optout_file",
+                                           type=["csv", "xls", "xlsx", "txt"])
+            replace_list = o2.checkbox("Replace the whole list", key="optout_replace")
+            if optout_file is not None and o2.button("Load list", key="optout_load"):
+                t0 = time.perf_counter()
+                n = suppression.LIST.load(suppression.read_numbers(optout_file), replace=replace_list)
+                st.success(f"Loaded {n} number(s) in {time.perf_counter() - t0:.1f}s.")
+            st.json(sup, expanded=False)
+
+    for br in circuit_breaker.all_breakers():
+        if br.state != circuit_breaker.CLOSED:
+            b = br.stats()
+            st.error(f"Sending paused for Twilio account …{br.name[-6:]}: {b['reason']}. {b['held']} message(s) "
+                     f"held on the schedule; "
+                     + (f"test send in {b['probe_in_s']}s." if br.state == circuit_breaker.OPEN
+                        else "test send in progress."))
+
     st.markdown("<h2><b>Upload the CSV / Excel</b></h2>", unsafe_allow_html=True)
+    st.session_state.MESSAGE_TEMPLATE = st.text_area(
+        "Message template (optional)",
+        value=st.session_state.get("MESSAGE_TEMPLATE", ""),
+        placeholder="Hello {name}, your appointment is on {date} at {time}.",
+        help="Use {column} for any column of the upload. Leave empty to send the file's "
+             "message column, or 'Hello {name}' if it has none.",
+    )
     uploaded_files = st.file_uploader(
         "Choose CSV or Excel files",
         type=["csv", "xls", "xlsx", "xlsm", "xlsb", "ods"],
@@ -548,64 +1030,255 @@ with left_col:
         help="Columns accepted: name, mobile_number, media_path/Media_URL, date, time OR combined datetime column.",
     )
 
+    with st.expander("Media library", expanded=False):
+        st.caption(f"Rows may name a file under {', '.join(media_store.SOURCE_DIRS)}/ (e.g. uploads\\sliding.jpg) "
+                   "or a URL from here. Each image is resized for WhatsApp and stored once, however many "
+                   "rows use it.")
+        media_files = st.file_uploader("Add images or documents", accept_multiple_files=True, key="media_upload",
+                                       type=[e.lstrip(".") for e in (*media_store.IMAGE_EXTS,
+                                                                     *media_store.PASSTHROUGH_TYPES)])
+        for mf in media_files or []:
+            try:
+                asset = media_store.STORE.put_bytes(mf.getvalue(), mf.name)
+                st.code(media_store.STORE.url_for(asset), language=None)
+            except ValueError as e:
+                st.error(str(e))
+        ms = media_store.STORE.stats()
+        st.caption(f"{ms['assets']} stored file(s), {ms['bytes'] / 1e6:.1f} MB.")
+
+    upload_lane = st.selectbox(
+        "Priority lane",
+        dispatch.LANES,
+        index=dispatch.LANES.index(dispatch.DEFAULT_LANE),
+        help="Applies to rows without their own 'priority' column value. Urgent messages get "
+             "reserved workers and rate share, so they are not delayed by a bulk backlog.",
+    )
+
+    dry_run = st.checkbox(
+        "Dry run: simulate the schedule instead of sending",
+        value=False,
+        help="Replays the upload on an accelerated clock with the current pacing, batch window "
+             "and a fake sender. Nothing is scheduled.",
+    )
+
     if uploaded_files:
-        total_scheduled = 0
-        for uploaded in uploaded_files:
-            base_name = os.path.splitext(uploaded.name)[0]
-            df = read_any_table(uploaded)
-            df = post_process_mobile_column(df)
-            if df is None or df.empty:
-                st.warning(f"No data found in {uploaded.name}.")
+        total_scheduled = revised_ops = 0
+        tpl_text = (st.session_state.get("MESSAGE_TEMPLATE") or "").strip()
+        upload_key = (tuple((u.name, u.size) for u in uploaded_files), tpl_text)
+        parsed = st.session_state.get("parsed_upload")
+
+        # Parse once per distinct upload; reruns (e.g. the confirm button) reuse the result
+        if parsed is None or parsed["key"] != upload_key:
+            parsed = {"key": upload_key, "files": [], "scheduled": False}
+            items = [(u.name, u.getvalue()) for u in uploaded_files]
+            results = [None] * len(items)
+            t_wall = time.perf_counter()
+            with st.status(f"Parsing {len(items)} file(s)...", expanded=True) as parse_status:
+                for i, res in parse_uploads(items, tpl_text):
+                    results[i] = res
+                    if res.get("profile") is not None:
+                        parse_status.write(f"✅ {res['name']}: {res['profile'].rows} rows in "
+                                           f"{res['profile'].total_seconds:.1f}s")
+                    else:
+                        parse_status.write(f"⚠️ {res.get('warning') or res.get('error')}")
+                wall = time.perf_counter() - t_wall
+                parse_status.update(label=f"Parsed {len(items)} file(s) in {wall:.1f}s", state="complete",
+                                    expanded=False)
+            for res in results:
+                if res.get("log_path"):
+                    log_archive.ACTIVE_LOGS.discard(st.session_state.get("active_upload_log"))
+                    log_archive.ACTIVE_LOGS.add(res["log_path"])  # the archive sweep skips it
+                    st.session_state.active_upload_log = res["log_path"]
+                parsed["files"].append(res)
+                metrics.SUPPRESSED.inc(res.get("suppressed", 0), stage="upload")
+            ok = [f for f in parsed["files"] if f.get("profile") is not None]
+            parsed["summary"] = {
+                "files": len(ok),
+                "rows": sum(f["profile"].rows for f in ok),
+                "messages": sum(len(f["jobs"]) for f in ok),
+                "suppressed": sum(f.get("suppressed", 0) for f in ok),
+                "wall_s": wall,
+                "parse_s": sum(f["profile"].total_seconds for f in ok),
+            }
+            st.session_state.parsed_upload = parsed
+
+        if parsed.get("summary", {}).get("files"):
+            sm = parsed["summary"]
+            st.caption(f"{sm['files']} file(s), {sm['rows']} rows, {sm['messages']} messages; parsed in "
+                       f"{sm['wall_s']:.1f}s wall time ({sm['parse_s']:.1f}s of per-file work).")
+            if sm.get("suppressed"):
+                st.info(f"{sm['suppressed']} row(s) to opted-out numbers were removed "
+                        + "(" + ", ".join(f"{f['name']}: {f['suppressed']}" for f in parsed["files"]
+                                          if f.get("suppressed")) + ").")
+
+        for f in parsed["files"]:
+            if f.get("warning"):
+                st.warning(f["warning"])
                 continue
-
-            st.markdown(f"**Preview: {uploaded.name} (first 10 rows)**")
+            if f.get("error"):
+                st.error(f["error"])
+                continue
+            st.markdown(f"**Preview: {f['name']} (first 10 rows)**")
             AgGrid(
-                df.head(10),
-                gridOptions=GridOptionsBuilder.from_dataframe(df.head(10)).build(),
+                f["preview"],
+                gridOptions=GridOptionsBuilder.from_dataframe(f["preview"]).build(),
                 height=200,
                 fit_columns_on_grid_load=True,
             )
-
-            jobs = parse_to_jobs(df, base_name)
-            for job in jobs:
-                schedule_job(job)
-            total_scheduled += len(jobs)
-
+            schema = f.get("schema")
+            if schema:
+                with st.expander(f"Column mapping: {f['name']} ({schema['source']})", expanded=False):
+                    st.caption("Detected once per header layout and reused for files with the same columns. "
+                               "Correct it here if a column was misread.")
+                    options = ["(none)"] + f["columns"]
+                    chosen = {}
+                    cols = st.columns(4)
+                    for i, role in enumerate(schema_inference.ROLES):
+                        current = schema["roles"].get(role)
+                        pick = cols[i % 4].selectbox(
+                            f"{role} ({schema['confidence'].get(role, 0):.0%})", options,
+                            index=options.index(current) if current in options else 0,
+                            key=f"schema_{schema['signature']}_{role}")
+                        chosen[role] = None if pick == "(none)" else pick
+                    if st.button("Save mapping and re-parse", key=f"schema_save_{schema['signature']}"):
+                        schema_inference.save_override(schema["signature"], chosen)
+                        st.session_state.parsed_upload = None
+                        st.rerun()
+
+        for f in parsed["files"]:
+            profile = f.get("profile")
+            if profile is None:
+                continue
+            with st.expander(f"Ingestion profile: {profile.source_name} "
+                             f"({profile.rows} rows, {profile.total_seconds:.2f}s)", expanded=False):
+                st.dataframe(pd.DataFrame(profile.stage_rows()), hide_index=True, use_container_width=True)
+                if profile.counters:
+                    st.markdown("**Fallback paths taken**")
+                    st.dataframe(pd.DataFrame([{"path": k, "count": v} for k, v in profile.counters.items()]),
+                                 hide_index=True, use_container_width=True)
+                st.caption(f"Profile saved to `{profile.path}`")
+
+        all_jobs = [j if j.get("lane") else {**j, "lane": upload_lane}
+                    for f in parsed["files"] for j in f.get("jobs", [])]
+        delay = float(st.session_state.get("DELAY_SECONDS", 1.0))
+
+        # what will actually be sent once rows to the same recipient are coalesced (per file, as scheduled)
+        coalesce_window = float(st.session_state.get("COALESCE_WINDOW_SECONDS", coalesce.COALESCE_WINDOW_SECONDS))
+        send_jobs, co_reports = all_jobs, []
+        if coalesce_window and all_jobs:
+            send_jobs = []
+            for f in parsed["files"]:
+                js, rep = coalesce.coalesce_recipients(
+                    [j if j.get("lane") else {**j, "lane": upload_lane} for j in f.get("jobs", [])],
+                    coalesce_window)
+                send_jobs += js
+                co_reports.append({"file": f["name"], **rep})
+        if any(r["api_calls_saved"] for r in co_reports):
+            saved = sum(r["api_calls_saved"] for r in co_reports)
+            st.info(f"Per-recipient coalescing: {len(all_jobs)} rows -> {len(send_jobs)} sends "
+                    f"({saved} API calls saved, {saved / len(all_jobs):.0%}).")
+            st.dataframe(pd.DataFrame(co_reports), hide_index=True, use_container_width=True)
+
+        if dry_run and all_jobs:
+            report = simulator.simulate(
+                send_jobs,
+                delay_seconds=delay,
+                batch_window_seconds=float(st.session_state.get("BATCH_WINDOW_SECONDS",
+                                                                dispatch.BATCH_WINDOW_SECONDS)),
+                lane_workers=dispatch.LANE_WORKERS,
+            )
+            st.markdown("### Dry run")
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("Messages", report["messages"])
+            c2.metric("Misfires (lost)", report["misfires"])
+            c3.metric("Max lateness", f"{report['max_lateness_s'] / 60:.1f} min")
+            c4.metric("Peak backlog", report["peak_backlog"])
+            st.caption(f"Last send predicted at {report['last_send_at'] or '-'}; "
+                       f"p95 lateness {report['p95_lateness_s']:.0f}s.")
+            if report["backlog"]:
+                st.line_chart(pd.DataFrame(report["backlog"]).set_index("time"))
+            if report["sends"]:
+                st.dataframe(pd.DataFrame(report["sends"]).head(1000), hide_index=True,
+                             use_container_width=True)
+
+        elif all_jobs:
+            # ---- Pre-flight capacity check, then explicit confirmation ----
+            pf = capacity.preflight(send_jobs, delay, senders=len(get_sender_configs()))
+            st.markdown("### Pre-flight capacity")
+            rate = pf["rate_per_second"]
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("Messages", pf["messages"])
+            c2.metric("Send rate", "unlimited" if rate == float("inf") else f"{rate * 60:.0f}/min")
+            c3.metric("Peak backlog", pf["peak_backlog"])
+            c4.metric("Max lateness", f"{pf['max_lateness_s'] / 60:.1f} min")
+            if pf["overloaded"]:
+                worst = max(pf["overloaded"], key=lambda r: r["scheduled"])
+                st.warning(
+                    f"{len(pf['overloaded'])} time window(s) exceed capacity. Worst: "
+                    f"{worst['scheduled']} messages at {worst['bucket_start']} "
+                    f"({pf['bucket_seconds'] // 60} min) vs {worst['capacity']:.0f} sends allowed. "
+                    f"Last message predicted at {pf['predicted_finish']} (last scheduled {pf['last_due']})."
+                )
+            else:
+                st.caption(f"Within capacity; last message predicted at {pf['predicted_finish']}.")
+            st.line_chart(pd.DataFrame(pf["buckets"]).set_index("bucket_start")[["scheduled", "capacity", "backlog"]])
+
+            # local media paths are converted and stored once here; scheduling then only looks them up
+            local_media = [{"media_url": m} for m in {j.get("media_url") or "" for j in all_jobs}
+                           if m and not re.match(r"^https?://", m, re.IGNORECASE)]
+            if local_media:
+                resolved, media_errors = media_store.STORE.resolve_jobs(local_media)
+                if media_errors:
+                    st.warning("These media files cannot be sent; their rows will fail:\n\n"
+                               + "\n".join(f"- {e}" for e in media_errors.values()))
+                if len(media_errors) < len(local_media):
+                    st.caption(f"{len(local_media) - len(media_errors)} local media file(s) resized for "
+                               f"WhatsApp and served from {media_store.public_base_url()}/media/.")
+
+            # Revised versions of an earlier upload (same file name) only apply their row-level delta
+            revisions = {}
+            for f in parsed["files"]:
+                if f.get("jobs"):
+                    prev = upload_diff.find_previous(f["jobs"][0]["upload_id"])
+                    if prev:
+                        revisions[f["name"]] = prev
+            incremental = bool(revisions) and st.checkbox(
+                "Apply as a revision of the earlier upload (only added, changed and removed rows)",
+                value=True, key="apply_as_revision")
+            diffs = {}
+            if incremental:
+                for f in parsed["files"]:
+                    if f["name"] in revisions:
+                        new_jobs = [j if j.get("lane") else {**j, "lane": upload_lane} for j in f["jobs"]]
+                        # scheduled rows carry store URLs: compare like with like, or every local-media row "changed"
+                        new_jobs, _ = media_store.STORE.resolve_jobs(new_jobs)
+                        diffs[f["name"]] = upload_diff.diff(
+                            upload_diff.previous_records(revisions[f["name"]]), new_jobs)
+                st.dataframe(pd.DataFrame([{"file": n, "revises": revisions[n], **upload_diff.summary(d)}
+                                           for n, d in diffs.items()]), hide_index=True, use_container_width=True)
+
+            n_ops = sum(len(d["added"]) + len(d["changed"]) + len(d["removed"]) for d in diffs.values()) + \
+                sum(len(f.get("jobs", [])) for f in parsed["files"] if f["name"] not in diffs)
+            if parsed["scheduled"]:
+                st.info("This upload has already been scheduled.")
+            elif st.button(f"Apply {n_ops} changes" if diffs else f"Schedule {len(send_jobs)} messages",
+                           key="confirm_schedule"):
+                for f in parsed["files"]:
+                    if not f.get("jobs"):
+                        continue
+                    with f["profile"].stage("schedule_job_loop"):
+                        if f["name"] in diffs:
+                            ops = upload_diff.apply(diffs[f["name"]], revisions[f["name"]],
+                                                    lambda js: schedule_jobs(js, force=True, lane=upload_lane))
+                            f["profile"].count("revision_scheduler_ops", ops)
+                            revised_ops += ops
+                        else:
+                            total_scheduled += schedule_jobs(f["jobs"], lane=upload_lane)
+                    f["profile"].write_json(ingest.PROFILES_DIR)
+                parsed["scheduled"] = True
+
+        if revised_ops:
+            st.success(f"Revision applied with {revised_ops} scheduler operations.")
         if total_scheduled:
             st.success(f"Scheduled {total_scheduled} messages from {len(uploaded_files)} file(s).")
 
-            # your existing imports
-            from apscheduler.schedulers.background import BackgroundScheduler
-            import time
-            import os
-            import atexit
-            from flask import Flask
-
-
-            # your existing functions and job logic
-            def send_whatsapp_message():
-                print("Sending WhatsApp message...")
-
-
-            # create scheduler and add your existing jobs
-            scheduler = BackgroundScheduler()
-            scheduler.add_job(send_whatsapp_message, "interval", minutes=1)
-            scheduler.start()
-
-            # shut down gracefully
-            atexit.register(lambda: scheduler.shutdown())
-
-            # Flask app to keep Render process alive
-            app = Flask(__name__)
-
-
-            @app.route("/")
-            def home():
-                return "Scheduler is running on Render!"
-
-
-            # run flask server (MUST be last!)
-            if __name__ == "__main__":
-                port = int(os.environ.get("PORT", 5000))  # Render provides PORT
-                app.run(host="0.0.0.0", port=port)
-
@@ -0,0 +1,191 @@
+# media_store.py
+#
+# Content-addressed store for local media referenced by upload rows
+# (e.g. "uploads\sliding.jpg"). Each source file is keyed by the hash of its
+# bytes, converted once to something WhatsApp accepts (images: JPEG, long
+# edge <= MEDIA_MAX_EDGE, <= 5 MB) and served by web_app at /media/<asset>
+# with immutable caching headers. The same picture sent to 100k recipients is
+# read, resized and stored once; every row just carries its public URL.
+#
+# Twilio fetches the media itself, so MEDIA_PUBLIC_BASE_URL must be the
+# externally reachable address of the web app (defaults to the host of
+# STATUS_CALLBACK_URL when that is set).
+
+import hashlib
+import io
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import status_callbacks
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # images are then stored as uploaded (if small enough)
+    Image = None
+
+MEDIA_DIR = os.environ.get("MEDIA_STORE_DIR", "media_store")
+# local paths in rows are only accepted under these folders (rows can come from the public API)
+SOURCE_DIRS = [d for d in os.environ.get("MEDIA_SOURCE_DIRS", "uploads").split(",") if d.strip()]
+MAX_EDGE = int(os.environ.get("MEDIA_MAX_EDGE", 1600))  # px; WhatsApp downsizes anything larger anyway
+IMAGE_MAX_BYTES = 5 * 1024 * 1024
+OTHER_MAX_BYTES = 16 * 1024 * 1024
+JPEG_QUALITIES = (85, 75, 65, 55, 45)
+PROFILE = f"jpeg-{MAX_EDGE}-v1"  # part of every image key: changing the conversion makes new assets
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff", ".heic"}
+PASSTHROUGH_TYPES = {
+    ".pdf": "application/pdf", ".mp4": "video/mp4", ".3gp": "video/3gpp", ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg", ".amr": "audio/amr", ".aac": "audio/aac", ".m4a": "audio/mp4",
+}
+MIME_TYPES = {".jpg": "image/jpeg", ".png": "image/png", **PASSTHROUGH_TYPES}
+ASSET_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{2,4}$")
+_URL_RE = re.compile(r"^https?://", re.IGNORECASE)
+
+
+def public_base_url() -> str:
+    base = os.environ.get("MEDIA_PUBLIC_BASE_URL", "").strip()
+    if not base and status_callbacks.STATUS_CALLBACK_URL:
+        parts = urlsplit(status_callbacks.STATUS_CALLBACK_URL)
+        base = f"{parts.scheme}://{parts.netloc}"
+    return base.rstrip("/")
+
+
+class MediaStore:
+    def __init__(self, root: str = MEDIA_DIR, source_dirs: List[str] = SOURCE_DIRS):
+        self.root = root
+        self.source_dirs = [os.path.realpath(d) for d in source_dirs]
+        self._by_file: Dict[Tuple[str, int, int], str] = {}  # (path, size, mtime) -> asset
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.stored = self.reused = 0
+
+    # ---------------- STORAGE ----------------
+    def path_for(self, asset: str) -> Optional[str]:
+        """File of a stored asset, or None (also for malformed names)."""
+        if not ASSET_RE.match(asset or ""):
+            return None
+        path = os.path.abspath(os.path.join(self.root, asset[:2], asset))
+        return path if os.path.exists(path) else None
+
+    def put_bytes(self, data: bytes, name: str) -> str:
+        """Store (converting once) and return the asset name; ValueError if unusable."""
+        ext = os.path.splitext(name)[1].lower()
+        if ext in IMAGE_EXTS:
+            key = hashlib.sha256(PROFILE.encode() + b"\0" + data).hexdigest()
+            out_ext = ".jpg" if Image is not None else (".png" if ext == ".png" else ".jpg")
+        elif ext in PASSTHROUGH_TYPES:
+            key, out_ext = hashlib.sha256(data).hexdigest(), ext
+        else:
+            raise ValueError(f"{name}: unsupported media type {ext or '(none)'}")
+        asset = key + out_ext
+
+        with self._lock:
+            lock = self._locks.setdefault(asset, threading.Lock())
+        with lock:  # concurrent rows with the same picture convert it once
+            if self.path_for(asset):
+                self.reused += 1
+                return asset
+            if ext in IMAGE_EXTS:
+                data = self._convert_image(data, name)
+            elif len(data) > OTHER_MAX_BYTES:
+                raise ValueError(f"{name}: {len(data) / 1e6:.1f} MB exceeds the 16 MB media limit")
+            path = os.path.join(self.root, asset[:2], asset)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)  # other processes see all of it or nothing
+            self.stored += 1
+        return asset
+
+    def _convert_image(self, data: bytes, name: str) -> bytes:
+        if Image is None:
+            if len(data) > IMAGE_MAX_BYTES:
+                raise ValueError(f"{name}: over 5 MB and Pillow is not installed to shrink it")
+            return data
+        try:
+            img = Image.open(io.BytesIO(data))
+            img = ImageOps.exif_transpose(img)  # phone photos: rotate, then drop the EXIF
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"{name}: not a readable image ({e})")
+        if img.mode != "RGB":
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))  # transparency onto white
+        edge = MAX_EDGE
+        while True:
+            frame = img.copy()
+            frame.thumbnail((edge, edge), Image.LANCZOS)
+            for quality in JPEG_QUALITIES:
+                buf = io.BytesIO()
+                frame.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+                if buf.tell() <= IMAGE_MAX_BYTES:
+                    return buf.getvalue()
+            edge = int(edge * 0.75)
+
+    def put_file(self, path: str) -> str:
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+        asset = self._by_file.get(key)
+        if asset and self.path_for(asset):
+            self.reused += 1
+            return asset
+        with open(path, "rb") as f:
+            asset = self.put_bytes(f.read(), os.path.basename(path))
+        self._by_file[key] = asset
+        return asset
+
+    # ---------------- ROW MEDIA ----------------
+    def local_source(self, media: str) -> str:
+        """File a row's media value points at, restricted to SOURCE_DIRS."""
+        rel = media.strip().replace("\\", "/")
+        candidates = [rel] + [os.path.join(d, os.path.basename(rel)) for d in self.source_dirs]
+        for cand in candidates:
+            real = os.path.realpath(cand)
+            if os.path.isfile(real) and any(real.startswith(d + os.sep) for d in self.source_dirs):
+                return real
+        raise ValueError(f"media file not found under {', '.join(SOURCE_DIRS)}: {media}")
+
+    def url_for(self, asset: str) -> str:
+        base = public_base_url()
+        if not base:
+            raise ValueError("local media needs MEDIA_PUBLIC_BASE_URL (the web app's public address)")
+        return f"{base}/media/{asset}"
+
+    def resolve(self, media: str) -> str:
+        """Public URL for a row's media value (http(s) URLs are returned unchanged)."""
+        if not media or _URL_RE.match(media):
+            return media
+        return self.url_for(self.put_file(self.local_source(media)))
+
+    def resolve_jobs(self, jobs: List[dict]) -> Tuple[List[dict], Dict[str, str]]:
+        """
+        Jobs with local media replaced by store URLs (each distinct value resolved once),
+        plus {media value: error} for values left as they were.
+        """
+        urls, errors = {}, {}
+        for media in {j.get("media_url") or "" for j in jobs}:
+            if media and not _URL_RE.match(media):
+                try:
+                    urls[media] = self.resolve(media)
+                except (OSError, ValueError) as e:
+                    errors[media] = str(e)
+        if not urls:
+            return jobs, errors
+        return [{**j, "media_url": urls[j["media_url"]]} if j.get("media_url") in urls else j
+                for j in jobs], errors
+
+    def stats(self) -> Dict[str, int]:
+        files = size = 0
+        for dirpath, _dirs, names in os.walk(self.root):
+            for n in names:
+                if ASSET_RE.match(n):
+                    files += 1
+                    size += os.path.getsize(os.path.join(dirpath, n))
+        return {"assets": files, "bytes": size, "stored": self.stored, "reused": self.reused}
+
+
+STORE = MediaStore()
@@ -0,0 +1,111 @@
+# message_templates.py
+#
+# Message body templates such as "Hello {name}, your slot is {time}".
+# A template is compiled once per upload (placeholders resolved to real
+# column names and validated against the header), then rendered for the
+# whole DataFrame at ingestion time, so every job carries its final body and
+# can move between processes. Rendered bodies are interned so identical texts
+# share one string object.
+
+import hashlib
+import string
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+DEFAULT_GREETING = "Hello {name}"
+MESSAGE_CANDS = ["message", "body", "text", "msg"]
+
+
+class TemplateError(ValueError):
+    """Template syntax error or placeholders that do not match the upload header."""
+
+
+class CompiledTemplate:
+    """Template with placeholders bound to concrete column names."""
+
+    def __init__(self, text: str, parts: List[Tuple[str, Optional[str]]]):
+        self.text = text
+        self.parts = parts  # [(literal, column or None), ...]
+        self.columns = sorted({c for _, c in parts if c})
+        self.template_id = hashlib.sha1(
+            (text + "\0" + "\0".join(self.columns)).encode("utf-8")).hexdigest()[:16]
+
+    def render(self, values: Dict) -> str:
+        out = []
+        for literal, col in self.parts:
+            out.append(literal)
+            if col:
+                v = values.get(col, "")
+                out.append("" if v is None or (isinstance(v, float) and pd.isna(v)) else str(v))
+        return sys.intern("".join(out))
+
+    def render_frame(self, df: pd.DataFrame) -> List[str]:
+        """Render every row of df at once (vectorised concat), bodies interned."""
+        if not len(df):
+            return []
+        acc = pd.Series([""] * len(df), index=df.index, dtype=object)
+        for literal, col in self.parts:
+            if literal:
+                acc = acc + literal
+            if col:
+                acc = acc + df[col].fillna("").astype(str)
+        return [sys.intern(s) for s in acc.tolist()]
+
+
+def compile_template(text: str, columns) -> CompiledTemplate:
+    """
+    Parse `text` once and bind each {placeholder} to a column of the upload.
+    Matching is case-insensitive and ignores surrounding spaces / underscores.
+    Raises TemplateError listing every unknown placeholder.
+    """
+    lookup = {_norm(c): c for c in columns}
+    parts, missing = [], []
+    try:
+        parsed = list(string.Formatter().parse(text or ""))
+    except ValueError as e:
+        raise TemplateError(f"Invalid template: {e}") from e
+    for literal, field, _spec, _conv in parsed:
+        col = None
+        if field is not None:
+            if field.strip() == "":
+                raise TemplateError("Empty {} placeholder in template")
+            col = lookup.get(_norm(field))
+            if col is None:
+                missing.append(field)
+        parts.append((literal, col))
+    if missing:
+        raise TemplateError(
+            f"Template placeholders not found in file header: {', '.join(sorted(set(missing)))}. "
+            f"Available columns: {', '.join(map(str, columns))}")
+    return CompiledTemplate(text, parts)
+
+
+def default_template(columns, message_col: Optional[str] = None, name_col: Optional[str] = None) -> CompiledTemplate:
+    """`{message}` when the upload has a message column, else the old 'Hello {name}' body."""
+    if message_col:
+        return CompiledTemplate("{" + message_col + "}", [("", message_col)])
+    if name_col:
+        return CompiledTemplate(DEFAULT_GREETING, [("Hello ", name_col)])
+    return CompiledTemplate("Hello ", [("Hello ", None)])
+
+
+def _norm(s) -> str:
+    return str(s).strip().lower().replace(" ", "_")
+
+
+def body_for(job: Dict) -> str:
+    """
+    Message body for a job: its rendered body, or the legacy greeting for jobs
+    scheduled before templates. A job that still refers to a template by id
+    (lazily rendered by an older version) raises TemplateError rather than
+    going out as the greeting.
+    """
+    body = job.get("body")
+    if body:
+        return body
+    if job.get("template_id"):
+        raise TemplateError(f"message {job.get('job_id', '')} refers to template {job['template_id']}, "
+                            "which is not rendered in this process; upload the file again")
+    return f"Hello {job.get('name', '')}"
@@ -0,0 +1,460 @@
+# metrics.py
+#
+# Tiny in-process metrics registry rendered in the Prometheus text format
+# (prometheus_client is not in requirements). The app modules the scrape-time
+# gauges read are imported when a scrape evaluates them, not at import time.
+#
+# The scheduler lives in the Streamlit process; the web app the Procfile runs
+# (gunicorn) only sees webhooks and API calls. The leader writes its metrics
+# to SNAPSHOT_PATH every SNAPSHOT_SECONDS (the processes share logs/ like the
+# hot folder and outbox do), and the gunicorn /metrics serves render_merged():
+# its own series labelled process="web" plus the snapshot's process="scheduler".
+
+import functools
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+SNAPSHOT_PATH = os.environ.get("METRICS_SNAPSHOT_PATH", os.path.join("logs", "metrics_scheduler.prom"))
+SNAPSHOT_SECONDS = 15.0
+
+# "Jobs due in the next N minutes" windows, e.g. METRICS_DUE_WINDOWS="5,15,60"
+DUE_WINDOWS_MINUTES = [
+    int(x) for x in os.environ.get("METRICS_DUE_WINDOWS", "5,15,60").split(",") if x.strip().isdigit()
+]
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+# ---------------- METRIC TYPES ----------------
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        return self._values.get(key, 0.0)
+
+    def samples(self):
+        with _lock:
+            items = list(self._values.items())
+        if not items and not self.labels:
+            items = [((), 0.0)]
+        for key, v in items:
+            yield f"{self.name}{_fmt_labels(self.labels, key)} {_fmt_value(v)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), callback=None):
+        super().__init__(name, help_text, labels)
+        # callback() -> float (unlabelled) or {label_tuple: float}; evaluated at scrape time
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with _lock:
+            self._values[key] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self._callback is not None:
+            try:
+                res = self._callback()
+            except Exception:
+                res = None
+            if isinstance(res, dict):
+                for key, v in res.items():
+                    key = key if isinstance(key, tuple) else (key,)
+                    yield f"{self.name}{_fmt_labels(self.labels, key)} {_fmt_value(v)}"
+            elif res is not None:
+                yield f"{self.name} {_fmt_value(res)}"
+            return
+        yield from super().samples()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS, labels: Iterable[str] = ()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with _lock:
+            s = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def samples(self):
+        with _lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        for key, s in items:
+            for i, b in enumerate(self.buckets):
+                le = f'le="{_fmt_value(b)}"'
+                yield f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {s[i]}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, key)} {_fmt_value(s[-2])}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, key)} {s[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self, extra: Optional[Dict[str, Dict[str, list]]] = None, label: str = "") -> str:
+        """
+        Prometheus text. label (e.g. 'process="web"') is added to every sample;
+        extra = {family: {"help", "type", "samples"}} from another process is merged in.
+        """
+        extra = dict(extra or {})
+        out = []
+        for m in list(self._metrics.values()):
+            other = extra.pop(m.name, None)
+            out.append(f"# HELP {m.name} {m.help}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(_with_label(line, label) for line in m.samples())
+            if other:
+                out.extend(other["samples"])
+        for name, fam in extra.items():  # families only the other process knows
+            out += [f"# HELP {name} {fam['help']}", f"# TYPE {name} {fam['type']}"] + fam["samples"]
+        return "\n".join(out) + "\n"
+
+
+def _with_label(sample: str, label: str) -> str:
+    if not label:
+        return sample
+    series, value = sample.rsplit(" ", 1)
+    if series.endswith("}"):
+        return f"{series[:-1]},{label}}} {value}"
+    return f"{series}{{{label}}} {value}"
+
+
+def parse_families(text: str, label: str = "") -> Dict[str, Dict]:
+    """Text produced by render() -> {family: {"help", "type", "samples"}}, label added to each sample."""
+    fams: Dict[str, Dict] = {}
+    cur = None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, _, help_text = line[7:].partition(" ")
+            cur = fams.setdefault(name, {"help": help_text, "type": "untyped", "samples": []})
+        elif line.startswith("# TYPE ") and cur is not None:
+            cur["type"] = line[7:].partition(" ")[2]
+        elif line and not line.startswith("#") and cur is not None:
+            cur["samples"].append(_with_label(line, label))
+    return fams
+
+
+REGISTRY = Registry()
+
+# ---------------- SCHEDULER INSTRUMENTATION ----------------
+_schedulers: "weakref.WeakSet" = weakref.WeakSet()
+
+
+def _messages_in(job) -> int:
+    # batch jobs (see dispatch.plan_batches) carry their messages in args[0]["jobs"]
+    try:
+        first = job.args[0]
+        if isinstance(first, dict) and isinstance(first.get("jobs"), list):
+            return len(first["jobs"])
+    except Exception:
+        pass
+    return 1
+
+
+def _pending_jobs() -> float:
+    total = 0
+    for s in list(_schedulers):
+        try:
+            total += sum(_messages_in(j) for j in s.get_jobs())
+        except Exception:
+            pass
+    return total
+
+
+def _due_within() -> Dict[Tuple[str, ...], float]:
+    now = datetime.now().astimezone()
+    counts = {(str(w),): 0 for w in DUE_WINDOWS_MINUTES}
+    for s in list(_schedulers):
+        try:
+            jobs = s.get_jobs()
+        except Exception:
+            continue
+        for job in jobs:
+            nrt = getattr(job, "next_run_time", None)
+            if nrt is None:
+                continue
+            for w in DUE_WINDOWS_MINUTES:
+                if nrt <= now + timedelta(minutes=w):
+                    counts[(str(w),)] += _messages_in(job)
+    return counts
+
+
+_busy: Dict[str, int] = {}  # lane -> job functions running on its executor (see busy_worker)
+
+
+def busy_worker(lane_of: Callable[..., str]):
+    """Decorator for scheduled job functions: counts them as running on lane_of(*args)'s executor."""
+    def wrap(fn):
+        @functools.wraps(fn)  # same name: APScheduler stores jobs by module:function reference
+        def run(*args, **kwargs):
+            lane = lane_of(*args)
+            with _lock:
+                _busy[lane] = _busy.get(lane, 0) + 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with _lock:
+                    _busy[lane] -= 1
+        return run
+    return wrap
+
+
+def _executor_busy() -> Dict[Tuple[str, ...], float]:
+    import dispatch
+    with _lock:
+        return {(lane,): _busy.get(lane, 0) for lane in dispatch.LANES}
+
+
+def _executor_capacity() -> Dict[Tuple[str, ...], float]:
+    import dispatch  # every scheduler is built with dispatch.lane_executors()
+    n = len(_schedulers)
+    return {(lane,): dispatch.LANE_WORKERS[lane] * n for lane in dispatch.LANES}
+
+
+def _executor_saturation() -> Dict[Tuple[str, ...], float]:
+    cap = _executor_capacity()
+    return {k: (v / cap[k]) if cap[k] else 0.0 for k, v in _executor_busy().items()}
+
+
+def _lane_depth(kind: str):
+    def read() -> Dict[Tuple[str, ...], float]:
+        import dispatch
+        import job_index
+        depths = job_index.INDEX.lane_depths()
+        return {(lane,): depths.get(lane, {}).get(kind, 0) for lane in dispatch.LANES}
+    return read
+
+
+def _status_buffered() -> float:
+    import status_callbacks
+    return status_callbacks.STORE.pending()
+
+
+def _bus_stat(key: str):
+    def read() -> float:
+        import event_bus
+        return event_bus.BUS.stats()[key]
+    return read
+
+
+def _breaker_states() -> Dict[Tuple[str, ...], float]:
+    import circuit_breaker
+    return {(b.name,): {"closed": 0, "half_open": 1, "open": 2}[b.state] for b in circuit_breaker.all_breakers()}
+
+
+PENDING_JOBS = REGISTRY.register(Gauge(
+    "scheduler_pending_jobs", "Messages waiting in the APScheduler job store (batches expanded).",
+    callback=_pending_jobs))
+JOBS_DUE = REGISTRY.register(Gauge(
+    "scheduler_jobs_due", "Pending messages due within the next N minutes.", labels=("window_minutes",),
+    callback=_due_within))
+EXECUTOR_BUSY = REGISTRY.register(Gauge(
+    "scheduler_executor_busy", "Send jobs running on each priority lane's executor.", labels=("lane",),
+    callback=_executor_busy))
+EXECUTOR_CAPACITY = REGISTRY.register(Gauge(
+    "scheduler_executor_capacity", "Worker threads of each priority lane's executor.", labels=("lane",),
+    callback=_executor_capacity))
+EXECUTOR_SATURATION = REGISTRY.register(Gauge(
+    "scheduler_executor_saturation", "Busy workers / capacity per lane (1.0 = saturated).", labels=("lane",),
+    callback=_executor_saturation))
+LANE_PENDING = REGISTRY.register(Gauge(
+    "scheduler_lane_pending_messages", "Messages not yet sent, per priority lane.", labels=("lane",),
+    callback=_lane_depth("pending")))
+LANE_DUE = REGISTRY.register(Gauge(
+    "scheduler_lane_queue_depth", "Messages past their scheduled time and not yet sent, per priority lane.",
+    labels=("lane",), callback=_lane_depth("due")))
+MISFIRES = REGISTRY.register(Counter(
+    "scheduler_misfires_total", "Jobs dropped because they missed misfire_grace_time."))
+MAX_INSTANCES = REGISTRY.register(Counter(
+    "scheduler_max_instances_total", "Job runs skipped because max_instances was reached."))
+JOB_ERRORS = REGISTRY.register(Counter(
+    "scheduler_job_errors_total", "Jobs that raised out of the job function."))
+SCHEDULED = REGISTRY.register(Counter(
+    "messages_scheduled_total", "Messages added to the scheduler."))
+BATCHES = REGISTRY.register(Counter(
+    "scheduler_batches_total", "Coalesced fan-out batch jobs scheduled."))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "scheduler_batch_size", "Messages per coalesced batch job.", buckets=(2, 10, 100, 1000, 10000, 100000)))
+SENDS = REGISTRY.register(Counter(
+    "messages_sent_total", "Send attempts by outcome.", labels=("outcome",)))
+SEND_LATENCY = REGISTRY.register(Histogram(
+    "whatsapp_send_latency_seconds", "Time spent in the Twilio messages.create call."))
+DISPATCH_DRIFT = REGISTRY.register(Histogram(
+    "scheduler_dispatch_drift_seconds", "Time from a message's scheduled_at to a worker picking it up.",
+    buckets=(0.5, 1, 5, 15, 60, 300, 900, 3600, 14400), labels=("lane",)))
+STATUS_CALLBACKS = REGISTRY.register(Counter(
+    "twilio_status_callbacks_total", "Delivery-status callbacks received by MessageStatus.", labels=("status",)))
+STATUS_BUFFERED = REGISTRY.register(Gauge(
+    "twilio_status_callbacks_buffered", "Status callbacks waiting to be written to disk.",
+    callback=_status_buffered))
+EVENT_SUBSCRIBERS = REGISTRY.register(Gauge(
+    "event_bus_subscribers", "Dashboard sessions subscribed to job events.",
+    callback=_bus_stat("subscribers")))
+EVENTS_DROPPED = REGISTRY.register(Gauge(
+    "event_bus_dropped_events", "Job events discarded from full subscriber buffers (oldest first).",
+    callback=_bus_stat("dropped")))
+BREAKER_STATE = REGISTRY.register(Gauge(
+    "provider_breaker_state", "Twilio account circuit breaker: 0 closed, 1 half-open, 2 open.", labels=("account",),
+    callback=_breaker_states))
+MESSAGES_HELD = REGISTRY.register(Counter(
+    "provider_messages_held_total", "Messages put back on the schedule because the provider breaker was open."))
+SUPPRESSED = REGISTRY.register(Counter(
+    "suppressed_messages_total", "Messages to opted-out numbers dropped, by where they were caught.",
+    labels=("stage",)))
+MEDIA_SERVED = REGISTRY.register(Counter(
+    "media_requests_total", "Stored media files served to Twilio (/media)."))
+SCHEDULER_LEADER = REGISTRY.register(Gauge(
+    "scheduler_is_leader", "1 while this process holds the scheduler leader lock and dispatches."))
+TWILIO_ERRORS = REGISTRY.register(Counter(
+    "twilio_errors_total", "Twilio API errors by error code.", labels=("code",)))
+SENDER_SENDS = REGISTRY.register(Counter(
+    "sender_messages_total", "Send attempts per sender number by outcome.", labels=("sender", "outcome")))
+SENDER_THROTTLES = REGISTRY.register(Counter(
+    "sender_throttled_total", "Rate-limit errors per sender number (sender put in cooldown).", labels=("sender",)))
+SENDER_FAILOVERS = REGISTRY.register(Counter(
+    "sender_failovers_total", "Recipients moved to another sender because theirs was throttled."))
+COALESCED = REGISTRY.register(Counter(
+    "messages_coalesced_total", "Rows folded into another send to the same recipient.", labels=("kind",)))
+INGEST_REQUESTS = REGISTRY.register(Counter(
+    "ingest_api_requests_total", "Bulk ingestion API requests by HTTP status.", labels=("status",)))
+INGEST_ROWS = REGISTRY.register(Counter(
+    "ingest_api_rows_total", "Rows received by the bulk ingestion API.", labels=("outcome",)))
+
+
+def _on_scheduler_event(event):
+    from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+    code = event.code
+    if code == EVENT_JOB_MISSED:
+        MISFIRES.inc()
+    elif code == EVENT_JOB_MAX_INSTANCES:
+        MAX_INSTANCES.inc()
+    elif code == EVENT_JOB_ERROR:
+        JOB_ERRORS.inc()
+
+
+def instrument_scheduler(scheduler):
+    """Attach metric listeners to an APScheduler instance (idempotent)."""
+    from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+    if scheduler in _schedulers:
+        return scheduler
+    scheduler.add_listener(
+        _on_scheduler_event,
+        EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES,
+    )
+    _schedulers.add(scheduler)
+    return scheduler
+
+
+# ---------------- SEND HELPERS ----------------
+def record_send(started: float, outcome: str, error_code: Optional[object] = None):
+    """Record one send attempt; `started` is a time.perf_counter() value."""
+    SEND_LATENCY.observe(time.perf_counter() - started)
+    SENDS.inc(outcome=outcome)
+    if outcome == "failed" and error_code is not None:
+        TWILIO_ERRORS.inc(code=error_code)
+
+
+def record_batch(size: int):
+    BATCHES.inc()
+    BATCH_SIZE.observe(size)
+    SCHEDULED.inc(size)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# ---------------- CROSS-PROCESS SNAPSHOT ----------------
+def write_snapshot(path: str = SNAPSHOT_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(path + ".tmp", path)
+
+
+def start_snapshots(path: str = SNAPSHOT_PATH, interval: float = SNAPSHOT_SECONDS):
+    """Write this process's metrics to path every interval while it is the scheduler leader."""
+    def _run():
+        while True:
+            time.sleep(interval)
+            if SCHEDULER_LEADER.value() != 1:
+                continue
+            try:
+                write_snapshot(path)
+            except Exception as e:
+                print(f"[METRICS] snapshot failed: {type(e).__name__}: {e}")
+
+    t = threading.Thread(target=_run, name="metrics-snapshot", daemon=True)
+    t.start()
+    return t
+
+
+def render_merged(path: str = SNAPSHOT_PATH) -> str:
+    """This process's series (process="web") plus the scheduler leader's last snapshot (process="scheduler")."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        text, age = "", -1.0
+    extra = parse_families(text, 'process="scheduler"')
+    extra["scheduler_metrics_snapshot_age_seconds"] = {
+        "help": "Seconds since the scheduler process last wrote its metrics (-1 = never).",
+        "type": "gauge", "samples": [f"scheduler_metrics_snapshot_age_seconds {_fmt_value(round(age, 1))}"]}
+    return REGISTRY.render(extra, label='process="web"')
@@ -0,0 +1,146 @@
+# report_export.py
+#
+# On-demand log report exports for the dashboard download buttons.
+# Reports are written in chunks straight into an (optionally compressed)
+# file under logs/exports/, named after a signature of their source, so an
+# unchanged log is never serialized twice and nothing is built until a
+# user asks for it.
+
+import csv
+import gzip
+import hashlib
+import io
+import os
+from typing import Dict, Iterable, List, Optional
+
+try:
+    import zstandard as zstd
+    _HAS_ZSTD = True
+except Exception:
+    _HAS_ZSTD = False
+
+EXPORTS_DIR = os.path.join("logs", "exports")
+CHUNK_SIZE = 1 << 16
+MAX_EXPORTS = 30  # oldest cached artifacts beyond this are deleted
+
+# name -> (file suffix, mime type)
+FORMATS: Dict[str, tuple] = {
+    "csv": ("", "text/csv"),
+    "gzip": (".gz", "application/gzip"),
+}
+if _HAS_ZSTD:
+    FORMATS["zstd"] = (".zst", "application/zstd")
+
+
+# ---------------- SIGNATURES ----------------
+def file_signature(path: str) -> str:
+    st = os.stat(path)
+    return _digest(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def rows_signature(name: str, rows: List[Dict]) -> str:
+    # log lists only grow (or get replaced on "Clear Logs"), so identity + length + last row is enough
+    last = repr(rows[-1]) if rows else ""
+    return _digest(name, id(rows), len(rows), last)
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1("\x1f".join(map(str, parts)).encode("utf-8")).hexdigest()[:16]
+
+
+def export_path(name: str, signature: str, fmt: str) -> str:
+    base = os.path.splitext(os.path.basename(name))[0]
+    return os.path.join(EXPORTS_DIR, f"{base}_{signature}.csv{FORMATS[fmt][0]}")
+
+
+def mime_type(fmt: str) -> str:
+    return FORMATS[fmt][1]
+
+
+# ---------------- WRITERS ----------------
+def _open_sink(path: str, fmt: str):
+    raw = open(path + ".part", "wb")
+    if fmt == "gzip":
+        return raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+    if fmt == "zstd":
+        return raw, zstd.ZstdCompressor(level=6).stream_writer(raw, closefd=False)
+    return raw, raw
+
+
+def _finish(path: str, raw, sink, ok: bool):
+    if sink is not raw:
+        sink.close()
+    raw.close()
+    if ok:
+        os.replace(path + ".part", path)
+        _prune()
+    else:
+        os.remove(path + ".part")
+
+
+def _prune(keep: int = MAX_EXPORTS):
+    try:
+        files = [os.path.join(EXPORTS_DIR, f) for f in os.listdir(EXPORTS_DIR) if not f.endswith(".part")]
+        files.sort(key=os.path.getmtime, reverse=True)
+        for old in files[keep:]:
+            os.remove(old)
+    except OSError:
+        pass
+
+
+def export_file(src_path: str, fmt: str = "csv") -> str:
+    """Copy a CSV log into the export cache (compressed per fmt), chunk by chunk."""
+    path = export_path(src_path, file_signature(src_path), fmt)
+    if os.path.exists(path):
+        return path
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    raw, sink = _open_sink(path, fmt)
+    ok = False
+    try:
+        with open(src_path, "rb") as src:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                sink.write(chunk)
+        ok = True
+    finally:
+        _finish(path, raw, sink, ok)
+    return path
+
+
+def export_rows(name: str, rows: List[Dict], fmt: str = "csv") -> str:
+    """Write log rows (list of dicts) as CSV into the export cache, buffering one chunk at a time."""
+    path = export_path(name, rows_signature(name, rows), fmt)
+    if os.path.exists(path):
+        return path
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    fields = _fieldnames(rows)
+    raw, sink = _open_sink(path, fmt)
+    ok = False
+    try:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            if buf.tell() >= CHUNK_SIZE:
+                sink.write(buf.getvalue().encode("utf-8"))
+                buf.seek(0)
+                buf.truncate()
+        sink.write(buf.getvalue().encode("utf-8"))
+        ok = True
+    finally:
+        _finish(path, raw, sink, ok)
+    return path
+
+
+def _fieldnames(rows: Iterable[Dict]) -> List[str]:
+    seen: Dict[str, None] = {}
+    for r in rows:
+        for k in r:
+            seen.setdefault(k, None)
+    return list(seen)
+
+
+def current_export(name: str, signature: str, fmt: str) -> Optional[str]:
+    """Path of an already generated export for this exact source state, if any."""
+    path = export_path(name, signature, fmt)
+    return path if os.path.exists(path) else None
@@ -6,10 +6,13 @@ from dateutil import tz
 from datetime import datetime
 import time
 
+import message_templates
+
 # ========= Config =========
 CSV_PATH = "messages.csv"
 TIMEZONE = tz.gettz("Asia/Kolkata")
 DRY_RUN = True  # start True to only log; set to False to actually send
+MESSAGE_TEMPLATE = os.environ.get("MESSAGE_TEMPLATE", "{message}")  # any {column} of the CSV
 
 # Twilio creds
 ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
@@ -29,12 +32,13 @@ def send_whatsapp(to_number: str, body: str):
     )
     print(f"[SENT] {to_number} SID={msg.sid}")
 
-def schedule_messages(rows):
+def schedule_messages(rows, template=None):
     sched = BlockingScheduler(timezone=TIMEZONE)
+    template = template or message_templates.compile_template(MESSAGE_TEMPLATE, rows.columns)
 
     for idx, row in rows.iterrows():
         phone = str(row["phone"]).strip()
-        body  = str(row["message"])
+        body  = template.render(row)
         send_at_str = str(row["send_at"]).strip()
 
         # parse time as IST
@@ -81,9 +85,13 @@ def schedule_messages(rows):
 def main():
     # Load CSV
     df = pd.read_csv(CSV_PATH)
-    required = {"phone", "message", "send_at"}
+    required = {"phone", "send_at"}
     if not required.issubset(df.columns):
         raise RuntimeError(f"CSV must have columns: {required}. Found: {list(df.columns)}")
+    try:
+        template = message_templates.compile_template(MESSAGE_TEMPLATE, df.columns)
+    except message_templates.TemplateError as e:
+        raise RuntimeError(str(e)) from e
 
     # Coerce send_at to datetime if possible
     try:
@@ -96,7 +104,7 @@ def main():
     print(df.head())
     print("===============")
 
-    schedule_messages(df)
+    schedule_messages(df, template)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,178 @@
+# schema_inference.py
+#
+# Column-role inference for uploads. A sample of the file is profiled once
+# (header names + cell shapes) and every column gets at most one role
+# (phone, name, media, datetime, date, time, message, priority) with a
+# confidence score. Results are cached on disk by header signature, so a
+# recurring export with the same layout skips inference; a mapping saved
+# from the UI overrides the inferred one for that layout.
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+import pandas as pd
+from dateutil import parser as date_parser
+
+import dispatch
+
+ROLES = ("phone", "name", "media", "datetime", "date", "time", "message", "priority")
+SCHEMA_CACHE_PATH = os.path.join("logs", "schemas.json")
+SAMPLE_ROWS = 200
+MIN_CONFIDENCE = 0.35
+HEADER_WEIGHT = 0.4  # rest comes from the sampled values
+
+_PHONE_RE = re.compile(r"^\+?[\d\s\-().]{10,20}$")
+_URL_RE = re.compile(r"^https?://", re.IGNORECASE)
+_TIME_RE = re.compile(r"^\d{1,2}[:.]\d{2}(:\d{2})?\s*([ap]\.?\s?m\.?)?$", re.IGNORECASE)
+_HAS_TIME_RE = re.compile(r"\d{1,2}:\d{2}")
+_DATE_LIKE_RE = re.compile(r"\d{1,4}[-/.\s]\d{1,2}[-/.\s]\d{1,4}|\d{1,2}\s+[A-Za-z]{3,}|[A-Za-z]{3,}\s+\d{1,2}")
+
+
+# ---------------- SIGNATURE ----------------
+def header_signature(columns) -> str:
+    norm = "\x1f".join(str(c).strip().lower() for c in columns)
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest()[:16]
+
+
+# ---------------- SCORING ----------------
+def _header_score(col: str, candidates: List[str]) -> float:
+    c = str(col).strip().lower()
+    if c in candidates:
+        return 1.0
+    return 0.7 if any(cand in c for cand in candidates) else 0.0
+
+
+def _parses_as_date(s: str) -> bool:
+    try:
+        date_parser.parse(s, dayfirst=True)
+        return True
+    except Exception:
+        return False
+
+
+def _value_scores(values: List[str]) -> Dict[str, float]:
+    """Fraction of non-empty sample cells that look like each role."""
+    n = len(values)
+    if not n:
+        return {}
+    phone = sum(1 for v in values if _PHONE_RE.match(v) and 10 <= sum(ch.isdigit() for ch in v) <= 15)
+    url = sum(1 for v in values if _URL_RE.match(v))
+    times = sum(1 for v in values if _TIME_RE.match(v))
+    datish = [v for v in values[:50] if _DATE_LIKE_RE.search(v) and _parses_as_date(v)]
+    date_frac = len(datish) / min(n, 50)
+    with_time = sum(1 for v in datish if _HAS_TIME_RE.search(v)) / min(n, 50)
+    lanes = sum(1 for v in values if dispatch.normalize_lane(v))
+    words = [v for v in values if not any(ch.isdigit() for ch in v)]
+    name_like = sum(1 for v in words if 1 <= len(v.split()) <= 4 and len(v) <= 40)
+    avg_len = sum(len(v) for v in values) / n
+    message_like = sum(1 for v in values if len(v) >= 15 and " " in v)
+    return {
+        "phone": phone / n,
+        "media": url / n,
+        "time": times / n,
+        "datetime": with_time,
+        "date": max(0.0, date_frac - with_time),
+        "priority": lanes / n,
+        "name": name_like / n if avg_len <= 40 else 0.0,
+        "message": message_like / n,
+    }
+
+
+def infer(df: pd.DataFrame, role_candidates: Dict[str, List[str]], sample_rows: int = SAMPLE_ROWS) -> Dict:
+    """Score every (role, column) pair on a head sample and assign roles greedily."""
+    sample = df.head(sample_rows)
+    scored = []
+    for col in df.columns:
+        values = [str(v).strip() for v in sample[col].tolist() if pd.notna(v) and str(v).strip()]
+        by_value = _value_scores(values)
+        for role in ROLES:
+            score = HEADER_WEIGHT * _header_score(col, role_candidates.get(role, [])) + \
+                (1 - HEADER_WEIGHT) * by_value.get(role, 0.0)
+            if score >= MIN_CONFIDENCE:
+                scored.append((score, role, col))
+
+    roles: Dict[str, Optional[str]] = {r: None for r in ROLES}
+    confidence: Dict[str, float] = {r: 0.0 for r in ROLES}
+    used = set()
+    for score, role, col in sorted(scored, key=lambda x: -x[0]):
+        if roles[role] is None and col not in used:
+            roles[role], confidence[role] = col, round(score, 2)
+            used.add(col)
+    if roles["datetime"] is not None and roles["date"] is not None and \
+            confidence["date"] < confidence["datetime"]:
+        roles["date"], confidence["date"] = None, 0.0  # one full timestamp column is enough
+    return {"signature": header_signature(df.columns), "roles": roles, "confidence": confidence,
+            "source": "inferred"}
+
+
+# ---------------- CACHE ----------------
+_cache: Dict[str, Dict] = {}
+_cache_mtime = [None]
+_cache_lock = threading.Lock()
+
+
+def _load_cache(path: str):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return
+    if mtime == _cache_mtime[0]:
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            _cache.update(json.load(f))
+        _cache_mtime[0] = mtime
+    except (OSError, ValueError):
+        pass
+
+
+def _save_cache(path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_cache, f, indent=1)
+    os.replace(tmp, path)
+    _cache_mtime[0] = os.path.getmtime(path)
+
+
+def get_schema(df: pd.DataFrame, role_candidates: Dict[str, List[str]], profile=None,
+               path: str = SCHEMA_CACHE_PATH) -> Dict:
+    """Cached schema for df's header, inferring (and caching) it on first sight."""
+    sig = header_signature(df.columns)
+    with _cache_lock:
+        _load_cache(path)  # picks up mappings saved by other processes / the UI
+        hit = _cache.get(sig)
+    # the signature ignores case and padding: map cached roles onto this file's spelling of the headers
+    actual = {str(c).strip().lower(): c for c in df.columns}
+    if hit is not None and all(c is None or str(c).strip().lower() in actual for c in hit["roles"].values()):
+        if profile is not None:
+            profile.count("schema_cache_hit")
+        return {**hit, "roles": {r: None if c is None else actual[str(c).strip().lower()]
+                                 for r, c in hit["roles"].items()}}
+    if profile is not None:
+        with profile.stage("schema_inference"):
+            schema = infer(df, role_candidates)
+    else:
+        schema = infer(df, role_candidates)
+    with _cache_lock:
+        _cache[sig] = schema
+        try:
+            _save_cache(path)
+        except OSError:
+            pass
+    return schema
+
+
+def save_override(signature: str, roles: Dict[str, Optional[str]], path: str = SCHEMA_CACHE_PATH) -> Dict:
+    """Store a user-confirmed mapping for this header layout (wins over inference)."""
+    with _cache_lock:
+        _load_cache(path)
+        schema = {"signature": signature, "roles": {r: roles.get(r) for r in ROLES},
+                  "confidence": {r: 1.0 if roles.get(r) else 0.0 for r in ROLES}, "source": "user"}
+        _cache[signature] = schema
+        _save_cache(path)
+    return schema
@@ -1,67 +1,254 @@
-import pandas as pd
-from twilio.rest import Client
+# send_whatsapp.py
+#
+# Resumable bulk sender for a recipients file (CSV / Excel), sending now
+# (scheduled times are ignored). Rows are parsed with the same rules as the
+# uploader (phone normalisation, media column, message column / template)
+# and sent with a thread pool under a rate limit. Progress is checkpointed
+# per row (see checkpoint.py): kill it at any point and run the same command
+# again to continue where it stopped without re-sending anything. Systemic
+# provider errors (revoked credentials, suspended account, sustained 5xx)
+# trip a circuit breaker: sending waits for it instead of failing every row.
+#
+#   python send_whatsapp.py recipients.csv --concurrency 8 --rate 20
+#   python send_whatsapp.py recipients.csv --status            # show checkpoint only
+#
+# Credentials: --sid / --token / --from, or TWILIO_ACCOUNT_SID,
+# TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_FROM in the environment.
+
+import argparse
+import hashlib
+import os
 import re
-
-
-
-
-# Twilio credentials
-TWILIO_WHATSAPP_NUMBER = "whatsapp:8583966708"  # Sandbox number
-ACCOUNT_SID = "ACad148527704f0c316bb2d1888bf83eff"
-AUTH_TOKEN = "841b0cdcc70497c369cb9b4661c6cf73"
-
-client = Client(ACCOUNT_SID, AUTH_TOKEN)
-
-def send_whatsapp_media():
-    try:
-        df = pd.read_csv("recipients.csv", dtype={'mobile_number': str})
-        print("CSV columns:", list(df.columns))
-
-        # Normalize headers (lowercase + no spaces)
-        df.columns = [col.strip().lower().replace(" ", "_") for col in df.columns]
-
-        # Try to find phone column
-        phone_col = None
-        for possible in ["mobile_number", "phone", "number", "contact"]:
-            if possible in df.columns:
-                phone_col = possible
-                break
-
-        if not phone_col:
-            print("❌ No phone number column found! Make sure CSV has one.")
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import checkpoint
+import circuit_breaker
+import dispatch
+import ingest
+import media_store
+import message_templates
+import suppression
+from sender_pool import THROTTLE_CODES
+
+CHECKPOINT_DIR = os.path.join("logs", "send_checkpoints")
+SNAPSHOT_SECONDS = 5.0
+THROTTLE_RETRIES = 5
+
+
+def file_fingerprint(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_jobs(path: str):
+    """Jobs in file order, parsed like an upload (conversion log goes to the temp dir)."""
+    with open(path, "rb") as f:
+        df = ingest.load_table(f)
+    if df is None or df.empty:
+        raise ValueError(f"{path}: no data rows")
+    base = os.path.splitext(os.path.basename(path))[0]
+    # opted-out rows stay in (row numbers must match the checkpoint); they are skipped at send time
+    jobs, _ = ingest.parse_to_jobs(df, base, logs_dir=tempfile.gettempdir(), suppress=False)
+    jobs, media_errors = media_store.STORE.resolve_jobs(jobs)  # local files -> web app /media URLs
+    for err in media_errors.values():
+        print(f"⚠ {err}")
+    return jobs
+
+
+# ---------------- SENDING ----------------
+class BulkSender:
+    def __init__(self, jobs, ckpt: checkpoint.SendCheckpoint, send_fn, concurrency: int = 4,
+                 rate_per_sec: float = 0.0, out=sys.stdout):
+        self.jobs, self.ckpt, self.send_fn = jobs, ckpt, send_fn
+        self.concurrency = max(1, concurrency)
+        self.limiter = dispatch.RateLimiter(rate_per_sec)
+        self.breaker = circuit_breaker.Breaker("bulk")
+        self.out = out
+        self.stop = threading.Event()
+        self.sent = self.failed = self.held = 0
+        self._lock = threading.Lock()
+        self._recent = deque()  # completion times for the rolling rate
+
+    def _send(self, row: int):
+        if self.stop.is_set():
             return
-
-        # Try to find media column
-        media_col = None
-        for possible in ["media_path", "media_url", "file", "url"]:
-            if possible in df.columns:
-                media_col = possible
-                break
-
-        for _, row in df.iterrows():
-            mobile_number = str(row[phone_col]).strip()
-            mobile_number = row['mobile_number'].strip()
-            mobile_number = mobile_number.replace(".0", "")  # quick fix if still float string
-            to_number = f"whatsapp:+{mobile_number}"
-
-            media_url = "https://upload.wikimedia.org/wikipedia/commons/thumb/a/a7/React-icon.svg/1024px-React-icon.svg.png"
-
-            print("Sending media URL:", media_url)  # <-- Add this line here
-
+        job = self.jobs[row]
+        if not re.fullmatch(r"\+\d{8,15}", job.get("mobile_number", "")):
+            self._done(row, checkpoint.FAILED, f"row {row + 1}: invalid phone {job.get('mobile_number')!r}")
+            return
+        if suppression.LIST.contains(job["mobile_number"]):
+            self._done(row, checkpoint.FAILED, f"row {row + 1}: {job['mobile_number']} opted out")
+            return
+        while not self.breaker.allow():  # provider down: the row stays "todo" until a probe succeeds
+            if self.stop.wait(1.0):
+                return
+        self.limiter.acquire()
+        self.ckpt.mark(row, checkpoint.STARTED)
+        error = code = None
+        for attempt in range(THROTTLE_RETRIES + 1):
             try:
-                to_number = f"whatsapp:+{mobile_number}"
-                message = client.messages.create(
-                from_=TWILIO_WHATSAPP_NUMBER,
-                body="Here's your scheduled message!",
-                media_url=[media_url],
-                to=to_number
-                )
-                print(f"✅ Message sent to {mobile_number}. SID: {message.sid}")
+                self.send_fn(job)
+                error = code = None
+                break
             except Exception as e:
-                print(f"❌ Failed to send to {mobile_number}: {e}")
+                error = f"row {row + 1} ({job['mobile_number']}): {e}"
+                code = getattr(e, "code", None) or getattr(e, "status", None) or \
+                    ("transport" if circuit_breaker.is_transport_error(e) else None)
+                if code not in THROTTLE_CODES or attempt == THROTTLE_RETRIES:
+                    break
+                time.sleep(min(60.0, 2.0 ** attempt))  # provider throttling: back off, same row
+        self.breaker.record(code)
+        if error and circuit_breaker.is_systemic(code):
+            self.ckpt.mark(row, checkpoint.TODO)  # not the row's fault: sent by the next run
+            with self._lock:
+                self.held += 1
+            return
+        self._done(row, checkpoint.FAILED if error else checkpoint.DONE, error)
+
+    def _done(self, row: int, state: int, error=None):
+        self.ckpt.mark(row, state)
+        with self._lock:
+            if state == checkpoint.DONE:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._recent.append(time.monotonic())
+        if error:
+            self.out.write(f"\n{error}\n")
+
+    def _progress(self, todo: int, started: float):
+        last_snapshot = time.monotonic()
+        while not self.stop.wait(1.0):
+            self._print(todo, started)
+            if time.monotonic() - last_snapshot >= SNAPSHOT_SECONDS:
+                self.ckpt.snapshot()
+                last_snapshot = time.monotonic()
+
+    def _print(self, todo: int, started: float, end: str = "\r"):
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 10.0:
+                self._recent.popleft()
+            done, recent = self.sent + self.failed, len(self._recent)
+        rate = recent / min(10.0, max(now - started, 1e-6))
+        eta = (todo - done) / rate if rate > 0 else float("inf")
+        eta_s = "-" if eta == float("inf") else time.strftime("%H:%M:%S", time.gmtime(eta))
+        paused = "" if self.breaker.state == circuit_breaker.CLOSED else \
+            f" | PAUSED ({self.breaker.reason}), probe in {self.breaker.stats()['probe_in_s']}s"
+        self.out.write(f"{done}/{todo} this run | sent {self.sent} | failed {self.failed} | "
+                       f"{rate:.1f} msg/s (avg {done / max(now - started, 1e-6):.1f}) | ETA {eta_s}{paused}   {end}")
+        self.out.flush()
+
+    def run(self, rows) -> dict:
+        rows = list(rows)
+        started = time.monotonic()
+        reporter = threading.Thread(target=self._progress, args=(len(rows), started), daemon=True)
+        reporter.start()
+        window = threading.BoundedSemaphore(self.concurrency * 4)  # never queue a million futures
+        try:
+            with ThreadPoolExecutor(self.concurrency, thread_name_prefix="bulk-send") as pool:
+                for row in rows:
+                    while not window.acquire(timeout=0.5):
+                        if self.stop.is_set():
+                            break
+                    if self.stop.is_set():
+                        break
+                    pool.submit(self._send, row).add_done_callback(lambda _: window.release())
+        finally:
+            self.stop.set()  # in-flight rows finish (the pool waits); nothing new starts
+            reporter.join()
+            self._print(len(rows), started, end="\n")
+            self.ckpt.snapshot()
+        return {"sent": self.sent, "failed": self.failed, "held": self.held,
+                "seconds": round(time.monotonic() - started, 1)}
+
+
+def twilio_send_fn(sid: str, token: str, wa_from: str, body=None, media=None):
+    from twilio.rest import Client
+    client = Client(sid, token)
+
+    def send(job):
+        media_url = media or job.get("media_url", "")
+        kwargs = {"media_url": [media_url]} if re.match(r"^https?://", media_url or "", re.IGNORECASE) else {}
+        return client.messages.create(from_=wa_from, to=f"whatsapp:{job['mobile_number']}",
+                                      body=body or message_templates.body_for(job), **kwargs)
+    return send
+
+
+# ---------------- CLI ----------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Send a recipients file now, resumably.")
+    ap.add_argument("path", nargs="?", default="recipients.csv", help="CSV / Excel file (default recipients.csv)")
+    ap.add_argument("--concurrency", type=int, default=4, help="Parallel API calls")
+    ap.add_argument("--rate", type=float, default=0.0, help="Max messages per second (0 = unlimited)")
+    ap.add_argument("--body", help="Send this text instead of the file's message column / greeting")
+    ap.add_argument("--media", help="Attach this public http(s) URL instead of the file's media column")
+    ap.add_argument("--checkpoint", help=f"Checkpoint file (default {CHECKPOINT_DIR}/<file>.<hash>.ckpt)")
+    ap.add_argument("--retry-failed", action="store_true", help="Also resend rows that failed before")
+    ap.add_argument("--retry-uncertain", action="store_true",
+                    help="Also resend rows interrupted mid-call (may duplicate those messages)")
+    ap.add_argument("--status", action="store_true", help="Print checkpoint progress and exit")
+    ap.add_argument("--sid", default=os.environ.get("TWILIO_ACCOUNT_SID", ""), help="Twilio account SID")
+    ap.add_argument("--token", default=os.environ.get("TWILIO_AUTH_TOKEN", ""), help="Twilio auth token")
+    ap.add_argument("--from", dest="wa_from", default=os.environ.get("TWILIO_WHATSAPP_FROM", ""),
+                    help="Sender, e.g. whatsapp:+14155238886")
+    args = ap.parse_args(argv)
+    missing = [f"{flag} / {env}" for flag, env, val in (("--sid", "TWILIO_ACCOUNT_SID", args.sid),
+                                                         ("--token", "TWILIO_AUTH_TOKEN", args.token),
+                                                         ("--from", "TWILIO_WHATSAPP_FROM", args.wa_from))
+               if not val and not args.status]
+    if missing:
+        ap.error("missing Twilio credentials: " + ", ".join(missing))
+
+    if not os.path.exists(args.path):
+        print(f"❌ {args.path} not found!")
+        return 1
+    fingerprint = file_fingerprint(args.path)
+    jobs = load_jobs(args.path)
+    path = args.checkpoint or os.path.join(
+        CHECKPOINT_DIR, f"{os.path.basename(args.path)}.{fingerprint[:12]}.ckpt")
+    try:
+        ckpt = checkpoint.SendCheckpoint(path, len(jobs), fingerprint)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+
+    counts = ckpt.counts()
+    print(f"{args.path}: {len(jobs)} rows | " + ", ".join(f"{k} {v}" for k, v in counts.items())
+          + f" | checkpoint {path}" + (" (resumed)" if ckpt.resumed else ""))
+    if counts["uncertain"] and not args.retry_uncertain:
+        print(f"⚠ {counts['uncertain']} row(s) were mid-send when the last run stopped; they are skipped "
+              "(pass --retry-uncertain to resend them).")
+    if args.status:
+        ckpt.close()
+        return 0
+
+    sender = BulkSender(jobs, ckpt, twilio_send_fn(args.sid, args.token, args.wa_from, args.body, args.media),
+                        concurrency=args.concurrency, rate_per_sec=args.rate)
+    signal.signal(signal.SIGTERM, lambda *_: sender.stop.set())
+    try:
+        result = sender.run(ckpt.rows(args.retry_failed, args.retry_uncertain))
+    except KeyboardInterrupt:
+        sender.stop.set()
+        result = {"sent": sender.sent, "failed": sender.failed, "interrupted": True}
+    ckpt.close()
+    left = ckpt.counts()["todo"]
+    if sender.held:
+        print(f"⚠ {sender.held} row(s) hit provider errors ({sender.breaker.reason or 'see above'}) and were kept "
+              "for the next run.")
+    print(f"✅ sent {result['sent']}, failed {result['failed']}; {left} row(s) left"
+          + (" — run the same command again to resume." if left else "."))
+    return 0
 
-    except FileNotFoundError:
-        print("❌ recipients.csv not found! Make sure the file is in the same folder.")
 
 if __name__ == "__main__":
-    send_whatsapp_media()
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# sender_pool.py
+#
+# Pool of WhatsApp sender numbers (optionally on different Twilio accounts).
+# Each sender has its own lane-aware rate limiter, so throughput scales with
+# the number of senders. A recipient sticks to the sender that first wrote to
+# them; new recipients go to the sender whose next token is free soonest.
+# A throttled sender cools down and its message fails over to another one.
+# Senders on an account whose circuit breaker is open are skipped; when no
+# sender may call, send() returns a "held" outcome instead of failing.
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import circuit_breaker
+import dispatch
+import metrics
+
+# Twilio: 20429 = too many requests, 63018 = WhatsApp sender rate limit exceeded
+THROTTLE_CODES = {20429, 63018, 429}
+COOLDOWN_SECONDS = 30.0
+MAX_COOLDOWN_SECONDS = 600.0
+
+# recipient -> sender number; shared by every pool so edits to the pool keep conversations in place
+_sticky: Dict[str, str] = {}
+_recipients: Dict[str, int] = {}  # sender number -> recipients stuck to it
+_sticky_lock = threading.Lock()
+
+
+class Sender:
+    def __init__(self, account_sid: str, auth_token: str, from_number: str, delay_seconds: float):
+        self.account_sid, self.auth_token, self.from_number = account_sid, auth_token, from_number
+        self.delay_seconds = delay_seconds
+        self._client = None
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.cooldown_until = 0.0
+        self._cooldown = COOLDOWN_SECONDS
+
+    @property
+    def client(self):
+        if self._client is None:
+            from twilio.rest import Client
+            self._client = Client(self.account_sid, self.auth_token)
+        return self._client
+
+    def limiter(self, lane: str):
+        return dispatch.lane_limiter(lane, self.delay_seconds, key=f"sender:{self.from_number}")
+
+    @property
+    def breaker(self) -> circuit_breaker.Breaker:
+        return circuit_breaker.get(self.account_sid)
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until and not self.breaker.is_open(now)
+
+    def next_free_in(self, lane: str) -> float:
+        return self.limiter(lane).next_free_in()
+
+
+class SenderPool:
+    def __init__(self, senders: List[Sender], clock: Callable[[], float] = time.time):
+        if not senders:
+            raise ValueError("sender pool needs at least one sender")
+        self.senders = senders
+        self.by_number = {s.from_number: s for s in senders}
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.failovers = 0
+
+    # ---------------- ROUTING ----------------
+    def assign(self, job: Dict, exclude: Sequence[str] = ()) -> Optional[Sender]:
+        """Sender for this recipient: its sticky sender if usable, else the least loaded one."""
+        now = self.clock()
+        mobile = job.get("mobile_number", "")
+        with _sticky_lock:
+            current = self.by_number.get(_sticky.get(mobile, ""))
+        if current is not None and current.from_number not in exclude and current.available(now):
+            return current
+
+        lane = dispatch.job_lane(job)
+        candidates = [s for s in self.senders if s.from_number not in exclude and s.available(now)]
+        if not candidates:
+            if exclude:
+                return None
+            # every sender is cooling down: use the one that recovers first
+            candidates = [min(self.senders, key=lambda s: s.cooldown_until)]
+        with _sticky_lock:
+            # expected wait: time to the sender's next token plus one pacing slot per recipient it already owns
+            best = min(candidates, key=lambda s: (
+                s.next_free_in(lane) + _recipients.get(s.from_number, 0) * s.delay_seconds, s.in_flight))
+            if current is not None:
+                _recipients[current.from_number] -= 1
+            _sticky[mobile] = best.from_number
+            _recipients[best.from_number] = _recipients.get(best.from_number, 0) + 1
+        if current is not None and best is not current:
+            with self._lock:
+                self.failovers += 1
+            metrics.SENDER_FAILOVERS.inc()
+        return best
+
+    def limiter_for(self, job: Dict):
+        """Per-job limiter for dispatch.iter_batch: the assigned sender's lane bucket."""
+        return self.assign(job).limiter(dispatch.job_lane(job))
+
+    @contextmanager
+    def _track(self, sender: Sender):
+        with self._lock:
+            sender.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                sender.in_flight -= 1
+
+    def send(self, job: Dict, send_fn: Callable[[Sender, bool], Dict]) -> Dict:
+        """
+        Send via the job's sender (the rate token is taken by the caller).
+        send_fn(sender, may_retry) -> outcome dict. On a throttling error the
+        sender cools down and the message is retried once per remaining sender.
+        A failure send_fn skipped logging (may_retry) but that was not retried
+        after all comes back with "unlogged": True.
+        Returns {"status": "held"} without calling when no remaining sender's
+        account breaker allows calls, and after a systemic error (see circuit_breaker).
+        """
+        lane = dispatch.job_lane(job)
+        tried: List[str] = []
+        sender = self.assign(job)
+        while True:
+            tried.append(sender.from_number)
+            now = self.clock()  # a retry needs a sender that could take the message right now
+            may_retry = any(s.from_number not in tried and s.available(now) for s in self.senders)
+            if not sender.breaker.allow():
+                # half-open with its probe in flight (or just tripped): other accounts may be fine
+                nxt = self.assign(job, exclude=tried) if may_retry else None
+                if nxt is None:
+                    return {"status": "held", "sender": sender.from_number, "reason": sender.breaker.reason}
+                nxt.limiter(lane).acquire()
+                sender = nxt
+                continue
+            with self._track(sender):
+                res = send_fn(sender, may_retry) or {}
+            outcome = res.get("status", "failed")
+            sender.breaker.record(None if outcome == "delivered" else res.get("code"))
+            if outcome != "delivered" and circuit_breaker.is_systemic(res.get("code")):
+                # provider / account trouble: another sender (account) may be fine, else hold the message
+                nxt = self.assign(job, exclude=tried) if may_retry else None
+                if nxt is None:
+                    return {**res, "status": "held", "sender": sender.from_number}
+                nxt.limiter(lane).acquire()
+                sender = nxt
+                continue
+            metrics.SENDER_SENDS.inc(sender=sender.from_number, outcome=outcome)
+            if res.get("code") not in THROTTLE_CODES:
+                with self._lock:
+                    if outcome == "delivered":
+                        sender.sent += 1
+                        sender._cooldown = COOLDOWN_SECONDS
+                    else:
+                        sender.failed += 1
+                return {**res, "sender": sender.from_number}
+
+            self._throttle(sender)
+            nxt = self.assign(job, exclude=tried) if may_retry else None
+            if nxt is None:
+                with self._lock:
+                    sender.failed += 1
+                # send_fn was told a retry would follow and did not log the failure: the caller must
+                return {**res, "sender": sender.from_number, "unlogged": may_retry}
+            nxt.limiter(lane).acquire()
+            sender = nxt
+
+    def blocked(self) -> bool:
+        """Every sender's account breaker is open: hold messages rather than route them."""
+        now = self.clock()
+        return all(s.breaker.is_open(now) for s in self.senders)
+
+    def hold_until(self, due_ts: float) -> float:
+        """When a held message (originally due at due_ts) should be retried: after the first breaker to probe."""
+        tripped = [s.breaker for s in self.senders if s.breaker.state != circuit_breaker.CLOSED]
+        if not tripped:
+            return self.clock() + 5.0  # lost a half-open probe race; try again shortly
+        return min(tripped, key=lambda b: b.open_until).hold_until(due_ts)
+
+    def _throttle(self, sender: Sender):
+        with self._lock:
+            sender.throttled += 1
+            sender.cooldown_until = self.clock() + sender._cooldown
+            sender._cooldown = min(MAX_COOLDOWN_SECONDS, sender._cooldown * 2)
+        metrics.SENDER_THROTTLES.inc(sender=sender.from_number)
+
+    # ---------------- STATS ----------------
+    def stats(self) -> List[Dict]:
+        now = self.clock()
+        with _sticky_lock:
+            recipients = dict(_recipients)
+        return [{
+            "sender": s.from_number,
+            "sent": s.sent,
+            "failed": s.failed,
+            "throttled": s.throttled,
+            "in_flight": s.in_flight,
+            "recipients": recipients.get(s.from_number, 0),
+            "cooling_down_s": round(max(0.0, s.cooldown_until - now)),
+        } for s in self.senders]
+
+
+# ---------------- PROCESS-WIDE POOLS ----------------
+_pools: Dict[Tuple, SenderPool] = {}
+_pools_lock = threading.Lock()
+_tokens: Dict[Tuple[str, str], str] = {}  # (account_sid, from_number) -> auth token known to this process
+
+
+def remember_credentials(configs: Sequence[Tuple[str, str, str]]):
+    """Make senders configured in this process resolvable by reference (see resolve_refs)."""
+    with _pools_lock:
+        for sid, tok, frm in configs:
+            if sid and tok and frm:
+                _tokens[(sid, frm)] = tok
+
+
+def config_refs(configs) -> List[List[str]]:
+    """Sender configs without their tokens: [[account_sid, from_number], ...] (safe to write to disk)."""
+    if configs and isinstance(configs[0], str):  # a single (sid, token, from)
+        configs = (configs,)
+    return [[sid, frm] for sid, _tok, frm in configs]
+
+
+def resolve_refs(refs: Sequence[Sequence[str]]) -> Tuple[Tuple[str, str, str], ...]:
+    """
+    Back from config_refs() to ((sid, token, from), ...) using credentials entered in
+    this process or TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN. LookupError when unknown.
+    """
+    env_sid = os.environ.get("TWILIO_ACCOUNT_SID", "")
+    out = []
+    for sid, frm in refs:
+        with _pools_lock:
+            tok = _tokens.get((sid, frm)) or next((t for (s, _f), t in _tokens.items() if s == sid), "")
+        if not tok and sid == env_sid:
+            tok = os.environ.get("TWILIO_AUTH_TOKEN", "")
+        if not tok:
+            raise LookupError(f"no auth token in this process for account {sid} ({frm})")
+        out.append((sid, tok, frm))
+    return tuple(out)
+
+
+def get_pool(configs: Sequence[Tuple[str, str, str]], delay_seconds: float) -> SenderPool:
+    """
+    Pool for ((account_sid, auth_token, from_number), ...). Pools (and their
+    counters) are reused across sessions; delay_seconds paces each sender.
+    """
+    key = tuple(configs)
+    remember_credentials(key)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SenderPool([Sender(sid, tok, frm, delay_seconds) for sid, tok, frm in key])
+    for s in pool.senders:
+        s.delay_seconds = delay_seconds
+    return pool
+
+
+def active_pools() -> List[SenderPool]:
+    with _pools_lock:
+        return list(_pools.values())
+
+
+def parse_pool_config(text: str, default_sid: str, default_token: str) -> List[Tuple[str, str, str]]:
+    """
+    Extra senders, one per line: `whatsapp:+1415...` (same account) or
+    `whatsapp:+1415..., ACxxxxxxxx, auth_token`. Raises ValueError on a bad line.
+    """
+    out = []
+    for n, line in enumerate((text or "").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [p.strip() for p in line.split(",")]
+        if len(parts) == 1:
+            frm, sid, tok = parts[0], default_sid, default_token
+        elif len(parts) == 3:
+            frm, sid, tok = parts
+        else:
+            raise ValueError(f"line {n}: expected 'whatsapp:+NUMBER' or 'whatsapp:+NUMBER, ACCOUNT_SID, AUTH_TOKEN'")
+        if not frm.startswith("whatsapp:"):
+            raise ValueError(f"line {n}: sender must start with 'whatsapp:'")
+        out.append((sid, tok, frm))
+    return out
@@ -0,0 +1,207 @@
+# simulator.py
+#
+# Accelerated-clock dry run of a parsed schedule.
+# Replays jobs through the real dispatch code (plan_batches, RateLimiter,
+# iter_batch) on a virtual clock with a fake sender, modelling the
+# APScheduler thread pool and its misfire rule for single-row jobs.
+# With lane_workers, each priority lane gets its own pool and rate share.
+#
+#   python simulator.py recipients.csv --delay 1 --workers 10 --window 60
+
+import argparse
+import bisect
+import heapq
+import itertools
+import json
+import tempfile
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import coalesce
+import dispatch
+from ingest import IST
+
+DEFAULT_WORKERS = 10  # APScheduler BackgroundScheduler default thread pool
+
+
+class VirtualClock:
+    def __init__(self, start: float):
+        self.now = float(start)
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        # Only used if something calls limiter.acquire() directly; the event loop
+        # normally advances time itself.
+        self.now += max(0.0, seconds)
+
+
+def simulate(jobs: List[Dict], delay_seconds: float = 1.0, workers: int = DEFAULT_WORKERS,
+             batch_window_seconds: float = dispatch.BATCH_WINDOW_SECONDS,
+             misfire_grace_seconds: Optional[float] = dispatch.MISFIRE_GRACE_SECONDS,
+             api_latency_seconds: float = 0.3, start: Optional[float] = None,
+             backlog_points: int = 500, lane_workers: Optional[Dict[str, int]] = None) -> Dict:
+    """
+    Predict when every job would be sent. Returns a report dict with
+    per-job send times, backlog over time, misfires and lateness stats.
+    lane_workers ({lane: threads}) models the priority-lane executors and
+    LaneLimiter; without it every job shares one pool of `workers`.
+    """
+    if not jobs:
+        return _report([], [], [], 0, 0.0)
+
+    first_due = min(j["scheduled_at"].timestamp() for j in jobs)
+    clock = VirtualClock(start if start is not None else first_due)
+    if lane_workers:
+        lanes = dispatch.LaneLimiter.from_delay(delay_seconds, clock=clock, sleep=clock.sleep)
+        pool_of = lambda b: b["lane"]  # noqa: E731
+        limiter_of = lambda b: lanes.lane(b["lane"])  # noqa: E731
+        capacity = {lane: max(1, int(lane_workers.get(lane, 1))) for lane in dispatch.LANES}
+    else:
+        limiter = dispatch.RateLimiter.from_delay(delay_seconds, clock=clock, sleep=clock.sleep)
+        pool_of = lambda b: "all"  # noqa: E731
+        limiter_of = lambda b: limiter  # noqa: E731
+        capacity = {"all": max(1, int(workers))}
+
+    sends: List[Dict] = []
+    misfires: List[Dict] = []
+
+    def fake_send(job):
+        due = job["scheduled_at"].timestamp()
+        sends.append({"job_id": job["job_id"], "mobile_number": job.get("mobile_number", ""),
+                      "lane": dispatch.job_lane(job), "due": due, "sent": clock.now, "lateness_s": max(0.0, clock.now - due)})
+        return {"status": "delivered"}
+
+    seq = itertools.count()
+    events = []  # (time, seq, kind, payload)
+    for b in dispatch.plan_batches(jobs, batch_window_seconds):
+        grace = misfire_grace_seconds if len(b["jobs"]) == 1 else None
+        heapq.heappush(events, (b["scheduled_at"].timestamp(), next(seq), "due", (b, grace)))
+
+    queues = {p: deque() for p in capacity}
+    free = dict(capacity)
+    peak_busy = 0
+
+    def advance(pool, steps):
+        try:
+            kind, value = next(steps)
+        except StopIteration:
+            free[pool] += 1
+            start_ready(pool)
+            return
+        wait = api_latency_seconds if kind == "sent" else value
+        heapq.heappush(events, (clock.now + wait, next(seq), "resume", (pool, steps)))
+
+    def start_ready(pool):
+        nonlocal peak_busy
+        queue = queues[pool]
+        while free[pool] > 0 and queue:
+            b, grace = queue.popleft()
+            run_time = b["scheduled_at"].timestamp()
+            if grace is not None and clock.now - run_time > grace:
+                for j in b["jobs"]:
+                    misfires.append({"job_id": j["job_id"], "due": run_time, "at": clock.now})
+                continue
+            free[pool] -= 1
+            peak_busy = max(peak_busy, sum(capacity.values()) - sum(free.values()))
+            advance(pool, dispatch.iter_batch(b, fake_send, limiter_of(b), clock))
+
+    while events:
+        t, _, kind, payload = heapq.heappop(events)
+        clock.now = max(clock.now, t)
+        if kind == "due":
+            pool = pool_of(payload[0])
+            queues[pool].append(payload)
+            start_ready(pool)
+        else:
+            advance(*payload)
+
+    return _report(jobs, sends, misfires, peak_busy, clock.now, backlog_points)
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, IST).isoformat(timespec="seconds")
+
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    i = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return sorted_vals[i]
+
+
+def _report(jobs, sends, misfires, peak_busy, end, backlog_points=500) -> Dict:
+    dues = sorted(j["scheduled_at"].timestamp() for j in jobs)
+    done = sorted([s["sent"] for s in sends] + [m["at"] for m in misfires])
+    lateness = sorted(s["lateness_s"] for s in sends)
+    by_lane: Dict[str, List[float]] = {}
+    for s in sends:
+        by_lane.setdefault(s["lane"], []).append(s["lateness_s"])
+
+    backlog = []
+    if dues:
+        t0, t1 = dues[0], max(end, dues[-1])
+        step = max(1.0, (t1 - t0) / max(1, backlog_points))
+        t = t0
+        while t <= t1 + step:
+            pending = bisect.bisect_right(dues, t) - bisect.bisect_right(done, t)
+            backlog.append({"time": _iso(t), "backlog": max(0, pending)})
+            t += step
+
+    return {
+        "messages": len(jobs),
+        "sent": len(sends),
+        "misfires": len(misfires),
+        "max_lateness_s": lateness[-1] if lateness else 0.0,
+        "p50_lateness_s": _percentile(lateness, 0.50),
+        "p95_lateness_s": _percentile(lateness, 0.95),
+        "peak_backlog": max((b["backlog"] for b in backlog), default=0),
+        "peak_busy_workers": peak_busy,
+        "lanes": {lane: {"sent": len(v), "max_lateness_s": max(v),
+                         "p95_lateness_s": _percentile(sorted(v), 0.95)} for lane, v in by_lane.items()},
+        "last_send_at": _iso(max(s["sent"] for s in sends)) if sends else "",
+        "sends": [{**s, "due": _iso(s["due"]), "sent": _iso(s["sent"])} for s in sends],
+        "misfired": [{**m, "due": _iso(m["due"]), "at": _iso(m["at"])} for m in misfires],
+        "backlog": backlog,
+    }
+
+
+def main():
+    import ingest
+
+    ap = argparse.ArgumentParser(description="Simulate a schedule on a virtual clock.")
+    ap.add_argument("path", help="CSV / Excel upload to replay")
+    ap.add_argument("--delay", type=float, default=1.0, help="Delay between messages (seconds)")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    ap.add_argument("--window", type=float, default=dispatch.BATCH_WINDOW_SECONDS,
+                    help="Batch window in seconds (0 = identical times only)")
+    ap.add_argument("--latency", type=float, default=0.3, help="Simulated API call time (seconds)")
+    ap.add_argument("--lanes", action="store_true", help="Model the priority-lane executors (LANE_WORKERS)")
+    ap.add_argument("--coalesce", type=float, default=0.0,
+                    help="Per-recipient coalescing window in seconds (0 = off)")
+    ap.add_argument("--json", action="store_true", help="Print the full report as JSON")
+    args = ap.parse_args()
+
+    with open(args.path, "rb") as f:
+        df = ingest.load_table(f)
+    jobs, _ = ingest.parse_to_jobs(df, "simulation", logs_dir=tempfile.gettempdir())
+    jobs, coalesced = coalesce.coalesce_recipients(jobs, args.coalesce)
+    report = simulate(jobs, args.delay, args.workers, args.window, api_latency_seconds=args.latency,
+                      lane_workers=dispatch.LANE_WORKERS if args.lanes else None)
+    report["coalescing"] = coalesced
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+        return
+    for k in ("messages", "sent", "misfires", "max_lateness_s", "p50_lateness_s", "p95_lateness_s",
+              "peak_backlog", "peak_busy_workers", "last_send_at"):
+        print(f"{k:>18}: {report[k]}")
+    for lane, stats in report["lanes"].items():
+        print(f"{lane:>18}: {stats}")
+    if args.coalesce:
+        print(f"{'coalescing':>18}: {coalesced}")
+
+
+if __name__ == "__main__":
+    main()
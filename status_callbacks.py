@@ -0,0 +1,258 @@
+# status_callbacks.py
+#
+# Twilio delivery-status callbacks (StatusCallback webhook).
+# The web handler only validates and enqueues; a flusher thread appends the
+# callbacks in batches to logs/delivery_status.jsonl and keeps the latest
+# status per MessageSid in memory for the dashboard. Lookups re-read the
+# file's new tail, so callbacks received by another process (gunicorn) show up.
+# The log is rotated at ROTATE_BYTES (a few old files kept) and only the most
+# recently updated MAX_TRACKED messages stay in memory.
+#
+# Load-test locally (web app started with TWILIO_WEBHOOK_ALLOW_UNSIGNED=1):
+#   python status_callbacks.py --url http://localhost:5000/twilio/status --count 20000
+
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional
+
+import portalocker
+
+LOGS_DIR = "logs"
+STATUS_LOG_PATH = os.path.join(LOGS_DIR, "delivery_status.jsonl")
+
+# Public URL Twilio should call, e.g. https://example.onrender.com/twilio/status
+STATUS_CALLBACK_URL = os.environ.get("STATUS_CALLBACK_URL", "").strip()
+# X-Twilio-Signature is checked against this auth token; without it webhooks are
+# refused unless TWILIO_WEBHOOK_ALLOW_UNSIGNED=1 (local load tests only).
+WEBHOOK_AUTH_TOKEN = os.environ.get("TWILIO_WEBHOOK_AUTH_TOKEN", "").strip()
+ALLOW_UNSIGNED = os.environ.get("TWILIO_WEBHOOK_ALLOW_UNSIGNED", "") == "1"
+TAIL_INTERVAL_SECONDS = 2.0  # lookups re-read the log's tail at most this often
+ROTATE_BYTES = int(float(os.environ.get("STATUS_LOG_MAX_MB", 64)) * 1024 * 1024)
+KEEP_ROTATED = 5
+MAX_TRACKED = int(os.environ.get("STATUS_MAX_TRACKED", 500_000))  # MessageSids kept in memory
+
+# Later states win; callbacks may arrive out of order.
+STATUS_RANK = {"accepted": 0, "queued": 1, "sending": 2, "sent": 3, "delivered": 4, "read": 5,
+               "undelivered": 6, "failed": 6, "canceled": 6}
+KEEP_FIELDS = ("MessageSid", "MessageStatus", "ErrorCode", "To", "From", "AccountSid")
+
+
+class StatusStore:
+    """Buffers callbacks and writes them to disk in batches, keyed by SID."""
+
+    def __init__(self, path: str = STATUS_LOG_PATH, max_buffer: int = 200_000,
+                 batch_size: int = 2000, flush_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._q: "queue.Queue[Dict]" = queue.Queue(maxsize=max_buffer)
+        self._latest: "OrderedDict[str, Dict]" = OrderedDict()  # least recently updated first
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._offset = 0          # bytes of the log applied so far
+        self._inode = None        # which file _offset refers to (the log is rotated)
+        self._tailed_at = 0.0
+        self.written = 0
+        self.dropped = 0
+
+    # ---- intake (web thread) ----
+    def submit(self, form: Dict) -> bool:
+        """Queue one callback; False when the buffer is full, ValueError when it is not a status callback."""
+        sid = form.get("MessageSid") or form.get("SmsSid")
+        if not sid or not form.get("MessageStatus"):
+            raise ValueError("MessageSid and MessageStatus are required")
+        rec = {k: form.get(k, "") for k in KEEP_FIELDS}
+        rec["MessageSid"] = sid
+        rec["received_at"] = time.time()
+        self._ensure_started()
+        try:
+            self._q.put_nowait(rec)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    # ---- lookups (dashboard) ----
+    def status_for(self, sid: str) -> Optional[Dict]:
+        self._ensure_loaded()
+        with self._lock:
+            return self._latest.get(sid)
+
+    def statuses(self, sids) -> Dict[str, str]:
+        self._ensure_loaded()
+        with self._lock:
+            return {s: self._latest[s]["MessageStatus"] for s in sids if s in self._latest}
+
+    def pending(self) -> int:
+        return self._q.qsize()
+
+    # ---- batching ----
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="status-flusher", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+    def _take_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """Write everything buffered so far (used by tests/shutdown)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with portalocker.Lock(self.path + ".lock", timeout=30):  # every gunicorn worker appends here
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in batch))
+                full = f.tell() >= ROTATE_BYTES
+            if full:
+                self._rotate()
+        with self._lock:
+            for r in batch:
+                self._apply(r)  # the tail re-read applies them again; later ranks win either way
+        self.written += len(batch)
+
+    def _rotate(self):
+        """Called with the log lock held: start a new file, keep the newest KEEP_ROTATED old ones."""
+        base, ext = os.path.splitext(self.path)
+        os.replace(self.path, f"{base}.{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}")
+        for old in self._rotated()[:-KEEP_ROTATED]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _rotated(self):
+        base, ext = os.path.splitext(self.path)
+        return sorted(glob.glob(f"{glob.escape(base)}.*{ext}"))
+
+    def _apply(self, rec: Dict):
+        sid = rec["MessageSid"]
+        cur = self._latest.get(sid)
+        if cur is None or STATUS_RANK.get(rec["MessageStatus"], 0) >= STATUS_RANK.get(cur["MessageStatus"], 0):
+            self._latest[sid] = rec
+        if sid in self._latest:
+            self._latest.move_to_end(sid)
+        while len(self._latest) > MAX_TRACKED:
+            self._latest.popitem(last=False)
+
+    def _ensure_loaded(self):
+        """Apply lines appended to the log since the last look (by any process), at most every few seconds."""
+        if time.monotonic() - self._tailed_at < TAIL_INTERVAL_SECONDS:
+            return
+        with self._lock:
+            self._tailed_at = time.monotonic()
+            try:
+                with open(self.path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    if st.st_ino != self._inode:
+                        if self._inode is not None:
+                            self._finish_rotated(self._inode)  # lines written before the rotation
+                        self._inode, self._offset = st.st_ino, 0
+                    elif st.st_size < self._offset:
+                        self._offset = 0  # truncated: start over
+                    self._read_from(f)
+            except OSError:
+                if self._inode is not None:
+                    self._finish_rotated(self._inode)  # rotated, no new file yet
+
+    def _finish_rotated(self, inode):
+        for path in reversed(self._rotated()):
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_ino == inode:
+                        self._read_from(f)
+                        return
+            except OSError:
+                continue
+
+    def _read_from(self, f):
+        f.seek(self._offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # still being written: read on the next look
+            self._offset += len(line)
+            try:
+                self._apply(json.loads(line))
+            except Exception:
+                continue
+
+
+STORE = StatusStore()
+
+
+def verify_request(url: str, params: Dict, signature: str) -> bool:
+    """Validate X-Twilio-Signature against TWILIO_WEBHOOK_AUTH_TOKEN (unsigned only when explicitly allowed)."""
+    if not WEBHOOK_AUTH_TOKEN:
+        return ALLOW_UNSIGNED
+    from twilio.request_validator import RequestValidator
+    return RequestValidator(WEBHOOK_AUTH_TOKEN).validate(url, params, signature or "")
+
+
+# ---------------- LOCAL CALLBACK GENERATOR ----------------
+def generate(url: str, count: int, concurrency: int = 16):
+    """POST `count` fake Twilio callbacks (sent -> delivered/read/failed) to url."""
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    session = requests.Session()
+    finals = ["delivered", "read", "failed", "undelivered"]
+
+    def one(i):
+        sid = f"SM{i:032x}"
+        ok = 0
+        for status in ("sent", random.choice(finals)):
+            data = {"MessageSid": sid, "MessageStatus": status, "To": "whatsapp:+910000000000",
+                    "ErrorCode": "63016" if status in ("failed", "undelivered") else ""}
+            r = session.post(url, data=data, timeout=10)
+            ok += r.status_code < 300
+        return ok
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        accepted = sum(pool.map(one, range(count)))
+    dt = time.perf_counter() - t0
+    print(f"posted {count * 2} callbacks ({accepted} accepted) in {dt:.1f}s = {count * 2 / dt * 60:,.0f}/min")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Send fake Twilio status callbacks to the web app.")
+    ap.add_argument("--url", default="http://localhost:5000/twilio/status")
+    ap.add_argument("--count", type=int, default=1000, help="messages (2 callbacks each)")
+    ap.add_argument("--concurrency", type=int, default=16)
+    args = ap.parse_args()
+    generate(args.url, args.count, args.concurrency)
@@ -0,0 +1,305 @@
+# suppression.py
+#
+# Opt-out (suppression) list: numbers that must never be messaged. Checked in
+# bulk when uploads are parsed (ingest.parse_to_jobs, the ingest API) and
+# again right before every send, so a number that opts out after scheduling
+# is still skipped.
+#
+# Layout under SUPPRESSION_DIR (shared by every process):
+#   base.<gen>.u64    sorted, unique numbers as uint64 (E.164 digits), memory-mapped
+#   bloom.<gen>.bits  Bloom filter over the base: most numbers are not opted
+#                     out, and the filter rejects those without touching the base
+#   meta.json         current generation and counts
+#   delta.log         "+<digits>" / "-<digits>" lines appended since that base
+# Adding or removing numbers only appends to delta.log (other processes pick
+# it up within REFRESH_SECONDS). Once the delta is large, or on a bulk load,
+# base + delta are compacted into a new generation. 5M numbers take ~40 MB of
+# page cache shared by all sessions, plus an 8 MB filter.
+#
+#   python suppression.py load optouts.csv [--replace]
+#   python suppression.py add +919876543210 ... | remove ... | check ... | stats
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import portalocker
+
+SUPPRESSION_DIR = os.environ.get("SUPPRESSION_DIR", os.path.join("logs", "suppression"))
+BLOOM_BITS_PER_NUMBER = 12
+BLOOM_HASHES = 8             # ~0.3% of non-opted-out numbers need an exact lookup
+COMPACT_DELTA_LINES = 100_000
+REFRESH_SECONDS = 1.0
+_H1 = np.uint64(0x9E3779B97F4A7C15)
+_H2 = np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+def phone_key(phone) -> int:
+    """Digits of an E.164 number as an integer (0 = not a number, never suppressed)."""
+    digits = str(phone or "").strip().lstrip("+")
+    return int(digits) if digits.isdigit() and 0 < len(digits) <= 18 else 0
+
+
+def _keys(phones: Iterable) -> np.ndarray:
+    return np.fromiter((phone_key(p) for p in phones), dtype=np.uint64)
+
+
+def _bloom_positions(keys: np.ndarray, mask: int) -> List[np.ndarray]:
+    h1 = keys * _H1  # wraps modulo 2**64 (double hashing: g_i = h1 + i*h2)
+    h2 = (keys * _H2) | np.uint64(1)
+    m = np.uint64(mask)
+    return [((h1 + np.uint64(i) * h2) >> np.uint64(20)) & m for i in range(BLOOM_HASHES)]
+
+
+def _build_bloom(keys: np.ndarray) -> np.ndarray:
+    nbits = 1 << max(10, int(len(keys) * BLOOM_BITS_PER_NUMBER - 1).bit_length())
+    bits = np.zeros(nbits, dtype=bool)
+    for pos in _bloom_positions(keys, nbits - 1):
+        bits[pos.astype(np.int64)] = True
+    return np.packbits(bits, bitorder="little")  # bit i of the filter = byte i >> 3, bit i & 7
+
+
+class SuppressionList:
+    def __init__(self, directory: str = SUPPRESSION_DIR):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.delta_path = os.path.join(directory, "delta.log")
+        self._lock = threading.RLock()
+        self.gen = -1
+        self._base = np.zeros(0, dtype=np.uint64)
+        self._bloom = np.zeros(0, dtype=np.uint8)
+        self._added: set = set()
+        self._removed: set = set()
+        self._delta_offset = 0
+        self._delta_lines = 0
+        self._checked_at = 0.0
+        self.suppressed = 0  # numbers filtered by this process
+
+    # ---------------- LOADING ----------------
+    def _meta(self) -> Dict:
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"gen": 0, "count": 0}
+
+    def refresh(self, force: bool = False):
+        """Pick up compactions and delta lines written by any process."""
+        now = time.monotonic()
+        if not force and now - self._checked_at < REFRESH_SECONDS:
+            return
+        with self._lock:
+            self._checked_at = now
+            meta = self._meta()
+            if meta["gen"] != self.gen:
+                self._open_base(meta)
+            self._read_delta()
+
+    def _open_base(self, meta: Dict):
+        gen = meta["gen"]
+        base_path = os.path.join(self.directory, f"base.{gen}.u64")
+        if gen and os.path.getsize(base_path):
+            self._base = np.memmap(base_path, dtype=np.uint64, mode="r")
+            self._bloom = np.fromfile(os.path.join(self.directory, f"bloom.{gen}.bits"), dtype=np.uint8)
+        else:
+            self._base = np.zeros(0, dtype=np.uint64)
+            self._bloom = np.zeros(0, dtype=np.uint8)
+        self.gen = gen
+        self._added, self._removed = set(), set()
+        self._delta_offset = self._delta_lines = 0
+
+    def _read_delta(self):
+        try:
+            with open(self.delta_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self._delta_offset:  # compacted since meta was read
+                    self._open_base(self._meta())
+                f.seek(self._delta_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1  # a line still being written is read next time
+        for line in data[:end].split(b"\n"):
+            if len(line) < 2:
+                continue
+            key = int(line[1:])
+            if line[:1] == b"+":
+                self._added.add(key)
+                self._removed.discard(key)
+            else:
+                self._removed.add(key)
+                self._added.discard(key)
+            self._delta_lines += 1
+        self._delta_offset += end
+
+    # ---------------- CHECKS ----------------
+    def _in_base(self, keys: np.ndarray) -> np.ndarray:
+        hit = np.zeros(len(keys), dtype=bool)
+        if not len(self._base) or not len(keys):
+            return hit
+        maybe = np.ones(len(keys), dtype=bool)
+        for pos in _bloom_positions(keys, len(self._bloom) * 8 - 1):
+            maybe &= (self._bloom[(pos >> np.uint64(3)).astype(np.int64)]
+                      >> (pos & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        cand = np.nonzero(maybe)[0]
+        if len(cand):  # exact confirmation of Bloom hits
+            at = np.searchsorted(self._base, keys[cand])
+            at[at >= len(self._base)] = 0
+            hit[cand] = self._base[at] == keys[cand]
+        return hit
+
+    def mask(self, phones: Iterable) -> np.ndarray:
+        """Boolean array: True for opted-out numbers."""
+        self.refresh()
+        keys = _keys(phones)
+        with self._lock:
+            hit = self._in_base(keys)
+            if self._removed:
+                hit &= ~np.isin(keys, np.fromiter(self._removed, dtype=np.uint64))
+            if self._added:
+                hit |= np.isin(keys, np.fromiter(self._added, dtype=np.uint64))
+        hit &= keys != 0
+        return hit
+
+    def contains(self, phone) -> bool:
+        return bool(self.mask([phone])[0])
+
+    def filter_jobs(self, jobs: List[Dict]) -> Tuple[List[Dict], int]:
+        """(jobs to opted-in numbers, number of rows dropped)."""
+        if not jobs:
+            return jobs, 0
+        hit = self.mask(j.get("mobile_number", "") for j in jobs)
+        n = int(hit.sum())
+        if not n:
+            return jobs, 0
+        self.suppressed += n
+        return [j for j, h in zip(jobs, hit) if not h], n
+
+    # ---------------- UPDATES ----------------
+    def _write_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return portalocker.Lock(os.path.join(self.directory, "write.lock"), timeout=60)
+
+    def _append(self, sign: bytes, phones: Iterable) -> int:
+        keys = [k for k in (phone_key(p) for p in phones) if k]
+        if not keys:
+            return 0
+        with self._write_lock():
+            with open(self.delta_path, "ab") as f:
+                f.write(b"".join(sign + str(k).encode() + b"\n" for k in keys))
+            self.refresh(force=True)
+            if self._delta_lines >= COMPACT_DELTA_LINES:
+                self._compact()
+        return len(keys)
+
+    def add(self, phones: Iterable) -> int:
+        """Opt numbers out (incremental: appended to the delta log)."""
+        return self._append(b"+", phones)
+
+    def remove(self, phones: Iterable) -> int:
+        """Opt numbers back in."""
+        return self._append(b"-", phones)
+
+    def load(self, phones: Iterable, replace: bool = False) -> int:
+        """Bulk load a list (millions of numbers): merged into a new base, or replacing it."""
+        keys = _keys(phones)
+        keys = keys[keys != 0]
+        with self._write_lock():
+            self.refresh(force=True)
+            self._compact(extra=keys, replace=replace)
+        return len(keys)
+
+    def _compact(self, extra: Optional[np.ndarray] = None, replace: bool = False):
+        """Fold base + delta (+ extra) into a new generation; caller holds the write lock."""
+        with self._lock:
+            parts = []
+            if not replace:
+                base = np.asarray(self._base)
+                if self._removed:  # opt-ins undo the old list only, never the numbers being loaded
+                    base = base[~np.isin(base, np.fromiter(self._removed, dtype=np.uint64))]
+                parts.append(base)
+                if self._added:
+                    parts.append(np.fromiter(self._added, dtype=np.uint64))
+            if extra is not None:
+                parts.append(extra)
+            keys = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.uint64)
+            old, gen = self.gen, self.gen + 1
+            keys.tofile(os.path.join(self.directory, f"base.{gen}.u64"))
+            _build_bloom(keys).tofile(os.path.join(self.directory, f"bloom.{gen}.bits"))
+            tmp = self.meta_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"gen": gen, "count": int(len(keys)), "compacted_at": time.time()}, f)
+            os.replace(tmp, self.meta_path)  # readers switch here; delta lines still apply cleanly
+            open(self.delta_path, "wb").close()
+            for stale in (old - 1,):  # keep the previous generation for readers mid-switch
+                for name in (f"base.{stale}.u64", f"bloom.{stale}.bits"):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+            self._open_base({"gen": gen})
+
+    def stats(self) -> Dict:
+        self.refresh()
+        return {"generation": self.gen, "base_numbers": int(len(self._base)),
+                "pending_adds": len(self._added), "pending_removals": len(self._removed),
+                "filter_bytes": int(self._bloom.nbytes), "suppressed_here": self.suppressed}
+
+
+LIST = SuppressionList()
+
+
+# ---------------- FILE INPUT ----------------
+def read_numbers(path_or_file) -> List[str]:
+    """Normalised numbers from the phone column of a CSV / Excel file, or a plain list (one per line)."""
+    import ingest
+    import schema_inference
+
+    name = getattr(path_or_file, "name", str(path_or_file))
+    if name.lower().endswith(".txt"):
+        f = open(path_or_file, "rb") if isinstance(path_or_file, str) else path_or_file
+        values = f.read().decode("utf-8", "replace").split()
+    else:
+        f = open(path_or_file, "rb") if isinstance(path_or_file, str) else path_or_file
+        df = ingest.load_table(f)
+        if df is None or df.empty:
+            return []
+        col = schema_inference.get_schema(df, ingest.ROLE_CANDS)["roles"]["phone"] or df.columns[0]
+        values = df[col].tolist()
+    return [p for p in (ingest.normalize_phone(v) for v in values) if p]
+
+
+# ---------------- CLI ----------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Manage the opt-out (suppression) list.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("load", help="Bulk load numbers from a CSV / Excel / .txt file")
+    p.add_argument("path")
+    p.add_argument("--replace", action="store_true", help="Replace the whole list instead of merging")
+    for cmd in ("add", "remove", "check"):
+        sub.add_parser(cmd).add_argument("numbers", nargs="+")
+    sub.add_parser("stats")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "load":
+        t0 = time.perf_counter()
+        n = LIST.load(read_numbers(args.path), replace=args.replace)
+        print(f"loaded {n} numbers in {time.perf_counter() - t0:.1f}s")
+    elif args.cmd in ("add", "remove"):
+        import ingest
+        phones = [ingest.normalize_phone(v) for v in args.numbers]
+        print(f"{args.cmd}: {getattr(LIST, args.cmd)(phones)} number(s)")
+    elif args.cmd == "check":
+        import ingest
+        for v, hit in zip(args.numbers, LIST.mask(ingest.normalize_phone(v) for v in args.numbers)):
+            print(f"{v}: {'opted out' if hit else 'ok'}")
+    print(json.dumps(LIST.stats()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
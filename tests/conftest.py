@@ -0,0 +1,44 @@
+# tests/conftest.py
+#
+# Behavioural tests for the scheduling subsystems. They run offline: no Twilio,
+# no Streamlit, files only under pytest's tmp_path. (The test*.py scripts in the
+# repo root send real messages and are not part of this suite.)
+#
+#   python -m pytest -q
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import IST  # noqa: E402
+
+
+class FakeClock:
+    """Manually advanced time source for the clock= parameters."""
+
+    def __init__(self, start: float = 1_700_000_000.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    def sleep(self, seconds: float):
+        self.now += max(0.0, seconds)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def at(clock_or_ts, offset: float = 0.0) -> datetime:
+    """IST datetime offset seconds from a FakeClock's now (or an epoch)."""
+    ts = clock_or_ts.now if isinstance(clock_or_ts, FakeClock) else clock_or_ts
+    return datetime.fromtimestamp(ts + offset, IST)
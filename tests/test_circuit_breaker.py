@@ -0,0 +1,106 @@
+# tests/test_circuit_breaker.py
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, Breaker
+
+
+def _trip_on_auth_errors(br):
+    for _ in range(circuit_breaker.ACCOUNT_TRIP_ERRORS):
+        br.record(20003)
+
+
+def test_classify():
+    assert circuit_breaker.classify(None) == "ok"
+    assert circuit_breaker.classify(21211) == "ok"       # invalid number: the message, not the provider
+    assert circuit_breaker.classify(20003) == "account"
+    assert circuit_breaker.classify(503) == "server"
+    assert circuit_breaker.classify("transport") == "server"
+    assert circuit_breaker.classify(63018) == "throttle"
+    assert circuit_breaker.is_systemic(20500) and not circuit_breaker.is_systemic(63018)
+
+
+def test_account_errors_trip_the_breaker(clock):
+    br = Breaker("AC1", clock=clock)
+    br.record(20003)
+    br.record(20003)
+    assert br.state == CLOSED and br.allow()
+    br.record(20003)
+    assert br.state == OPEN and br.trips == 1
+    assert br.is_open() and not br.allow()
+
+
+def test_server_errors_trip_on_ratio_after_min_calls(clock):
+    br = Breaker("AC1", clock=clock)
+    for _ in range(circuit_breaker.MIN_CALLS // 2 - 1):
+        br.record(None)
+    for _ in range(circuit_breaker.MIN_CALLS // 2):
+        br.record(503)
+    assert br.state == CLOSED            # 5 of 9 calls, below MIN_CALLS
+    br.record(503)
+    assert br.state == OPEN
+
+
+def test_old_errors_leave_the_window(clock):
+    br = Breaker("AC1", clock=clock)
+    br.record(20003)
+    br.record(20003)
+    clock.advance(circuit_breaker.WINDOW_SECONDS + 1)
+    br.record(20003)
+    assert br.state == CLOSED
+
+
+def test_throttling_and_recipient_errors_do_not_count(clock):
+    br = Breaker("AC1", clock=clock)
+    for _ in range(20):
+        br.record(63018)
+        br.record(21211)
+    assert br.state == CLOSED
+
+
+def test_half_open_allows_one_probe_and_closes_on_success(clock):
+    br = Breaker("AC1", clock=clock)
+    _trip_on_auth_errors(br)
+    clock.advance(circuit_breaker.OPEN_SECONDS)
+    assert not br.is_open()
+    assert br.allow()                    # the probe
+    assert br.state == HALF_OPEN
+    assert not br.allow()                # everyone else waits for it
+    br.record(None)
+    assert br.state == CLOSED and br.allow()
+
+
+def test_failed_probe_reopens_for_twice_as_long(clock):
+    br = Breaker("AC1", clock=clock)
+    _trip_on_auth_errors(br)
+    clock.advance(circuit_breaker.OPEN_SECONDS)
+    assert br.allow()
+    br.record(20003)
+    assert br.state == OPEN
+    assert br.open_until == clock.now + 2 * circuit_breaker.OPEN_SECONDS
+    assert br.trips == 1                 # a backoff, not a new trip
+
+
+def test_lost_probe_frees_the_slot(clock):
+    br = Breaker("AC1", clock=clock)
+    _trip_on_auth_errors(br)
+    clock.advance(circuit_breaker.OPEN_SECONDS)
+    assert br.allow()
+    clock.advance(circuit_breaker.PROBE_TIMEOUT_SECONDS)
+    assert br.allow()
+
+
+def test_hold_until_keeps_the_backlog_order(clock):
+    br = Breaker("AC1", clock=clock)
+    _trip_on_auth_errors(br)
+    opened = clock.now
+    first, second = br.hold_until(opened + 10), br.hold_until(opened + 20)
+    assert first == br.open_until + 1.0 + 10
+    assert second - first == 10
+    assert br.hold_until(opened - 5) == br.open_until + 1.0  # already overdue: right after the probe
+
+
+def test_reset_closes(clock):
+    br = Breaker("AC1", clock=clock)
+    _trip_on_auth_errors(br)
+    br.reset()
+    assert br.state == CLOSED and br.allow()
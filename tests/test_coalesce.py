@@ -0,0 +1,66 @@
+# tests/test_coalesce.py
+
+from conftest import at
+
+import coalesce
+
+
+def _row(clock, n, phone="+911", offset=0.0, body="hi", media="", lane=None):
+    job = {"job_id": f"j{n}", "row_key": f"{phone}#{n}", "mobile_number": phone,
+           "scheduled_at": at(clock, offset), "media_url": media, "body": body}
+    if lane:
+        job["lane"] = lane
+    return job
+
+
+def test_window_off_returns_jobs_unchanged(clock):
+    jobs = [_row(clock, 0), _row(clock, 1)]
+    out, report = coalesce.coalesce_recipients(jobs, window_seconds=0)
+    assert out is jobs
+    assert report["api_calls_saved"] == 0
+
+
+def test_exact_duplicates_are_dropped(clock):
+    jobs = [_row(clock, 0), _row(clock, 1, offset=30)]
+    out, report = coalesce.coalesce_recipients(jobs, window_seconds=60)
+    assert len(out) == 1
+    assert out[0]["job_id"] == "j0"
+    assert coalesce.absorbed_ids(out[0]) == ["j1"]
+    assert report["duplicates_dropped"] == 1 and report["api_calls_saved"] == 1
+
+
+def test_texts_merge_at_the_earliest_time_in_the_most_urgent_lane(clock):
+    jobs = [_row(clock, 1, offset=40, body="second", lane="urgent"), _row(clock, 0, offset=0, body="first", lane="bulk")]
+    out, report = coalesce.coalesce_recipients(jobs, window_seconds=60)
+    assert len(out) == 1
+    msg = out[0]
+    assert msg["body"] == "first" + coalesce.MERGE_SEPARATOR + "second"
+    assert msg["scheduled_at"] == at(clock, 0)
+    assert msg["lane"] == "urgent"
+    assert msg["row"]["body"] == "first"              # its own row as uploaded, for revisions
+    assert [a["row_key"] for a in msg["coalesced"]] == ["+911#1"]
+    assert report["merged"] == 1 and report["recipients"] == 1
+
+
+def test_one_media_attachment_per_message(clock):
+    jobs = [_row(clock, 0, media="https://x/a.jpg"), _row(clock, 1, offset=10, body="b", media="https://x/b.jpg"),
+            _row(clock, 2, offset=20, body="c")]
+    out, _report = coalesce.coalesce_recipients(jobs, window_seconds=60)
+    assert [m["media_url"] for m in out] == ["https://x/a.jpg", "https://x/b.jpg"]
+    assert out[1]["body"] == "b" + coalesce.MERGE_SEPARATOR + "c"
+
+
+def test_rows_outside_the_window_or_for_other_recipients_stay_separate(clock):
+    jobs = [_row(clock, 0), _row(clock, 1, offset=120, body="later"), _row(clock, 2, phone="+912", body="other")]
+    out, report = coalesce.coalesce_recipients(jobs, window_seconds=60)
+    assert sorted(m["job_id"] for m in out) == ["j0", "j1", "j2"]
+    assert not any("coalesced" in m for m in out)
+    assert report["sends"] == 3
+
+
+def test_merged_body_respects_the_provider_limit(clock):
+    long = "x" * (coalesce.MAX_BODY_CHARS - 10)
+    jobs = [_row(clock, 0, body=long), _row(clock, 1, offset=5, body="tail that does not fit")]
+    out, _report = coalesce.coalesce_recipients(jobs, window_seconds=60)
+    assert len(out) == 2
+    assert all(len(m["body"]) <= coalesce.MAX_BODY_CHARS for m in out)
@@ -0,0 +1,109 @@
+# tests/test_dispatch.py
+
+import pytest
+from conftest import at
+
+import dispatch
+from dispatch import BULK, NORMAL, URGENT, LaneLimiter, RateLimiter
+
+
+def _job(clock, n, offset=0.0, lane=None):
+    job = {"job_id": f"j{n}", "scheduled_at": at(clock, offset)}
+    if lane:
+        job["lane"] = lane
+    return job
+
+
+# ---------------- RATE LIMITERS ----------------
+def test_rate_limiter_paces_after_the_burst(clock):
+    lim = RateLimiter(2.0, burst=2, clock=clock, sleep=clock.sleep)
+    assert [lim.reserve() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    clock.advance(1.0)
+    assert lim.next_free_in() == pytest.approx(0.5)
+    assert RateLimiter(0, clock=clock).reserve() == 0.0  # unlimited
+
+
+def test_lane_limiter_splits_the_rate_by_share(clock):
+    lim = LaneLimiter(10.0, shares={URGENT: 0.2, NORMAL: 0.4, BULK: 0.4}, clock=clock, sleep=clock.sleep)
+    assert lim.buckets[URGENT].rate == pytest.approx(2.0)
+    assert lim.buckets[BULK].rate == pytest.approx(4.0)
+
+
+def test_busy_lane_borrows_but_lenders_keep_their_last_token(clock):
+    lim = LaneLimiter(10.0, shares={URGENT: 0.2, NORMAL: 0.4, BULK: 0.4}, clock=clock, sleep=clock.sleep)
+    bulk = lim.lane(BULK)
+    assert [bulk.reserve() for _ in range(4)] == [0.0] * 4  # own 2, then one each from urgent and normal
+    assert bulk.reserve() == pytest.approx(0.25)           # nothing left to borrow: wait for its own refill
+    assert lim.lane(URGENT).reserve() == 0.0               # an idle lane can still send at once
+    assert lim.lane(NORMAL).reserve() == 0.0
+
+
+def test_zero_share_lane_still_trickles(clock):
+    lim = LaneLimiter(10.0, shares={URGENT: 0.0, NORMAL: 1.0, BULK: 0.0}, clock=clock)
+    assert lim.buckets[URGENT].rate > 0
+
+
+def test_lane_limiter_handles_unknown_lanes():
+    view = dispatch.lane_limiter("nonsense", key="test-unknown-lane")
+    assert view.name == dispatch.DEFAULT_LANE
+
+
+def test_normalize_lane():
+    assert dispatch.normalize_lane(" High ") == URGENT
+    assert dispatch.normalize_lane("campaign") == BULK
+    assert dispatch.normalize_lane("", default=NORMAL) == NORMAL
+    assert dispatch.normalize_lane("whenever") is None
+
+
+# ---------------- BATCH PLANNING ----------------
+def test_plan_batches_groups_by_window_and_lane(clock):
+    base = clock.now - clock.now % 60  # window boundary
+    clock.now = base
+    jobs = [_job(clock, 1, 50), _job(clock, 2, 10), _job(clock, 3, 30, lane=URGENT), _job(clock, 4, 70)]
+    batches = dispatch.plan_batches(jobs, window_seconds=60)
+    assert [(b["lane"], [j["job_id"] for j in b["jobs"]]) for b in batches] == [
+        (URGENT, ["j3"]), (NORMAL, ["j2", "j1"]), (NORMAL, ["j4"])]
+    assert batches[1]["scheduled_at"] == at(clock, 10)      # runs at its earliest job
+    assert batches[0]["batch_id"].startswith("batch|urgent|")
+    assert batches[1]["batch_id"].startswith("batch|20")
+
+
+def test_plan_batches_ids_are_stable(clock):
+    jobs = [_job(clock, n, n) for n in range(5)]
+    assert [b["batch_id"] for b in dispatch.plan_batches(jobs)] == \
+           [b["batch_id"] for b in dispatch.plan_batches(list(reversed(jobs)))]
+
+
+def test_zero_window_groups_identical_times_only(clock):
+    jobs = [_job(clock, 1), _job(clock, 2), _job(clock, 3, 1)]
+    assert [len(b["jobs"]) for b in dispatch.plan_batches(jobs, window_seconds=0)] == [2, 1]
+
+
+# ---------------- FAN-OUT ----------------
+def test_run_batch_waits_for_each_job_and_the_limiter(clock):
+    start = clock.now
+    batch = dispatch.plan_batches([_job(clock, 1, 0), _job(clock, 2, 0), _job(clock, 3, 20)])[0]
+    lim = RateLimiter(1.0, burst=1, clock=clock, sleep=clock.sleep)
+    sent_at = []
+
+    def send_one(job):
+        sent_at.append((job["job_id"], clock.now - start))
+        if job["job_id"] == "j2":
+            raise RuntimeError("boom")
+        return {"status": "delivered", "sid": "SM" + job["job_id"]}
+
+    summary = dispatch.run_batch(batch, send_one, lim)
+    assert sent_at == [("j1", 0.0), ("j2", 1.0), ("j3", 20.0)]
+    assert (summary["delivered"], summary["failed"]) == (2, 1)
+    assert summary["outcomes"][0]["sid"] == "SMj1"
+    assert summary["outcomes"][1]["error"] == "boom"
+
+
+def test_admit_skips_without_spending_a_token(clock):
+    batch = dispatch.plan_batches([_job(clock, 1), _job(clock, 2)])[0]
+    lim = RateLimiter(1.0, burst=1, clock=clock, sleep=clock.sleep)
+    start = clock.now
+    summary = dispatch.run_batch(batch, lambda job: {"status": "held"}, lim, admit=lambda job: job["job_id"] != "j1")
+    assert (summary["skipped"], summary["held"], summary["failed"]) == (1, 1, 0)
+    assert clock.now == start  # no rate wait: j2 used the only token
+    assert lim.next_free_in() == pytest.approx(1.0)
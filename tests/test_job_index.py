@@ -0,0 +1,143 @@
+# tests/test_job_index.py
+
+from conftest import at
+
+import job_index
+from job_index import CANCELLED, DISPATCHED, PARKED, PAUSED, PENDING, JobIndex
+
+
+def _job(clock, n, offset=60.0, upload="list_20240101_100000", lane=None):
+    job = {"job_id": f"j{n}", "mobile_number": f"+9100000000{n}", "upload_id": upload,
+           "scheduled_at": at(clock, offset)}
+    if lane:
+        job["lane"] = lane
+    return job
+
+
+def _index(clock, jobs, keep_seconds=3600.0):
+    idx = JobIndex(keep_seconds=keep_seconds, clock=clock)
+    idx.add(jobs, "aps-1")
+    return idx
+
+
+def _state(idx, jid):
+    return idx.records[jid]["state"]
+
+
+def test_claim_dispatches_pending_once(clock):
+    job = _job(clock, 1)
+    idx = _index(clock, [job])
+    assert idx.claim(job)
+    assert _state(idx, "j1") == DISPATCHED
+    assert not idx.claim(job)
+    assert idx.claim({"job_id": "unknown"})  # messages the index never saw are allowed
+
+
+def test_cancel_only_touches_active_messages(clock):
+    jobs = [_job(clock, n) for n in range(3)]
+    idx = _index(clock, jobs)
+    idx.claim(jobs[0])
+    assert idx.cancel(["j0", "j1", "missing"]) == 1
+    assert _state(idx, "j0") == DISPATCHED
+    assert _state(idx, "j1") == CANCELLED
+    assert not idx.claim(jobs[1])
+    assert idx.state_counts() == {DISPATCHED: 1, CANCELLED: 1, PENDING: 1}
+
+
+def test_pause_parks_a_firing_message_and_resume_redispatches_it(clock):
+    jobs = [_job(clock, 1), _job(clock, 2)]
+    idx = _index(clock, jobs)
+    assert idx.pause(["j1", "j2"]) == 2
+    assert not idx.claim(jobs[0])           # its APScheduler job fired while paused
+    assert _state(idx, "j1") == PARKED
+    assert _state(idx, "j2") == PAUSED
+
+    n, redispatch = idx.resume(["j1", "j2", "j3"])
+    assert n == 2
+    assert [j["job_id"] for j in redispatch] == ["j1"]  # j2 never fired: its entry is still live
+    assert redispatch[0]["gen"] == 1
+    assert not idx.claim(jobs[0])           # the old generation stays stopped
+    assert idx.claim(redispatch[0])
+    assert idx.claim(jobs[1])
+
+
+def test_resume_counts_only_changed_records(clock):
+    jobs = [_job(clock, 1), _job(clock, 2)]
+    idx = _index(clock, jobs)
+    idx.pause(["j1"])
+    assert idx.resume(["j1", "j2"]) == (1, [])
+
+
+def test_shift_moves_pending_and_supersedes_old_generation(clock):
+    job = _job(clock, 1, offset=60)
+    idx = _index(clock, [job])
+    n, moved = idx.shift(["j1"], 300)
+    assert n == 1
+    assert moved[0]["scheduled_at"] == at(clock, 360)
+    assert moved[0]["gen"] == 1
+    assert not idx.claim(job)               # stale entry at the old time
+    assert idx.claim(moved[0])
+
+
+def test_shift_keeps_paused_and_parked_state(clock):
+    jobs = [_job(clock, 1), _job(clock, 2)]
+    idx = _index(clock, jobs)
+    idx.pause(["j1", "j2"])
+    idx.claim(jobs[1])                      # j2 parked
+    n, moved = idx.shift(["j1", "j2"], 600)
+    assert n == 2 and moved == []           # nothing is rescheduled while paused
+    assert _state(idx, "j1") == PAUSED
+    assert _state(idx, "j2") == PARKED
+
+    n, redispatch = idx.resume(["j1", "j2"])
+    assert n == 2
+    assert sorted(j["job_id"] for j in redispatch) == ["j1", "j2"]
+    assert all(j["scheduled_at"] == at(clock, 660) for j in redispatch)
+
+
+def test_lane_depths_count_due_messages(clock):
+    jobs = [_job(clock, 1, offset=10, lane="urgent"), _job(clock, 2, offset=100), _job(clock, 3, offset=200)]
+    idx = _index(clock, jobs)
+    assert idx.lane_depths() == {"urgent": {"pending": 1, "due": 0}, "normal": {"pending": 2, "due": 0}}
+    clock.advance(150)
+    assert idx.lane_depths() == {"urgent": {"pending": 1, "due": 1}, "normal": {"pending": 2, "due": 1}}
+    idx.claim(jobs[0])
+    idx.pause(["j2"])
+    assert idx.lane_depths() == {"normal": {"pending": 1, "due": 0}}
+
+
+def test_terminal_records_are_evicted_after_keep_seconds(clock):
+    jobs = [_job(clock, 1, offset=0), _job(clock, 2, offset=0), _job(clock, 3, offset=0)]
+    idx = _index(clock, jobs, keep_seconds=3600)
+    idx.claim(jobs[0])
+    idx.cancel(["j2"])
+    clock.advance(3599)
+    assert set(idx.records) == {"j1", "j2", "j3"}
+    clock.advance(2)
+    assert idx.state_counts() == {PENDING: 1}
+    assert set(idx.records) == {"j3"}
+    assert idx.select(upload_id="list_20240101_100000", states=job_index.TERMINAL_STATES) == set()
+    assert idx.upload_ids() == ["list_20240101_100000"]
+
+
+def test_eviction_waits_for_a_shifted_stale_entry(clock):
+    job = _job(clock, 1, offset=0)
+    idx = _index(clock, [job], keep_seconds=60)
+    _n, moved = idx.shift(["j1"], 7200)
+    idx.cancel(["j1"])
+    clock.advance(3600)
+    assert "j1" in idx.records              # the moved entry is still registered until its new time
+    clock.advance(3600 + 61)
+    idx.state_counts()
+    assert "j1" not in idx.records
+    assert idx.claim(moved[0])              # unknown again: allowed, but its APScheduler job is long gone
+
+
+def test_readd_replaces_record_and_keeps_counters_exact(clock):
+    job = _job(clock, 1)
+    idx = _index(clock, [job])
+    idx.pause(["j1"])
+    idx.add([{**job, "gen": 2}], "aps-2")
+    assert _state(idx, "j1") == PENDING and idx.records["j1"]["gen"] == 2
+    assert idx.state_counts() == {PENDING: 1}
+    assert idx.dead_aps_jobs() == ["aps-1"]
@@ -0,0 +1,87 @@
+# tests/test_leader.py
+
+import os
+
+import pytest
+from conftest import at
+
+import leader
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return leader.Outbox(str(tmp_path / "outbox"))
+
+
+def test_outbox_round_trip_in_order(clock, outbox):
+    ops = [{"op": "schedule", "jobs": [{"job_id": "j1", "scheduled_at": at(clock, 60)}], "n": 1},
+           {"op": "cancel", "ids": {"b", "a"}, "n": 2}]
+    for op in ops:
+        outbox.put(op)
+    applied = []
+    assert outbox.drain(applied.append) == 2
+    assert applied[0]["jobs"][0]["scheduled_at"] == at(clock, 60)   # tz-aware datetime back
+    assert applied[1]["ids"] == ["a", "b"]                          # sets travel as sorted lists
+    assert [op["n"] for op in applied] == [1, 2]
+    assert outbox.pending() == []
+
+
+def test_entries_are_private_to_the_owner(outbox):
+    name = outbox.put({"op": "schedule"})
+    assert os.stat(os.path.join(outbox.directory, name)).st_mode & 0o077 == 0
+
+
+def test_lookup_error_leaves_the_entry_for_later(outbox):
+    outbox.put({"op": "schedule", "senders": [["AC1", "whatsapp:+1"]]})
+
+    def no_credentials(op):
+        raise LookupError("no auth token in this process for account AC1")
+
+    assert outbox.drain(no_credentials) == 0
+    assert outbox.waiting == 1 and len(outbox.pending()) == 1
+    assert outbox.drain(lambda op: None) == 1
+    assert outbox.waiting == 0 and outbox.pending() == []
+
+
+def test_unreadable_entry_is_set_aside(outbox):
+    outbox.put({"op": "schedule"})
+    os.makedirs(outbox.directory, exist_ok=True)
+    with open(os.path.join(outbox.directory, "0000000000.000000_1_bad.json"), "w") as f:
+        f.write("{not json")
+    applied = []
+    assert outbox.drain(applied.append) == 1
+    assert [n for n in os.listdir(outbox.directory) if n.endswith(".bad")] == ["0000000000.000000_1_bad.json.bad"]
+
+
+def test_drain_limit(outbox):
+    for n in range(5):
+        outbox.put({"n": n})
+    applied = []
+    assert outbox.drain(applied.append, limit=2) == 2
+    assert outbox.drain(applied.append) == 3
+    assert [op["n"] for op in applied] == list(range(5))
+
+
+def test_one_leader_at_a_time_and_terms_increase(tmp_path):
+    path = str(tmp_path / "scheduler.lock")
+    events = []
+    a = leader.LeaderElector(path, on_elected=lambda: events.append("a+"), on_demoted=lambda: events.append("a-"))
+    b = leader.LeaderElector(path, on_elected=lambda: events.append("b+"))
+    assert a._try_acquire() and a.is_leader and a.term == 1
+    assert not b._try_acquire() and not b.is_leader
+    assert b.status()["leader"] == a.identity and b.status()["role"] == "follower"
+
+    a._step_down("test")
+    assert b._try_acquire() and b.term == 2
+    assert events == ["a+", "a-", "b+"]
+    b._step_down("test")
+
+
+def test_leader_steps_down_when_its_lock_file_is_replaced(tmp_path):
+    path = str(tmp_path / "scheduler.lock")
+    a = leader.LeaderElector(path)
+    assert a._try_acquire()
+    assert a._renew()
+    os.remove(path)
+    assert not a._renew()
+    assert not a.is_leader
@@ -0,0 +1,82 @@
+# tests/test_sender_pool.py
+
+import pytest
+
+import circuit_breaker
+import sender_pool
+from sender_pool import Sender, SenderPool
+
+JOB = {"job_id": "j1", "mobile_number": "+911"}
+
+
+@pytest.fixture
+def pool(clock, monkeypatch):
+    monkeypatch.setattr(sender_pool, "_sticky", {})
+    monkeypatch.setattr(sender_pool, "_recipients", {})
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    for account in ("ACa", "ACb"):
+        circuit_breaker._breakers[account] = circuit_breaker.Breaker(account, clock=clock)
+    return SenderPool([Sender("ACa", "t", "whatsapp:+1", 0.0), Sender("ACb", "t", "whatsapp:+2", 0.0)], clock=clock)
+
+
+def _delivered(calls):
+    def send_fn(sender, may_retry):
+        calls.append(sender.from_number)
+        return {"status": "delivered"}
+    return send_fn
+
+
+def _probing(breaker):
+    for _ in range(circuit_breaker.ACCOUNT_TRIP_ERRORS):
+        breaker.record(20003)
+    breaker.clock.advance(circuit_breaker.OPEN_SECONDS)
+    assert breaker.allow()  # someone else's probe is now in flight
+
+
+def test_recipient_sticks_to_its_sender(pool):
+    first = pool.assign(JOB)
+    assert pool.assign(JOB) is first
+    calls = []
+    assert pool.send(JOB, _delivered(calls))["sender"] == first.from_number
+
+
+def test_open_breaker_fails_over(pool):
+    sticky = pool.assign(JOB)
+    for _ in range(circuit_breaker.ACCOUNT_TRIP_ERRORS):
+        sticky.breaker.record(20003)
+    calls = []
+    res = pool.send(JOB, _delivered(calls))
+    assert res["status"] == "delivered" and calls == [res["sender"]] != [sticky.from_number]
+
+
+def test_probing_breaker_fails_over_instead_of_holding(pool):
+    sticky = pool.assign(JOB)
+    _probing(sticky.breaker)
+    calls = []
+    res = pool.send(JOB, _delivered(calls))
+    assert res["status"] == "delivered"
+    assert calls == [res["sender"]] and res["sender"] != sticky.from_number
+
+
+def test_held_when_no_sender_may_call(pool):
+    for s in pool.senders:
+        _probing(s.breaker)
+    calls = []
+    res = pool.send(JOB, _delivered(calls))
+    assert res["status"] == "held" and calls == []
+
+
+def test_throttled_sender_cools_down_and_the_message_moves(pool):
+    sticky = pool.assign(JOB)
+    calls = []
+
+    def send_fn(sender, may_retry):
+        calls.append(sender.from_number)
+        if sender is sticky:
+            return {"status": "failed", "code": 63018}
+        return {"status": "delivered"}
+
+    res = pool.send(JOB, send_fn)
+    assert res["status"] == "delivered" and len(calls) == 2
+    assert sticky.throttled == 1 and not sticky.available(pool.clock())
+    assert pool.assign(JOB) is not sticky
@@ -0,0 +1,77 @@
+# tests/test_suppression.py
+
+import os
+
+import numpy as np
+import pytest
+
+import suppression
+from suppression import SuppressionList
+
+
+@pytest.fixture
+def optouts(tmp_path):
+    return SuppressionList(str(tmp_path / "suppression"))
+
+
+def test_add_and_remove(optouts):
+    assert optouts.add(["+919876543210", "whatever", ""]) == 1  # not a number: ignored
+    assert optouts.contains("+919876543210")
+    assert optouts.contains("919876543210")
+    assert not optouts.contains("+919876543211")
+    assert optouts.remove(["+919876543210"]) == 1
+    assert not optouts.contains("+919876543210")
+
+
+def test_other_processes_see_updates(tmp_path, optouts):
+    optouts.add(["+911"])
+    other = SuppressionList(optouts.directory)
+    assert other.contains("+911")
+    optouts.remove(["+911"])
+    other.refresh(force=True)
+    assert not other.contains("+911")
+
+
+def test_filter_jobs(optouts):
+    optouts.add(["+912"])
+    jobs = [{"mobile_number": "+911"}, {"mobile_number": "+912"}, {"mobile_number": "+913"}]
+    kept, dropped = optouts.filter_jobs(jobs)
+    assert [j["mobile_number"] for j in kept] == ["+911", "+913"]
+    assert dropped == 1 and optouts.suppressed == 1
+
+
+def test_delta_is_compacted_into_a_new_generation(optouts, monkeypatch):
+    monkeypatch.setattr(suppression, "COMPACT_DELTA_LINES", 3)
+    optouts.add(["+911", "+912"])
+    assert optouts.gen == 0
+    optouts.remove(["+912"])            # third delta line: compaction
+    assert optouts.gen == 1
+    assert os.path.getsize(optouts.delta_path) == 0
+    assert optouts.stats()["base_numbers"] == 1
+    assert optouts.contains("+911") and not optouts.contains("+912")
+
+    optouts.remove(["+911"])            # opt-in over the compacted base
+    assert not optouts.contains("+911")
+    reader = SuppressionList(optouts.directory)
+    assert not reader.contains("+911")
+
+
+def test_bulk_load_merges_or_replaces(optouts):
+    optouts.add(["+911"])
+    numbers = [f"+91{9_000_000_000 + i}" for i in range(5000)]
+    assert optouts.load(numbers) == 5000
+    assert optouts.mask(numbers + ["+911"]).all()   # the Bloom filter never misses a listed number
+    others = [f"+91{8_000_000_000 + i}" for i in range(5000)]
+    assert not optouts.mask(others).any()
+
+    optouts.load(["+912"], replace=True)
+    assert optouts.contains("+912")
+    assert not optouts.contains("+911") and not optouts.contains(numbers[0])
+
+
+def test_old_generations_are_cleaned_up(optouts):
+    for n in range(4):
+        optouts.load([f"+91{n}"])
+    names = sorted(n for n in os.listdir(optouts.directory) if n.startswith("base."))
+    assert names == ["base.3.u64", "base.4.u64"]  # current plus the previous one for readers mid-switch
+    assert np.fromfile(os.path.join(optouts.directory, "base.4.u64"), dtype=np.uint64).tolist() == [910, 911, 912, 913]
@@ -0,0 +1,108 @@
+# tests/test_upload_diff.py
+
+import pytest
+from conftest import at
+
+import lifecycle
+import upload_diff
+from job_index import CANCELLED, DISPATCHED, PENDING, JobIndex
+
+OLD, NEW = "list_20240101_100000", "list_20240102_090000"
+
+
+def _row(clock, key, body="hi", offset=3600.0, upload=OLD, **extra):
+    phone = key.split("#")[0]
+    return {"job_id": f"{upload}|{key}", "row_key": key, "mobile_number": phone, "upload_id": upload,
+            "scheduled_at": at(clock, offset), "media_url": "", "body": body, **extra}
+
+
+@pytest.fixture
+def manifests(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_diff, "UPLOADS_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(lifecycle, "LEDGER", lifecycle.Ledger(str(tmp_path / "lifecycle")))
+    return tmp_path
+
+
+def test_upload_base_strips_the_timestamp():
+    assert upload_diff.upload_base(OLD) == "list"
+    assert upload_diff.upload_base("my_list_20240101_100000") == "my_list"
+    assert upload_diff.upload_base("api_batch") == "api_batch"
+
+
+def test_diff_classifies_rows(clock):
+    old = [_row(clock, "+911#0"), _row(clock, "+912#0"), _row(clock, "+913#0"), _row(clock, "+914#0"),
+           _row(clock, "+915#0")]
+    idx = JobIndex(clock=clock)
+    idx.add(old, "aps")
+    idx.claim(old[3])                  # +914 already sent
+    idx.cancel([old[4]["job_id"]])     # +915 cancelled by hand
+    new = [_row(clock, "+911#0", upload=NEW),                    # unchanged
+           _row(clock, "+912#0", body="edited", upload=NEW),     # changed
+           _row(clock, "+914#0", body="edited", upload=NEW),     # already sent
+           _row(clock, "+915#0", upload=NEW),                    # cancelled stays cancelled
+           _row(clock, "+916#0", upload=NEW)]                    # added; +913 removed
+    d = upload_diff.diff(idx.records_for_upload(OLD), new)
+    assert upload_diff.summary(d) == {"added": 1, "changed": 1, "removed": 1, "unchanged": 2, "already_sent": 1}
+    assert d["added"][0]["row_key"] == "+916#0"
+    assert d["removed"][0]["job"]["row_key"] == "+913#0"
+
+
+def test_held_message_diffs_against_its_row_time(clock):
+    old = _row(clock, "+911#0")
+    held = {**old, "scheduled_at": at(clock, 7200), "held_from": old["scheduled_at"]}
+    d = upload_diff.diff([{"job": held, "state": PENDING, "gen": 0}], [_row(clock, "+911#0", upload=NEW)])
+    assert d["unchanged"] == 1 and not d["changed"]
+
+
+def test_apply_cancels_replaces_and_schedules_under_the_old_upload(clock):
+    old = [_row(clock, "+911#0"), _row(clock, "+912#0")]
+    idx = JobIndex(clock=clock)
+    idx.add(old, "aps")
+    new = [{**_row(clock, "+911#0", body="edited"), "upload_id": NEW}, _row(clock, "+913#0", upload=NEW)]
+    d = upload_diff.diff(idx.records_for_upload(OLD), new)
+    scheduled = []
+    ops = upload_diff.apply(d, OLD, lambda jobs: scheduled.extend(jobs) or len(jobs), index=idx)
+    assert ops == 4  # cancel +911 (replaced) and +912 (removed), schedule two
+    assert idx.records[old[1]["job_id"]]["state"] == CANCELLED
+    assert {j["upload_id"] for j in scheduled} == {OLD}
+    replaced = next(j for j in scheduled if j["row_key"] == "+911#0")
+    assert replaced["gen"] == 1 and replaced["body"] == "edited"  # same job id: newer generation
+    assert not idx.claim(old[0])
+
+
+def test_coalesced_carrier_is_replaced_when_a_folded_row_changes(clock):
+    folded = _row(clock, "+911#1", body="second")
+    carrier = _row(clock, "+911#0", body="first\n\nsecond", coalesced=[folded],
+                   row=_row(clock, "+911#0", body="first"))
+    old = [{"job": carrier, "state": PENDING, "gen": 0}]
+    unchanged = upload_diff.diff(old, [_row(clock, "+911#0", body="first", upload=NEW),
+                                       _row(clock, "+911#1", body="second", upload=NEW)])
+    assert upload_diff.summary(unchanged)["unchanged"] == 2
+
+    edited = upload_diff.diff(old, [_row(clock, "+911#0", body="first", upload=NEW),
+                                    _row(clock, "+911#1", body="edited", upload=NEW)])
+    assert [r["job"]["row_key"] for r, _ in edited["changed"]] == ["+911#0"]
+    assert [j["row_key"] for j in edited["added"]] == ["+911#1"]
+
+
+def test_manifest_remembers_rows_the_index_forgot(clock, manifests):
+    jobs = [_row(clock, "+911#0"), _row(clock, "+912#0")]
+    upload_diff.remember(jobs)
+    assert upload_diff.find_previous(NEW, index=JobIndex(clock=clock)) == OLD
+
+    lifecycle.LEDGER.record(jobs[0], "delivered", clock.now, {"sid": "SM1"})
+    assert lifecycle.LEDGER.flush()
+    records = upload_diff.previous_records(OLD, index=JobIndex(clock=clock))  # e.g. after a restart
+    assert [(r["job"]["row_key"], r["state"]) for r in records] == [("+911#0", DISPATCHED)]
+
+    d = upload_diff.diff(records, [_row(clock, "+911#0", upload=NEW), _row(clock, "+912#0", upload=NEW)])
+    assert upload_diff.summary(d) == {"added": 1, "changed": 0, "removed": 0, "unchanged": 0, "already_sent": 1}
+
+
+def test_newer_upload_replaces_the_manifest(clock, manifests):
+    upload_diff.remember([_row(clock, "+911#0")])
+    upload_diff.remember([_row(clock, "+912#0", upload=NEW)])
+    upload_diff.remember([_row(clock, "+913#0")])  # late message of the older upload
+    manifest = upload_diff._load_manifest("list")
+    assert manifest["upload_id"] == NEW
+    assert list(manifest["rows"]) == ["+912#0"]
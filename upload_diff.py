@@ -0,0 +1,247 @@
+# upload_diff.py
+#
+# Incremental re-uploads: match a revised file to the earlier upload of the
+# same list (same file base name), diff the rows by their stable row_key
+# ("<phone>#<n-th row for that phone>") and apply only the delta to the
+# pending schedule: cancel removed rows, replace changed ones, add new ones.
+# Rows already sent (or cancelled by hand) are left alone.
+#
+# The job index forgets finished messages (eviction, restarts), so every
+# scheduled upload also leaves a manifest in UPLOADS_DIR: row_key -> the row_key
+# of the message that carries it (itself unless coalesced) and its due time.
+# With the lifecycle ledger that tells which rows went out even when the index
+# no longer knows the upload.
+
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import job_index
+import lifecycle
+from ingest import IST
+
+UPLOADS_DIR = os.path.join("logs", "uploads")
+MANIFEST_KEEP_SECONDS = float(os.environ.get("UPLOAD_MANIFEST_KEEP_DAYS", 30)) * 86400
+SENT_STATUSES = ("delivered", "failed")  # ledger statuses of rows handed to Twilio
+_manifest_lock = threading.Lock()
+_pruned_at = [0.0]
+
+# Upload ids are "<safe_base>_<YYYYmmdd>_<HHMMSS>" (see ingest.parse_to_jobs).
+
+
+def upload_base(upload_id: str) -> str:
+    parts = upload_id.rsplit("_", 2)
+    return parts[0] if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit() else upload_id
+
+
+def find_previous(upload_id: str, index: job_index.JobIndex = job_index.INDEX) -> Optional[str]:
+    """Most recent other upload of the same list known to the index or its manifest (sent or not)."""
+    base = upload_base(upload_id)
+    candidates = [u for u in index.upload_ids() if u != upload_id and upload_base(u) == base]
+    manifest = _load_manifest(base)
+    if manifest and manifest["upload_id"] != upload_id:
+        candidates.append(manifest["upload_id"])
+    return max(candidates, default=None)  # the timestamp suffix sorts chronologically
+
+
+def previous_records(upload_id: str, index: job_index.JobIndex = job_index.INDEX) -> List[Dict]:
+    """
+    old_records for diff(): the index's records of the upload, plus rows it no
+    longer knows that the ledger shows were sent (counted as already sent, not new).
+    """
+    records = index.records_for_upload(upload_id)
+    manifest = _load_manifest(upload_base(upload_id))
+    if not manifest or manifest["upload_id"] != upload_id:
+        return records
+    known = {r["job"].get("row_key") for r in records}
+    known.update(a.get("row_key") for r in records for a in r["job"].get("coalesced", ()))
+    missing = {k: v for k, v in manifest["rows"].items() if k not in known}
+    if missing:
+        sent = _sent_row_keys(upload_id, (due for _carrier, due in missing.values()))
+        records += [{"job": {"job_id": "", "row_key": key}, "state": job_index.DISPATCHED, "gen": 0}
+                    for key, (carrier, _due) in missing.items() if carrier in sent]
+    return records
+
+
+# ---------------- MANIFESTS ----------------
+def _manifest_path(base: str) -> str:
+    return os.path.join(UPLOADS_DIR, f"{base}.json")
+
+
+def _load_manifest(base: str) -> Optional[Dict]:
+    try:
+        with open(_manifest_path(base), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remember(jobs: Iterable[Dict]):
+    """
+    Record scheduled messages (after coalescing) in their upload's manifest. A newer
+    upload of the same list that is not a revision replaces the manifest.
+    """
+    by_upload: Dict[str, Dict[str, list]] = {}
+    for job in jobs:
+        key = job.get("row_key")
+        if not key or not job.get("upload_id"):
+            continue
+        rows = by_upload.setdefault(job["upload_id"], {})
+        due = job["scheduled_at"].timestamp()
+        rows[key] = [key, due]
+        for a in job.get("coalesced", ()):
+            if a.get("row_key"):
+                rows[a["row_key"]] = [key, due]
+    with _manifest_lock:
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        for upload_id, rows in by_upload.items():
+            base = upload_base(upload_id)
+            manifest = _load_manifest(base)
+            if manifest is None or upload_id > manifest["upload_id"]:
+                manifest = {"upload_id": upload_id, "rows": {}}
+            elif upload_id != manifest["upload_id"]:
+                continue  # an older upload's messages (e.g. handed off): the manifest moved on
+            manifest["rows"].update(rows)
+            path = _manifest_path(base)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, separators=(",", ":"))
+            os.replace(path + ".tmp", path)
+        if time.time() - _pruned_at[0] > 3600:
+            _pruned_at[0] = time.time()
+            _prune_manifests()
+
+
+def _prune_manifests():
+    """Drop manifests of lists not scheduled for MANIFEST_KEEP_SECONDS (one-off API batches, old lists)."""
+    cutoff = time.time() - MANIFEST_KEEP_SECONDS
+    for name in os.listdir(UPLOADS_DIR):
+        path = os.path.join(UPLOADS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _sent_row_keys(upload_id: str, dues: Iterable[float]) -> Set[str]:
+    days = [datetime.fromtimestamp(d, IST).date() for d in dues]
+    start: date = min(days)
+    end: date = max(days) + timedelta(days=2)  # held messages may be logged a little later
+    df = lifecycle.LEDGER.load(start, end)
+    df = df[(df["upload_id"] == upload_id) & df["status"].isin(SENT_STATUSES)]
+    return set(df["row_key"].dropna())
+
+
+def fingerprint(job: Dict) -> tuple:
+    """What a revision can change about a row: time, media, text and lane."""
+    text = job.get("body")
+    due = job.get("held_from") or job["scheduled_at"]  # a message held by the breaker keeps its row time
+    return (due.timestamp(), job.get("media_url", ""), text, job.get("lane") or "")
+
+
+def diff(old_records: List[Dict], new_jobs: List[Dict]) -> Dict:
+    """
+    old_records: previous_records(previous upload).
+    Returns {"added": [job], "changed": [(old_record, job)], "removed": [old_record],
+             "unchanged": n, "already_sent": n, "unkeyed": n}.
+    A pending coalesced message is kept only while its own row and every row folded
+    into it are unchanged; otherwise it is replaced by the revised rows, sent one each.
+    """
+    old_by_key, absorbed = {}, {}  # row_key -> record; absorbed row_key -> (carrier record, row)
+    for rec in old_records:
+        key = rec["job"].get("row_key")
+        if key is not None:
+            old_by_key[key] = rec
+        for a in rec["job"].get("coalesced", ()):
+            absorbed[a.get("row_key")] = (rec, a)
+    out = {"added": [], "changed": [], "removed": [], "unchanged": 0, "already_sent": 0,
+           "unkeyed": len(old_records) - len(old_by_key)}
+
+    def pending_carrier(rec):
+        return rec["job"].get("coalesced") and rec["state"] in job_index.ACTIVE_STATES
+
+    broken = {}    # carrier job_id -> record whose content no longer matches the revision
+    carried = {}   # carrier job_id -> new rows folded into it
+    own_rows = {}  # carrier job_id -> (record, its own new row)
+    seen_absorbed = set()
+    for job in new_jobs:
+        rec = old_by_key.pop(job["row_key"], None)
+        if rec is None and job["row_key"] in absorbed:
+            # folded into another message by coalescing: its content goes (or went) out with that one
+            carrier, row = absorbed[job["row_key"]]
+            seen_absorbed.add(job["row_key"])
+            if not pending_carrier(carrier):
+                out["already_sent" if carrier["state"] == job_index.DISPATCHED else "unchanged"] += 1
+                continue
+            carried.setdefault(carrier["job"]["job_id"], []).append(job)
+            if fingerprint(row) != fingerprint(job):
+                broken[carrier["job"]["job_id"]] = carrier
+            continue
+        if rec is None:
+            out["added"].append(job)
+        elif rec["state"] == job_index.DISPATCHED:
+            out["already_sent"] += 1
+        elif rec["state"] == job_index.CANCELLED:
+            out["unchanged"] += 1
+        elif pending_carrier(rec):
+            own_rows[rec["job"]["job_id"]] = (rec, job)
+            if fingerprint(rec["job"].get("row", rec["job"])) != fingerprint(job):
+                broken[rec["job"]["job_id"]] = rec
+        elif fingerprint(rec["job"]) == fingerprint(job):
+            out["unchanged"] += 1
+        else:
+            out["changed"].append((rec, job))
+    out["removed"] = [rec for rec in old_by_key.values() if rec["state"] in job_index.ACTIVE_STATES]
+
+    # carriers whose own row was removed or whose folded rows were edited or dropped
+    for key, (carrier, _row) in absorbed.items():
+        if key not in seen_absorbed and pending_carrier(carrier):
+            broken[carrier["job"]["job_id"]] = carrier
+    for rec in out["removed"]:
+        if pending_carrier(rec):
+            broken[rec["job"]["job_id"]] = rec
+    for jid, (rec, job) in own_rows.items():
+        if jid in broken:
+            out["changed"].append((rec, job))
+        else:
+            out["unchanged"] += 1
+    for jid, rows in carried.items():
+        for job in rows:
+            if jid in broken:
+                out["added"].append(job)  # its text left with the cancelled carrier: send it on its own
+            else:
+                out["unchanged"] += 1
+    return out
+
+
+def summary(d: Dict) -> Dict[str, int]:
+    return {"added": len(d["added"]), "changed": len(d["changed"]), "removed": len(d["removed"]),
+            "unchanged": d["unchanged"], "already_sent": d["already_sent"]}
+
+
+def apply(d: Dict, previous_upload_id: str, schedule: Callable[[List[Dict]], int],
+          index: job_index.JobIndex = job_index.INDEX) -> int:
+    """
+    Apply a diff: cancel removed + replaced rows, then schedule(jobs) the added
+    and changed ones (with force=True semantics) under the previous upload id,
+    so the next revision diffs against the merged state. Returns scheduler operations.
+    """
+    cancel = [rec["job"]["job_id"] for rec in d["removed"]]
+    cancel += [rec["job"]["job_id"] for rec, _ in d["changed"]]
+    index.cancel(cancel)
+
+    new_jobs = [{**job, "upload_id": previous_upload_id} for job in d["added"]]
+    for rec, job in d["changed"]:
+        job = {**job, "upload_id": previous_upload_id}
+        if job["job_id"] == rec["job"]["job_id"]:
+            # same id (e.g. text-only change): a newer generation stops the old copy from sending
+            job["gen"] = rec["gen"] + 1
+        new_jobs.append(job)
+    if new_jobs:
+        schedule(new_jobs)
+    if cancel:
+        index.purge_async()
+    return len(cancel) + len(new_jobs)
@@ -0,0 +1,121 @@
+# web_app.py
+#
+# Flask app served next to the Streamlit UI (gunicorn entrypoint: web_app:app).
+# Also started in a background thread by media_scheduler.py (WEB_APP_PORT), where
+# /metrics reports the scheduler living in the Streamlit process directly.
+# Scrape the deployed app's /metrics: gunicorn has no scheduler, so it serves its
+# own webhook / API series (process="web") merged with the scheduler leader's
+# last snapshot (process="scheduler", see metrics.render_merged).
+
+import os
+import threading
+
+from flask import Flask, Response, abort, request, send_file
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import ingest_api
+import media_store
+import metrics
+import status_callbacks
+import suppression
+
+app = Flask(__name__)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # Render terminates TLS in front of us
+_server = {"thread": None}  # set by serve_in_background(): this process runs the scheduler
+app.register_blueprint(ingest_api.api)  # /api/v1/batches
+
+
+@app.route("/")
+def home():
+    return "Scheduler is running on Render!"
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    text = metrics.render() if _server["thread"] is not None else metrics.render_merged()
+    return Response(text, mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _signed_url(configured: str = "") -> str:
+    """
+    The URL Twilio computed X-Twilio-Signature over: the configured public URL,
+    else the public base (media_store.public_base_url) plus this path, else
+    request.url as seen through the proxy headers.
+    """
+    if configured:
+        return configured
+    base = media_store.public_base_url()
+    return base + request.full_path.rstrip("?") if base else request.url
+
+
+@app.route("/twilio/status", methods=["POST"])
+def twilio_status_callback():
+    if not status_callbacks.WEBHOOK_AUTH_TOKEN and not status_callbacks.ALLOW_UNSIGNED:
+        return Response("status webhook needs TWILIO_WEBHOOK_AUTH_TOKEN", status=503)
+    form = request.form.to_dict()
+    url = _signed_url(status_callbacks.STATUS_CALLBACK_URL)  # what send passes Twilio as status_callback
+    if not status_callbacks.verify_request(url, form, request.headers.get("X-Twilio-Signature", "")):
+        return Response("invalid signature", status=403)
+    try:
+        accepted = status_callbacks.STORE.submit(form)
+    except ValueError as e:
+        return Response(str(e), status=400)  # malformed: a Twilio retry would not fix it
+    if not accepted:
+        return Response("status buffer full", status=503)
+    metrics.STATUS_CALLBACKS.inc(status=form.get("MessageStatus", ""))
+    return Response(status=204)
+
+
+OPT_OUT_WORDS = {"stop", "stopall", "unsubscribe", "cancel", "end", "quit", "optout"}
+OPT_IN_WORDS = {"start", "unstop", "subscribe"}
+
+
+@app.route("/twilio/inbound", methods=["POST"])
+def twilio_inbound():
+    """Incoming-message webhook: STOP-style replies opt the sender out, START opts them back in."""
+    if not status_callbacks.WEBHOOK_AUTH_TOKEN:
+        # without a signature check anyone could opt a number back in
+        return Response("inbound webhook needs TWILIO_WEBHOOK_AUTH_TOKEN", status=503)
+    form = request.form.to_dict()
+    if not status_callbacks.verify_request(_signed_url(), form, request.headers.get("X-Twilio-Signature", "")):
+        return Response("invalid signature", status=403)
+    word = (form.get("Body") or "").strip().lower()
+    phone = (form.get("From") or "").replace("whatsapp:", "")
+    if word in OPT_OUT_WORDS:
+        suppression.LIST.add([phone])
+    elif word in OPT_IN_WORDS:
+        suppression.LIST.remove([phone])
+    return Response("<Response/>", mimetype="text/xml")
+
+
+@app.route("/media/<asset>")
+def media(asset):
+    """Stored media for Twilio to fetch; names are content hashes, so responses never change."""
+    path = media_store.STORE.path_for(asset)
+    if path is None:
+        abort(404)
+    resp = send_file(path, mimetype=media_store.MIME_TYPES.get(os.path.splitext(asset)[1]),
+                     conditional=True, etag=asset.split(".")[0], max_age=31536000)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    metrics.MEDIA_SERVED.inc()
+    return resp
+
+
+# ---------------- BACKGROUND SERVER ----------------
+def serve_in_background(port: int, host: str = "0.0.0.0"):
+    """Start the Flask app on a daemon thread (once per process); also enables /metrics here."""
+    if _server["thread"] is not None:
+        return _server["thread"]
+    from werkzeug.serving import make_server
+
+    srv = make_server(host, port, app, threaded=True)
+    t = threading.Thread(target=srv.serve_forever, name="web-app", daemon=True)
+    t.start()
+    _server["thread"] = t
+    return t
+
+
+# run flask server (MUST be last!)
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 5000))  # Render provides PORT
+    app.run(host="0.0.0.0", port=port)